@@ -0,0 +1,6 @@
+# Lets the tests import quadricslam & quadricslam_examples from the source
+# tree when run with 'python -m pytest' from here (or anywhere above)
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -1,11 +1,19 @@
 from .quadricslam import QuadricSlam
 # from .quadricslam_original import QuadricSlam
 # from .quadricslam_backup import QuadricSlam
-from .quadricslam_states import QuadricSlamState, SystemState, StepState, qi, xi
+from .quadricslam_states import DetectionStore, KeyRegistry, QuadricSlamState, SystemState, StepState, qi, xi
+from .checkpoint import Checkpointer, latest_checkpoint
 from .data_associator import DataAssociator
 from .data_source import DataSource
 from .detector import Detection, Detector
+from .instrumentation import Instrumentation
+from .keyframe_policy import KeyframePolicy
+from .map_io import MapReader, MapWriter
+from .observation_budget import ObservationBudget
+from .pipeline import Pipeline
+from .profiler import ResourceProfiler, aggregate_reports
+from .refinement import QuadricRefiner
 from .visual_odometry import VisualOdometry
-from .visualisation import visualise
+from .visualisation import AsyncVisualiser, visualise
 
 from . import utils
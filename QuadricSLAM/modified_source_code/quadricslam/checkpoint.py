@@ -0,0 +1,526 @@
+from typing import (TYPE_CHECKING, Any, Dict, List, Optional, Sequence,
+                    Tuple)
+import glob
+import json
+import os
+import threading
+import time
+
+import gtsam
+import gtsam_quadrics
+import numpy as np
+
+from .quadricslam_states import (Detection, DetectionStore,
+                                 FixedLagSmootherKeyTimestampMap, StepState)
+
+if TYPE_CHECKING:
+    from .quadricslam import QuadricSlam
+
+# Checkpoints the complete state of a QuadricSlam run, so a run can resume
+# after a crash, or be forked part way through a sequence (e.g. to try other
+# optimiser settings from the same point).
+#
+# A checkpoint is a single .npz file of plain arrays (no pickles), holding:
+# - every factor in the graph as a row of a table (kind, keys, & measurement),
+#   in graph order with removed slots kept, so factor indices don't change
+# - the estimates, associated & unassociated detections, & labels
+# - the previous step & keyframe (odometry, stamp, & detections)
+# - fixed-lag bookkeeping, & the observation budget (if there is one)
+# - the frame the data source should resume from
+# Noise models & calibration aren't stored (they come from the QuadricSlam
+# being restored into), & neither are images (previous step images are read
+# back from the data source if it supports random access).
+#
+# The optimiser itself isn't stored; it's rebuilt on restore. iSAM2 is rebuilt
+# from the graph linearised at the saved estimates. The fixed-lag smoother
+# is rebuilt from a prior on each key in its window (with the key's marginal
+# covariance when the checkpoint was taken), which stands in for the window's
+# factors (they aren't kept in fixed-lag mode).
+#
+# Checkpointer gathers a checkpoint on the SLAM thread (factor rows are cached
+# between checkpoints, so this only costs what's new), & writes it from a
+# background thread with an atomic rename. If a write is still in progress
+# when the next checkpoint is taken, the older pending one is dropped.
+
+CHECKPOINT_VERSION = 1
+
+# Factor kinds in the factor table
+REMOVED = 0
+PRIOR_POSE = 1
+BETWEEN_POSE = 2
+BOX = 3
+_REMOVED_ROW = (REMOVED, -1, -1, np.zeros(16))
+
+
+def _factor_row(f: gtsam.NonlinearFactor) -> Tuple[int, int, int, np.ndarray]:
+    # (kind, key, key, measurement) of a factor that QuadricSlam adds
+    m = np.zeros(16)
+    if type(f) == gtsam.PriorFactorPose3:
+        m[:] = f.prior().matrix().ravel()
+        return PRIOR_POSE, f.keys()[0], -1, m
+    elif type(f) == gtsam.BetweenFactorPose3:
+        m[:] = f.measured().matrix().ravel()
+        return BETWEEN_POSE, f.keys()[0], f.keys()[1], m
+    elif type(f) == gtsam_quadrics.BoundingBoxFactor:
+        m[:4] = f.measurement().vector()
+        return BOX, f.poseKey(), f.objectKey(), m
+    raise ValueError("Can't checkpoint factors of type '%s'." %
+                     type(f).__name__)
+
+
+def _detection_arrays(prefix: str, ds: Sequence[Detection],
+                      labels: List[str]) -> Dict[str, np.ndarray]:
+    # (labels are appended to the label table as they're seen)
+    index = {l: i for i, l in enumerate(labels)}
+    for d in ds:
+        if d.label not in index:
+            index[d.label] = len(labels)
+            labels.append(d.label)
+    return {
+        prefix + 'bounds':
+            np.array([d.bounds for d in ds], dtype=np.float64).reshape(-1, 4),
+        prefix + 'pose_keys':
+            np.array([d.pose_key for d in ds], dtype=np.int64),
+        prefix + 'quadric_keys':
+            np.array([-1 if d.quadric_key is None else d.quadric_key
+                      for d in ds],
+                     dtype=np.int64),
+        prefix + 'label_ids':
+            np.array([index[d.label] for d in ds], dtype=np.int32)
+    }
+
+
+def _detections(data: Any, prefix: str, labels: List[str]) -> List[Detection]:
+    return [
+        Detection(label=labels[l],
+                  bounds=b.copy(),
+                  pose_key=int(p),
+                  quadric_key=None if q == -1 else int(q))
+        for b, p, q, l in zip(data[prefix + 'bounds'],
+                              data[prefix + 'pose_keys'],
+                              data[prefix + 'quadric_keys'],
+                              data[prefix + 'label_ids'])
+    ]
+
+
+def _covariance(cov: Optional[np.ndarray]) -> np.ndarray:
+    # Covariances are stored padded to 9x9 with NaN (all NaN for None)
+    out = np.full((9, 9), np.nan)
+    if cov is not None:
+        cov = np.asarray(cov)
+        out[:cov.shape[0], :cov.shape[1]] = cov
+    return out
+
+
+def _unpad(cov: np.ndarray, dim: int) -> Optional[np.ndarray]:
+    return None if np.isnan(cov[0, 0]) else cov[:dim, :dim]
+
+
+class Checkpointer:
+
+    def __init__(self,
+                 directory: str,
+                 every: int = 100,
+                 keep: int = 2,
+                 compress: bool = False) -> None:
+        # Checkpoints every 'every' frames into directory, keeping the newest
+        # 'keep' checkpoints
+        if every < 1 or keep < 1:
+            raise ValueError("Checkpoint interval & count must be positive.")
+        self.directory = directory
+        self.every = every
+        self.keep = keep
+        self.compress = compress
+        os.makedirs(directory, exist_ok=True)
+
+        self.written: List[str] = []
+        self.dropped = 0
+        self._rows: List[Tuple[int, int, int, np.ndarray]] = []
+        self._graph: Optional[gtsam.NonlinearFactorGraph] = None
+        self._removed = 0
+        self._pending: Optional[Tuple[str, Dict[str, np.ndarray]]] = None
+        self._error: Optional[BaseException] = None
+        self._cv = threading.Condition()
+        self._writing = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='Checkpointer',
+                                        daemon=True)
+        self._thread.start()
+
+    def due(self, n: StepState) -> bool:
+        return (n.i + 1) % self.every == 0
+
+    def save(self, q: 'QuadricSlam') -> str:
+        # Gathers a checkpoint of q now, & queues it to be written. Returns
+        # the path it will be written to.
+        self._raise()
+        assert q.state.prev_step is not None
+        path = os.path.join(self.directory,
+                            'checkpoint_%08d.npz' % q.state.prev_step.i)
+        arrays = self.snapshot(q)
+        with self._cv:
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = (path, arrays)
+            self._cv.notify()
+        return path
+
+    def flush(self) -> None:
+        # Waits until everything queued has been written
+        with self._cv:
+            while self._pending is not None or self._writing:
+                self._cv.wait()
+        self._raise()
+
+    def close(self) -> None:
+        self.flush()
+        with self._cv:
+            self._closed = True
+            self._cv.notify()
+        self._thread.join()
+
+    def _raise(self) -> None:
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
+
+    def _factor_rows(
+            self, q: 'QuadricSlam') -> List[Tuple[int, int, int, np.ndarray]]:
+        # Factor table of the graph, only converting factors added since the
+        # last checkpoint (the graph is append only, other than removals)
+        s = q.state.system
+        if (s.graph is not self._graph or s.graph.size() < len(self._rows) or
+                len(s.removed_factors) < self._removed):
+            self._rows = []
+            self._removed = 0
+            self._graph = s.graph
+        new = set(s.removed_factors[self._removed:])
+        for i in range(len(self._rows), s.graph.size()):
+            self._rows.append(_REMOVED_ROW if i in new else _factor_row(
+                s.graph.at(i)))
+        for i in new:
+            self._rows[i] = _REMOVED_ROW
+        self._removed = len(s.removed_factors)
+        return self._rows
+
+    def snapshot(self, q: 'QuadricSlam') -> Dict[str, np.ndarray]:
+        s = q.state.system
+        keys = q.state.keys
+        n = q.state.prev_step
+        assert n is not None
+        labels = list(s.associated.label_table)
+
+        rows = self._factor_rows(q)
+        ps = keys.poses(s.estimates)
+        qs = keys.quadrics(s.estimates)
+        out = {
+            'factor_kinds':
+                np.array([r[0] for r in rows], dtype=np.int8),
+            'factor_keys':
+                np.array([(r[1], r[2]) for r in rows],
+                         dtype=np.int64).reshape(-1, 2),
+            'factor_measurements':
+                np.array([r[3] for r in rows],
+                         dtype=np.float64).reshape(-1, 16),
+            'pose_keys':
+                np.array(list(ps.keys()), dtype=np.int64),
+            'poses':
+                np.array([p.matrix() for p in ps.values()],
+                         dtype=np.float64).reshape(-1, 4, 4),
+            'quadric_keys':
+                np.array(list(qs.keys()), dtype=np.int64),
+            'quadric_poses':
+                np.array([x.pose().matrix() for x in qs.values()],
+                         dtype=np.float64).reshape(-1, 4, 4),
+            'quadric_radii':
+                np.array([x.radii() for x in qs.values()],
+                         dtype=np.float64).reshape(-1, 3),
+            'associated_bounds':
+                s.associated.bounds(),
+            'associated_pose_keys':
+                s.associated.pose_keys(),
+            'associated_quadric_keys':
+                s.associated.quadric_keys(),
+            'associated_label_ids':
+                s.associated.label_ids()
+        }
+        out.update(_detection_arrays('unassociated_', s.unassociated, labels))
+
+        # Previous step & keyframe
+        steps = {'prev_step': n}
+        if (q.state.prev_keyframe is not None and
+                q.state.prev_keyframe is not n):
+            steps['prev_keyframe'] = q.state.prev_keyframe
+        for name, x in steps.items():
+            out.update(_detection_arrays(name + '_', x.detections, labels))
+            out[name + '_odom'] = (np.full((4, 4), np.nan) if x.odom is None
+                                   else np.asarray(x.odom, dtype=np.float64))
+
+        # Fixed-lag window, with the marginal covariance of every key in it
+        if s.lag is not None:
+            ks = list(s.stamps.keys())
+            covs: List[Optional[np.ndarray]] = [None] * len(ks)
+            if s.optimiser is not None:
+                isam = s.optimiser.getISAM2()
+                for i, k in enumerate(ks):
+                    try:
+                        covs[i] = isam.marginalCovariance(k)
+                    except RuntimeError:
+                        pass
+            out['window_keys'] = np.array(ks, dtype=np.int64)
+            out['window_stamps'] = np.array([s.stamps[k] for k in ks])
+            out['window_covariances'] = np.array(
+                [_covariance(c) for c in covs]).reshape(-1, 9, 9)
+            out['marginal_keys'] = np.array(list(s.marginals.keys()),
+                                            dtype=np.int64)
+            out['marginal_covariances'] = np.array(
+                [_covariance(c) for c in s.marginals.values()]).reshape(
+                    -1, 9, 9)
+
+        b = q.observation_budget
+        if b is not None:
+            os_ = [(k, o) for k, kept in b.observations.items() for o in kept]
+            out['budget_quadric_keys'] = np.array([k for k, _ in os_],
+                                                  dtype=np.int64)
+            out['budget_indices'] = np.array([o.index for _, o in os_],
+                                             dtype=np.int64)
+            out['budget_pose_keys'] = np.array([o.pose_key for _, o in os_],
+                                               dtype=np.int64)
+            out['budget_centres'] = np.array([o.centre for _, o in os_
+                                             ]).reshape(-1, 3)
+            out['budget_bearings'] = np.array([o.bearing for _, o in os_
+                                              ]).reshape(-1, 3)
+            out['budget_qualities'] = np.array([o.quality for _, o in os_])
+
+        meta = {
+            'version': CHECKPOINT_VERSION,
+            'step': n.i,
+            'next_frame': n.i + 1,
+            'stamp': n.stamp,
+            'steps': list(steps.keys()),
+            'prev_keyframe': (None if q.state.prev_keyframe is None else
+                              q.state.prev_keyframe.i),
+            'stamps': {k: steps[k].stamp for k in steps},
+            'labels': labels,
+            'optimiser_batch': s.optimiser_batch,
+            'lag': s.lag,
+            'lag_unit': s.lag_unit,
+            'budget': (None if b is None else b.report())
+        }
+        out['meta'] = np.array(json.dumps(meta))
+        return out
+
+    def _run(self) -> None:
+        while True:
+            with self._cv:
+                while self._pending is None and not self._closed:
+                    self._cv.wait()
+                if self._pending is None:
+                    return
+                (path, arrays), self._pending = self._pending, None
+                self._writing = True
+            try:
+                self._write(path, arrays)
+            except BaseException as e:
+                self._error = e
+            with self._cv:
+                self._writing = False
+                self._cv.notify_all()
+
+    def _write(self, path: str, arrays: Dict[str, np.ndarray]) -> None:
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            (np.savez_compressed if self.compress else np.savez)(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.written.append(path)
+        for p in checkpoints(self.directory)[:-self.keep]:
+            os.remove(p)
+
+
+def checkpoints(directory: str) -> List[str]:
+    # Checkpoints in a directory, oldest first
+    return sorted(glob.glob(os.path.join(directory, 'checkpoint_*.npz')))
+
+
+def latest_checkpoint(directory: str) -> Optional[str]:
+    cs = checkpoints(directory)
+    return cs[-1] if cs else None
+
+
+def _deferred(q: 'QuadricSlam', i: int, modality: int) -> Any:
+    # Re-reads an image of frame i from the data source (if it can)
+    def load() -> Optional[np.ndarray]:
+        x = q.data_source.read(i)[modality]
+        return x() if callable(x) else x
+
+    return load
+
+
+def restore_checkpoint(q: 'QuadricSlam', path: str) -> None:
+    # Restores q to the state in a checkpoint. q can have different optimiser
+    # settings, noise models, etc. to the run the checkpoint came from (as
+    # long as it isn't fixed-lag mode from a checkpoint without a graph).
+    with np.load(path, allow_pickle=False) as f:
+        data = {k: f[k] for k in f.files}
+    meta = json.loads(str(data['meta']))
+    if meta['version'] != CHECKPOINT_VERSION:
+        raise ValueError("Checkpoint version %d isn't supported." %
+                         meta['version'])
+    q.reset()
+    s = q.state.system
+    if meta['lag'] is not None and s.lag is None:
+        raise ValueError("Checkpoints from fixed-lag mode don't have a "
+                         "graph, so can only be restored in fixed-lag mode.")
+
+    # Estimates
+    for k, T in zip(data['pose_keys'], data['poses']):
+        s.estimates.insert(int(k), gtsam.Pose3(T))
+    for k, T, r in zip(data['quadric_keys'], data['quadric_poses'],
+                       data['quadric_radii']):
+        gtsam_quadrics.ConstrainedDualQuadric(gtsam.Pose3(T),
+                                              r).addToValues(
+                                                  s.estimates, int(k))
+    q.state.keys.invalidate()
+
+    # Detections
+    labels = meta['labels']
+    s.associated = DetectionStore(_detections(data, 'associated_', labels))
+    s.labels = s.associated.labels
+    s.unassociated = _detections(data, 'unassociated_', labels)
+
+    # Graph (removed slots are filled & then removed again, so factor indices
+    # match the checkpoint)
+    full = gtsam.NonlinearFactorGraph()
+    removed = []
+    cal = gtsam.Cal3_S2(s.calib_rgb)
+    kinds = data['factor_kinds']
+    placeholder = None
+    if np.any(kinds == REMOVED):
+        i = int(np.argmax(kinds == PRIOR_POSE))
+        placeholder = gtsam.PriorFactorPose3(
+            int(data['factor_keys'][i, 0]),
+            gtsam.Pose3(data['factor_measurements'][i].reshape(4, 4)),
+            gtsam.noiseModel.Isotropic.Sigma(6, 1))
+    for i, (kind, (k0, k1), m) in enumerate(
+            zip(kinds, data['factor_keys'], data['factor_measurements'])):
+        if kind == PRIOR_POSE:
+            f = gtsam.PriorFactorPose3(int(k0), gtsam.Pose3(m.reshape(4, 4)),
+                                       s.noise_prior)
+        elif kind == BETWEEN_POSE:
+            f = gtsam.BetweenFactorPose3(
+                int(k0), int(k1), gtsam.Pose3(m.reshape(4, 4)),
+                s.odometry_noise(q.state.keys.lookup(int(k1))[1] -
+                                 q.state.keys.lookup(int(k0))[1]))
+        elif kind == BOX:
+            f = gtsam_quadrics.BoundingBoxFactor(
+                gtsam_quadrics.AlignedBox2(m[:4]), cal, int(k0), int(k1),
+                s.noise_boxes)
+        else:
+            f = placeholder
+            removed.append(i)
+        full.add(f)
+        if s.lag is None:
+            s.graph.add(f)
+            if kind != REMOVED:
+                q._index_initial(f)
+    for i in removed:
+        s.graph.remove(i)
+    s.removed_factors = removed
+
+    # Optimiser
+    if s.lag is not None:
+        _restore_fixed_lag(q, data)
+    elif not s.optimiser_batch:
+        # (the graph linearised at the saved estimates, plus initial guesses
+        # for anything that didn't have an estimate, e.g. from batch mode)
+        q.guess_initial_values()
+        s.optimiser = s.optimiser_type(s.optimiser_params)
+        s.optimiser.update(full, s.estimates)
+        if removed:
+            s.optimiser.update(gtsam.NonlinearFactorGraph(), gtsam.Values(),
+                               gtsam.KeyVector(removed))
+        s.pending_factors = gtsam.NonlinearFactorGraph()
+        s.pending_values = gtsam.Values()
+
+    # Observation budget
+    b = q.observation_budget
+    if b is not None and 'budget_indices' in data:
+        from .observation_budget import Observation
+        for k, i, p, c, br, ql in zip(data['budget_quadric_keys'],
+                                      data['budget_indices'],
+                                      data['budget_pose_keys'],
+                                      data['budget_centres'],
+                                      data['budget_bearings'],
+                                      data['budget_qualities']):
+            b.observations.setdefault(int(k), []).append(
+                Observation(int(i), int(p), c, br, float(ql)))
+        for k, v in (meta['budget'] or {}).items():
+            setattr(b, k, v)
+
+    # Previous step & keyframe
+    steps = {}
+    random_access = q.data_source.length() is not None
+    for name in meta['steps']:
+        i = meta['step'] if name == 'prev_step' else meta['prev_keyframe']
+        n = StepState(i, q.state.keys)
+        n.stamp = meta['stamps'][name]
+        odom = data[name + '_odom']
+        n.odom = None if np.isnan(odom[0, 0]) else odom
+        n.detections = _detections(data, name + '_', labels)
+        if random_access:
+            n.rgb = _deferred(q, i, 1)
+            n.depth = _deferred(q, i, 2)
+        steps[name] = n
+    q.state.prev_step = steps['prev_step']
+    q.state.prev_keyframe = (None if meta['prev_keyframe'] is None else
+                             steps.get('prev_keyframe', steps['prev_step']))
+
+    # Stamps in seconds carry on from where the checkpoint left off
+    s.start_time = time.monotonic() - meta['stamp']
+    q.data_source.seek(meta['next_frame'])
+
+
+def _restore_fixed_lag(q: 'QuadricSlam', data: Dict[str, np.ndarray]) -> None:
+    from .quadricslam import MARGINAL_SIGMA
+
+    s = q.state.system
+    keys = q.state.keys
+    for k, c in zip(data.get('marginal_keys', []),
+                    data.get('marginal_covariances', [])):
+        s.marginals[int(k)] = _unpad(c, 9)
+
+    s.optimiser = s.optimiser_type(s.lag, s.optimiser_params)
+    priors = gtsam.NonlinearFactorGraph()
+    values = gtsam.Values()
+    ts = FixedLagSmootherKeyTimestampMap()
+    for k, t, c in zip(data.get('window_keys', []),
+                       data.get('window_stamps', []),
+                       data.get('window_covariances', [])):
+        k = int(k)
+        if keys.lookup(k)[0] == 'q':
+            x = gtsam_quadrics.ConstrainedDualQuadric.getFromValues(
+                s.estimates, k)
+            cov = _unpad(c, 9)
+            x.addToValues(values, k)
+            priors.add(
+                gtsam_quadrics.PriorFactorConstrainedDualQuadric(
+                    k, x,
+                    gtsam.noiseModel.Isotropic.Sigma(9, MARGINAL_SIGMA)
+                    if cov is None else
+                    gtsam.noiseModel.Gaussian.Covariance(cov)))
+        else:
+            p = s.estimates.atPose3(k)
+            cov = _unpad(c, 6)
+            values.insert(k, p)
+            priors.add(
+                gtsam.PriorFactorPose3(
+                    k, p,
+                    gtsam.noiseModel.Isotropic.Sigma(6, MARGINAL_SIGMA)
+                    if cov is None else
+                    gtsam.noiseModel.Gaussian.Covariance(cov)))
+        ts.insert((k, float(t)))
+        s.stamps[k] = float(t)
+    s.optimiser.update(priors, values, ts)
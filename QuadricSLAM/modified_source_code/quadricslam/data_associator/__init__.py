@@ -1,11 +1,14 @@
 from abc import ABC, abstractmethod
-from typing import List, Tuple
+from typing import FrozenSet, List, Tuple
 
 from ..quadricslam_states import Detection, QuadricSlamState
 
 
 class DataAssociator(ABC):
 
+    # Images the associator reads from each step (see DataSource.require())
+    modalities: FrozenSet[str] = frozenset()
+
     def __init__(self) -> None:
         pass
 
@@ -15,6 +18,9 @@ class DataAssociator(ABC):
     ) -> Tuple[List[Detection], List[Detection], List[Detection]]:
         # Returns a tuple of:
         # - list of the newly associated detections
-        # - updated list of associated detections
+        # - updated associated detections: the newly associated detections
+        #   must be appended to state.system.associated (a DetectionStore,
+        #   e.g. with .extend()), which is then returned. Building a new list
+        #   (e.g. n.detections + s.associated) isn't supported.
         # - updated list of unassociated detections
         pass
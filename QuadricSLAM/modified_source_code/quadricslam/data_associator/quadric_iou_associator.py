@@ -1,11 +1,11 @@
 from scipy.optimize import linear_sum_assignment
-from typing import List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 import gtsam
 import gtsam_quadrics
 import numpy as np
 
-from ..quadricslam_states import Detection, QuadricSlamState, qi as QI
-from ..utils import ps_and_qs_from_values
+from ..quadricslam_states import Detection, QuadricSlamState
+from ..utils import iou_matrix, project_quadrics
 from . import DataAssociator
 
 # Basic associator that makes associations by checking the 2D bounding box IOU
@@ -18,8 +18,128 @@ from . import DataAssociator
 
 class QuadricIouAssociator(DataAssociator):
 
-    def __init__(self, iou_thresh: float = 0.2) -> None:
+    def __init__(self,
+                 iou_thresh: float = 0.2,
+                 batch: bool = True,
+                 frustum_culling: bool = False,
+                 image_size: Optional[Tuple[float, float]] = None,
+                 max_range: float = np.inf,
+                 per_label: bool = False) -> None:
+        # batch=False falls back to projecting each quadric per detection
+        # through gtsam_quadrics (slow, but useful as a reference)
+        #
+        # frustum_culling only considers quadrics whose bounding sphere is in
+        # front of the camera, within the image, and within max_range. The
+        # image size defaults to twice the principal point (grown to cover
+        # any detection that lies outside of that). Spheres are refreshed for
+        # the quadrics touched by each update (see KeyRegistry.touch()), so
+        # with iSAM2 a quadric that drifted without being observed can be
+        # culled on stale bounds. Off by default, as culling can change
+        # which quadrics detections are associated with.
+        #
+        # per_label only compares detections with quadrics of the same label,
+        # solving a small assignment per label.
+        #
+        # In every mode, detections left without a match become new quadrics.
         self.iou_thresh = iou_thresh
+        self.batch = batch
+        self.frustum_culling = frustum_culling
+        self.image_size = image_size
+        self.max_range = max_range
+        self.per_label = per_label
+
+    def candidates(self, state: QuadricSlamState) -> np.ndarray:
+        # Indices (into state.keys.quadric_keys()) of quadrics that could be
+        # seen in the current step
+        s = state.system
+        n = state.this_step
+        qks = state.keys.quadric_keys(s.estimates)
+        if not self.frustum_culling:
+            return np.arange(len(qks))
+
+        calib = np.asarray(s.calib_rgb, dtype=np.float64)
+        image_size = self.image_size
+        if image_size is None:
+            bs = np.array([d.bounds for d in n.detections]).reshape(-1, 4)
+            image_size = (np.max([2 * calib[3], *bs[:, 2]]),
+                          np.max([2 * calib[4], *bs[:, 3]]))
+        return state.keys.quadric_positions(
+            s.estimates,
+            state.keys.spatial_index(s.estimates).in_frustum(
+                gtsam.Pose3(n.odom).matrix(),
+                calib,
+                image_size,
+                far=self.max_range))
+
+    def ious(self, state: QuadricSlamState, detections: List[Detection],
+             cs: np.ndarray) -> np.ndarray:
+        # IOU matrix of detections against the projections of the quadrics
+        # at indices cs (into state.keys.quadric_keys())
+        s = state.system
+        n = state.this_step
+        if self.batch:
+            return iou_matrix(
+                np.array([d.bounds for d in detections],
+                         dtype=np.float64).reshape(-1, 4),
+                project_quadrics(state.keys.quadric_matrices(s.estimates)[cs],
+                                 gtsam.Pose3(n.odom).matrix(),
+                                 np.asarray(s.calib_rgb, dtype=np.float64)))
+
+        qks = state.keys.quadric_keys(s.estimates)
+        qs = state.keys.quadrics(s.estimates)
+        ious = np.zeros((len(detections), len(cs)))
+        for i, b in enumerate(
+            [gtsam_quadrics.AlignedBox2(d.bounds) for d in detections]):
+            for j, q in enumerate([qs[qks[c]] for c in cs]):
+                # Note: smartBounds() can be used here for more accuracy?
+                ious[i, j] = b.iou(
+                    gtsam_quadrics.QuadricCamera.project(
+                        q, gtsam.Pose3(n.odom),
+                        gtsam.Cal3_S2(s.calib_rgb)).bounds())
+                if np.isnan(ious[i, j]):
+                    ious[i, j] = 0
+        return ious
+
+    @staticmethod
+    def _sparse_assignment(ious: np.ndarray) -> List[Tuple[int, int]]:
+        # Optimal assignment over only the rows & columns with some overlap,
+        # skipping the solver when either side has a single candidate
+        rs = np.flatnonzero(ious.max(axis=1, initial=0) > 0)
+        cs = np.flatnonzero(ious.max(axis=0, initial=0) > 0)
+        if len(rs) == 0 or len(cs) == 0:
+            return []
+        elif len(cs) == 1:
+            return [(rs[np.argmax(ious[rs, cs[0]])], cs[0])]
+        elif len(rs) == 1:
+            return [(rs[0], cs[np.argmax(ious[rs[0], cs])])]
+        ris, cis = linear_sum_assignment(-ious[np.ix_(rs, cs)])
+        return list(zip(rs[ris], cs[cis]))
+
+    def _matches_per_label(
+            self, state: QuadricSlamState,
+            cs: np.ndarray) -> List[Tuple[int, int, float]]:
+        s = state.system
+        n = state.this_step
+        qks = state.keys.quadric_keys(s.estimates)
+
+        # Bucket detections & candidate quadrics by label
+        cs_by_label: Dict[Any, List[int]] = {}
+        for j, c in enumerate(cs):
+            cs_by_label.setdefault(s.labels.get(qks[c]), []).append(j)
+        ds_by_label: Dict[Any, List[int]] = {}
+        for i, d in enumerate(n.detections):
+            ds_by_label.setdefault(d.label, []).append(i)
+
+        # Solve each bucket separately
+        matches = []
+        for l, dis in ds_by_label.items():
+            cis = cs_by_label.get(l, [])
+            if len(cis) == 0:
+                continue
+            ious = self.ious(state, [n.detections[i] for i in dis], cs[cis])
+            matches.extend([(dis[r], cis[c], ious[r, c])
+                            for r, c in self._sparse_assignment(ious)])
+        return matches
 
     def associate(
         self, state: QuadricSlamState
@@ -30,41 +150,43 @@ class QuadricIouAssociator(DataAssociator):
 
         s = state.system
         n = state.this_step
-        ps, qs = ps_and_qs_from_values(state.system.estimates)
-        next_q = (0 if len(qs.values()) == 0 else (
-            max([int(gtsam.Symbol(k).string()[1:]) for k in qs.keys()]) + 1))
+        next_q = state.keys.next_quadric_index(s.estimates)
+        qks = state.keys.quadric_keys(s.estimates)
+        cs = self.candidates(state)
 
         # Bail early if there's no quadrics yet to match against (each box is
         # treated as a new quadric)
-        if len(qs.values()) == 0:
+        if len(cs) == 0:
             for i, d in enumerate(n.detections):
-                d.quadric_key = QI(next_q + i)
-            return (n.detections, n.detections + s.associated, [])
-
-        # Compute IOU matrix for each unassociated detection
-        ious = np.zeros((len(n.detections), len(qs.values())))
-        for i, b in enumerate(
-            [gtsam_quadrics.AlignedBox2(d.bounds) for d in n.detections]):
-            for j, q in enumerate(qs.values()):
-                # Note: smartBounds() can be used here for more accuracy?
-                ious[i, j] = b.iou(
-                    gtsam_quadrics.QuadricCamera.project(
-                        q, gtsam.Pose3(n.odom),
-                        gtsam.Cal3_S2(s.calib_rgb)).bounds())
-                if np.isnan(ious[i, j]):
-                    ious[i, j] = 0
+                d.quadric_key = state.keys.qi(next_q + i)
+            s.associated.extend(n.detections)
+            return (n.detections, s.associated, [])
 
-        # Solve as an optimal assignment problem
-        dis, qis = linear_sum_assignment(-ious)
+        # Solve as an optimal assignment problem, giving (detection index,
+        # candidate index, IOU) matches
+        if self.per_label:
+            matches = self._matches_per_label(state, cs)
+        else:
+            ious = self.ious(state, n.detections, cs)
+            dis, qis = linear_sum_assignment(-ious)
+            matches = [(di, qi, ious[di, qi]) for di, qi in zip(dis, qis)]
 
         # Use IOU thresh to decide whether to associate with an existing
         # quadric, or define a new one
         i = 0
-        for di, qi in zip(dis, qis):
-            if ious[di, qi] < self.iou_thresh:
-                n.detections[di].quadric_key = QI(next_q + i)
+        for di, qi, iou in matches:
+            if iou < self.iou_thresh:
+                n.detections[di].quadric_key = state.keys.qi(next_q + i)
                 i += 1
             else:
-                n.detections[di].quadric_key = list(qs.keys())[qi]
+                n.detections[di].quadric_key = qks[cs[qi]]
+
+        # Detections left without a match (more detections than candidates,
+        # or no candidates with their label) become new quadrics
+        for d in n.detections:
+            if d.quadric_key is None:
+                d.quadric_key = state.keys.qi(next_q + i)
+                i += 1
 
-        return (n.detections, n.detections + s.associated, [])
+        s.associated.extend(n.detections)
+        return (n.detections, s.associated, [])
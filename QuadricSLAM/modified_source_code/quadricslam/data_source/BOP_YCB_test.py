@@ -1,45 +1,28 @@
-from spatialmath import SE3, UnitQuaternion, SO3
+from spatialmath import SE3
 from typing import Optional, Tuple
 import gtsam
 import numpy as np
 import os
 import cv2
 import matplotlib.pyplot as plt
-from scipy.spatial.transform import Rotation
 
 from ..quadricslam_states import QuadricSlamState
-from . import DataSource
-import json
+from . import DataSource, ImageFile
+from .bop_utils import SceneManifest
 
 
 class BOP_YCB_dataset(DataSource):
 
     def __init__(self, path:str) -> None:
-        # Validate path exists
+        # Frame ids, camera poses & intrinsics for every frame, read from
+        # the scene's (cached) manifest
         self.path = path
-        if not os.path.isdir(self.path):
-            raise ValueError("Path '%s' does not exist." % self.path)
-        
-        
-        img_id = os.listdir(self.path + '/rgb')
-        img_id = [os.path.splitext(x)[0] for x in img_id]
-        img_id.sort()
-        self.img_id = [str(int(x)) for x in img_id]
-        # stores the image id in string format after removing the zeros in beginning
-
-        # load odom
-        f1 = open(self.path + '/scene_camera.json')
-        data1 = json.load(f1)
-
-        self.odom_data = list(dict())
-        for id in self.img_id:
-            temp = dict()
-            temp['cam_R_w2c'] = data1[id]['cam_R_w2c']
-            temp['cam_t_w2c'] = data1[id]['cam_t_w2c']
-            temp['cam_K'] = data1[id]['cam_K']
-            self.odom_data.append(temp)
-
-        self.depth_scale = data1[id]['depth_scale']
+        self.manifest = SceneManifest(self.path)
+        self.img_id = [str(x) for x in self.manifest.frame_ids]
+        self.poses = self.manifest.poses
+        self.calib = self.manifest.calib
+        self.depth_scale = (self.manifest.depth_scale[-1]
+                            if len(self.manifest) else 1)
         self.data_length = len(self.img_id)
         self.restart()
 
@@ -49,11 +32,7 @@ class BOP_YCB_dataset(DataSource):
         # Vector representing the calibration (fx, fy, skew, u0, v0)
         # (fx, fy, skew, u0, v0) - (1,5,2,3,6)
         # return np.array([1, 1, 0, 0, 0])
-        return [self.odom_data[self.data_i]['cam_K'][0],
-                self.odom_data[self.data_i]['cam_K'][4],
-                self.odom_data[self.data_i]['cam_K'][1],
-                self.odom_data[self.data_i]['cam_K'][2],
-                self.odom_data[self.data_i]['cam_K'][5]]
+        return self.calib[self.data_i]
 
 
     def done(self) -> bool:
@@ -70,12 +49,8 @@ class BOP_YCB_dataset(DataSource):
     # In BOP dataset, the camera pose is rotation and translation matrixes
     # In TUM RGBD dataset, the pose is in quaternion format
     def _gt_to_SE3(self, i: int) -> SE3:
-        R = np.array(self.odom_data[i]['cam_R_w2c']).reshape((3,3))
-        t = self.odom_data[i]['cam_t_w2c']
-        pose = np.eye(4)
-        pose[:3, :3] = R
-        pose[:3, 3] = t
-        return np.linalg.inv(pose)
+        # (copied, as the table is read-only)
+        return self.poses[i].copy()
     
     # to do. load depth and rgb image and odom
     def next(
@@ -84,22 +59,20 @@ class BOP_YCB_dataset(DataSource):
         # Tuple is (odom, RGB, depth)
         i = self.data_i
         self.data_i += 1
-        depth_img = cv2.imread(self.path + '/depth/' + f'{int(self.img_id[i]):06d}' + '.png', -1)
-        # print(depth_img)
-        # print(depth_img.dtype)
-        depth_img = depth_img.astype(np.float64)
-        # print(depth_img)
-        # print(depth_img.dtype)
-        depth_img *= self.depth_scale
-        # print(depth_img)
-        # print(depth_img.dtype)
-        depth_img = depth_img.astype(np.uint16)
-        # print(depth_img)
-        # print(depth_img.dtype)
-        
+        return self.read(i)
+
+    def length(self) -> int:
+        return self.data_length
+
+    def read(
+        self, i: int
+    ) -> Tuple[Optional[SE3], Optional[np.ndarray], Optional[np.ndarray]]:
+        # Images are only decoded if something uses them (depth is scaled by
+        # depth_scale, and kept as uint16)
         return (self._gt_to_SE3(i),
-                cv2.imread(self.path + '/rgb/' + f'{int(self.img_id[i]):06d}' + '.png'),
-                depth_img)
+                ImageFile(self.path + '/rgb/' + f'{int(self.img_id[i]):06d}' + '.png'),
+                ImageFile(self.path + '/depth/' + f'{int(self.img_id[i]):06d}' + '.png', -1,
+                          self.depth_scale, np.uint16))
         # if state.prev_step is None:
         #     initial_pose = self._gt_to_SE3(i)
         #     state.system.initial_pose = gtsam.Pose3(initial_pose.A)
@@ -113,3 +86,8 @@ class BOP_YCB_dataset(DataSource):
     def restart(self) -> None:
         self.data_i = 0
 
+    def seek(self, i: int) -> None:
+        if not 0 <= i <= self.data_length:
+            raise ValueError("Frame %d is out of range." % i)
+        self.data_i = i
+
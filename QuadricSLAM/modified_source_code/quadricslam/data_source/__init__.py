@@ -1,17 +1,56 @@
 from abc import ABC, abstractmethod
 from spatialmath import SE3
-from typing import Optional, Tuple
+from typing import FrozenSet, Iterable, Optional, Tuple
 import gtsam
 import numpy as np
 
-from ..quadricslam_states import QuadricSlamState
+from ..quadricslam_states import MODALITIES, QuadricSlamState
+
+
+class ImageFile:
+    # Deferred read of an image file (see ImageLoader), which is small and
+    # cheap to pickle. Optionally scales the image & converts its type after
+    # decoding.
+
+    def __init__(self,
+                 path: str,
+                 flags: int = 1,
+                 scale: float = 1,
+                 dtype: Optional[np.dtype] = None) -> None:
+        self.path = path
+        self.flags = flags
+        self.scale = scale
+        self.dtype = dtype
+
+    def __call__(self) -> Optional[np.ndarray]:
+        import cv2
+        im = cv2.imread(self.path, self.flags)
+        if im is None:
+            return im
+        elif self.scale != 1:
+            im = im * self.scale
+        return im if self.dtype is None else im.astype(self.dtype, copy=False)
 
 
 class DataSource(ABC):
 
+    # Whether next() reads (or changes) the state it's given. Sources that do
+    # can't be read ahead of the rest of the system, so PrefetchingDataSource
+    # calls their next() in turn instead.
+    uses_state: bool = False
+
     def __init__(self) -> None:
         pass
 
+    def require(self, modalities: Iterable[str]) -> None:
+        # Declares which images the rest of the system will actually use.
+        # Images may still be returned as loaders (see ImageLoader); this is
+        # a hint for sources that eagerly load images (e.g. prefetching).
+        self.required_modalities = frozenset(modalities)
+
+    def required(self) -> FrozenSet[str]:
+        return getattr(self, 'required_modalities', frozenset(MODALITIES))
+
     def calib_depth(self) -> float:
         # Float representing a depth scaling factor
         return 1
@@ -29,9 +68,32 @@ class DataSource(ABC):
     def next(
         self, state: QuadricSlamState
     ) -> Tuple[Optional[SE3], Optional[np.ndarray], Optional[np.ndarray]]:
-        # Tuple is (odom, RGB, depth)
+        # Tuple is (odom, RGB, depth), where either image may be an
+        # ImageLoader rather than an array
         pass
 
     @abstractmethod
     def restart(self) -> None:
         pass
+
+    def seek(self, i: int) -> None:
+        # Moves the source so the next call to next() returns frame i (e.g.
+        # when resuming from a checkpoint). Sources that can't jump to a
+        # frame only support seeking to the start.
+        if i != 0:
+            raise NotImplementedError(
+                "'%s' can't seek to frame %d." % (type(self).__name__, i))
+        self.restart()
+
+    def length(self) -> Optional[int]:
+        # Number of frames, if known up front. Sources that return a length
+        # must also implement read().
+        return None
+
+    def read(
+        self, i: int
+    ) -> Tuple[Optional[SE3], Optional[np.ndarray], Optional[np.ndarray]]:
+        # Random access to frame i, without moving the source's position.
+        # Must be safe to call from multiple threads at once.
+        raise NotImplementedError(
+            "'%s' doesn't support random access." % type(self).__name__)
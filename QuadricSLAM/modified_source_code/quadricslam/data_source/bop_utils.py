@@ -0,0 +1,200 @@
+from typing import Dict, Optional, Tuple
+import json
+import numpy as np
+import os
+
+# Helpers shared by the BOP data sources & detectors. A scene directory is
+# compiled once into a binary manifest (frame ids, camera poses &
+# intrinsics, and ground truth boxes as flat offset-indexed arrays), which is
+# then memory-mapped by everything that reads the scene. The manifest is
+# rebuilt automatically whenever the scene's JSON files (or its list of
+# frames) change.
+#
+# Manifest layout: MANIFEST_MAGIC, then the JSON header length (uint64), the
+# JSON header itself, and finally each array (64 byte aligned) at the offset
+# the header gives relative to the start of the data.
+
+MANIFEST_FILE = 'scene_manifest.bin'
+MANIFEST_MAGIC = b'BOPSCENE'
+MANIFEST_VERSION = 1
+_ALIGN = 64
+
+# Files whose modification times the manifest is checked against (modifying
+# the 'rgb' directory's listing updates its mtime)
+_SOURCES = ('rgb', 'scene_camera.json', 'scene_gt_info.json', 'scene_gt.json')
+
+
+def orthonormalise(Rs: np.ndarray) -> np.ndarray:
+    # Nearest rotation matrices to a stack of (...,3,3) matrices (the JSON
+    # rotations are only stored to limited precision)
+    U, _, Vt = np.linalg.svd(Rs)
+    U[..., :, 2] *= np.sign(np.linalg.det(U @ Vt))[..., np.newaxis]
+    return U @ Vt
+
+
+def invert_rigid(Ts: np.ndarray) -> np.ndarray:
+    # Closed form inverse (R^T, -R^T t) of a stack of (...,4,4) rigid
+    # transforms
+    Rts = np.swapaxes(Ts[..., :3, :3], -1, -2)
+    out = np.zeros_like(Ts)
+    out[..., :3, :3] = Rts
+    out[..., :3, 3] = -np.einsum('...ij,...j->...i', Rts, Ts[..., :3, 3])
+    out[..., 3, 3] = 1
+    return out
+
+
+def _source_mtimes(path: str) -> Dict[str, Optional[int]]:
+    return {
+        s: (os.stat(os.path.join(path, s)).st_mtime_ns
+            if os.path.exists(os.path.join(path, s)) else None)
+        for s in _SOURCES
+    }
+
+
+def _load_json(path: str, name: str) -> Optional[dict]:
+    if not os.path.exists(os.path.join(path, name)):
+        return None
+    with open(os.path.join(path, name)) as f:
+        return json.load(f)
+
+
+def _index_scene(path: str) -> Dict[str, np.ndarray]:
+    # Frame ids are in the (zero padded) order of the images in 'rgb'
+    ids = sorted(os.path.splitext(x)[0] for x in os.listdir(path + '/rgb'))
+    ids = [str(int(x)) for x in ids]
+
+    cams = [_load_json(path, 'scene_camera.json')[i] for i in ids]
+    w2c = np.zeros((len(cams), 4, 4))
+    w2c[:, :3, :3] = orthonormalise(
+        np.array([c['cam_R_w2c'] for c in cams],
+                 dtype=np.float64).reshape(-1, 3, 3))
+    w2c[:, :3, 3] = np.array([c['cam_t_w2c'] for c in cams],
+                             dtype=np.float64).reshape(-1, 3)
+    w2c[:, 3, 3] = 1
+    Ks = np.array([c['cam_K'] for c in cams], dtype=np.float64).reshape(-1, 9)
+
+    # Ground truth boxes are (x, y, width, height) in the JSON, and stored as
+    # (xmin, ymin, xmax, ymax)
+    gt_info = _load_json(path, 'scene_gt_info.json')
+    gt = _load_json(path, 'scene_gt.json')
+    counts = ([len(gt_info[i]) for i in ids]
+              if gt_info is not None and gt is not None else [0] * len(ids))
+    labels = [
+        gt[i][d]['obj_id'] for i, c in zip(ids, counts) for d in range(c)
+    ]
+    bounds = np.array([
+        gt_info[i][d]['bbox_obj'] for i, c in zip(ids, counts)
+        for d in range(c)
+    ],
+                      dtype=np.float64).reshape(-1, 4)
+    bounds[:, 2:] += bounds[:, :2]
+
+    return {
+        'frame_ids': np.array([int(i) for i in ids], dtype=np.int64),
+        'poses': invert_rigid(w2c),
+        'calib': np.ascontiguousarray(Ks[:, [0, 4, 1, 2, 5]]),
+        'depth_scale': np.array([c['depth_scale'] for c in cams],
+                                dtype=np.float64),
+        'det_offsets': np.concatenate(([0], np.cumsum(counts))).astype(
+            np.int64),
+        'det_labels': np.array(labels, dtype=np.int64),
+        'det_bounds': bounds,
+    }
+
+
+def _read_manifest(
+        file: str,
+        sources: Dict[str, Optional[int]]) -> Optional[Dict[str, np.ndarray]]:
+    try:
+        with open(file, 'rb') as f:
+            if f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+                return None
+            header = json.loads(f.read(int.from_bytes(f.read(8), 'little')))
+        if (header['version'] != MANIFEST_VERSION or
+                header['sources'] != sources):
+            return None
+        mm = np.memmap(file, dtype=np.uint8, mode='r')
+        return {
+            k: np.frombuffer(mm,
+                             dtype=np.dtype(a['dtype']),
+                             count=int(np.prod(a['shape'])),
+                             offset=header['data_offset'] +
+                             a['offset']).reshape(a['shape'])
+            for k, a in header['arrays'].items()
+        }
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write_manifest(file: str, sources: Dict[str, Optional[int]],
+                    arrays: Dict[str, np.ndarray]) -> None:
+    layout = {}
+    offset = 0
+    for k, a in arrays.items():
+        layout[k] = {'dtype': a.dtype.str, 'shape': a.shape, 'offset': offset}
+        offset += -(-a.nbytes // _ALIGN) * _ALIGN
+
+    # The header's own length determines where the data starts
+    header = {
+        'version': MANIFEST_VERSION,
+        'sources': sources,
+        'arrays': layout,
+        'data_offset': 0
+    }
+    n = len(MANIFEST_MAGIC) + 8 + len(json.dumps(header)) + 32
+    header['data_offset'] = -(-n // _ALIGN) * _ALIGN
+    h = json.dumps(header).encode()
+
+    # Written atomically so concurrent runs never see a partial manifest. A
+    # read-only dataset just means no caching.
+    tmp = '%s.%d.tmp' % (file, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(MANIFEST_MAGIC + len(h).to_bytes(8, 'little') + h)
+            for k, a in arrays.items():
+                f.seek(header['data_offset'] + layout[k]['offset'])
+                f.write(np.ascontiguousarray(a).tobytes())
+            f.truncate(header['data_offset'] + offset)
+        os.replace(tmp, file)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class SceneManifest:
+    # Everything the system reads from a BOP scene's JSON files, with frames
+    # in order. Arrays are read-only (memory-mapped if the manifest was
+    # cached).
+
+    def __init__(self, path: str, cache: bool = True) -> None:
+        if not os.path.isdir(path):
+            raise ValueError("Path '%s' does not exist." % path)
+        self.path = path
+
+        file = os.path.join(path, MANIFEST_FILE)
+        sources = _source_mtimes(path)
+        arrays = _read_manifest(file, sources) if cache else None
+        if arrays is None:
+            arrays = _index_scene(path)
+            if cache:
+                _write_manifest(file, sources, arrays)
+            for a in arrays.values():
+                a.setflags(write=False)
+        self.has_detections = (sources['scene_gt_info.json'] is not None and
+                               sources['scene_gt.json'] is not None)
+
+        self.frame_ids: np.ndarray = arrays['frame_ids']  # (N,)
+        self.poses: np.ndarray = arrays['poses']  # (N,4,4), camera to world
+        self.calib: np.ndarray = arrays['calib']  # (N,5)
+        self.depth_scale: np.ndarray = arrays['depth_scale']  # (N,)
+        self.det_offsets: np.ndarray = arrays['det_offsets']  # (N+1,)
+        self.det_labels: np.ndarray = arrays['det_labels']  # (D,)
+        self.det_bounds: np.ndarray = arrays['det_bounds']  # (D,4)
+
+    def __len__(self) -> int:
+        return len(self.frame_ids)
+
+    def detections(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Labels & bounds of the ground truth boxes in frame i
+        a, b = self.det_offsets[i], self.det_offsets[i + 1]
+        return self.det_labels[a:b], self.det_bounds[a:b]
@@ -0,0 +1,217 @@
+from collections import deque
+from concurrent.futures import (Executor, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from spatialmath import SE3
+from typing import Any, Deque, FrozenSet, Iterable, Optional, Tuple
+import numpy as np
+import queue
+import threading
+
+from ..quadricslam_states import QuadricSlamState
+from . import DataSource
+
+Frame = Tuple[Optional[SE3], Optional[np.ndarray], Optional[np.ndarray]]
+
+# Wraps any DataSource, loading (and decoding) upcoming frames in the
+# background while the rest of the system works on the current one. Frames
+# are always returned in order, and done() / restart() behave exactly as they
+# would for the wrapped source. Deferred images are only loaded in the
+# background if they're declared as required (see DataSource.require()).
+#
+# Sources with random access (i.e. that implement length() & read()) have the
+# next `depth` frames read concurrently by a pool of `workers` threads (or
+# processes, if `processes=True`; the source must then be picklable). Other
+# sources are read sequentially by a single background thread, into a queue
+# of at most `depth` frames. Neither path gives the source the state of the
+# step a frame is for (frames are read before it exists), so sources that
+# use it (see DataSource.uses_state) aren't prefetched: next() is passed
+# straight through to them instead.
+
+_DONE = object()
+
+# Each worker process gets its own copy of the source once, rather than it
+# being pickled with every request
+_worker_source: Optional[DataSource] = None
+
+
+def _load(frame: Frame, modalities: FrozenSet[str]) -> Frame:
+    odom, rgb, depth = frame
+    return (odom, rgb() if callable(rgb) and 'rgb' in modalities else rgb,
+            depth() if callable(depth) and 'depth' in modalities else depth)
+
+
+def _read(source: DataSource, i: int, modalities: FrozenSet[str]) -> Frame:
+    return _load(source.read(i), modalities)
+
+
+def _init_worker(source: DataSource) -> None:
+    global _worker_source
+    _worker_source = source
+
+
+def _read_in_worker(i: int, modalities: FrozenSet[str]) -> Frame:
+    assert _worker_source is not None
+    return _read(_worker_source, i, modalities)
+
+
+class PrefetchingDataSource(DataSource):
+
+    def __init__(self,
+                 source: DataSource,
+                 depth: int = 8,
+                 workers: int = 2,
+                 processes: bool = False) -> None:
+        if depth < 1 or workers < 1:
+            raise ValueError("Queue depth & worker count must be positive.")
+        self.source = source
+        self.depth = depth
+        self.workers = workers
+        self.processes = processes
+
+        self._executor: Optional[Executor] = None
+        self._futures: Deque[Future] = deque()
+        self._producer: Optional[threading.Thread] = None
+        self._queue: queue.Queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._peeked: Any = None
+        self.restart()
+
+    def calib_depth(self) -> float:
+        return self.source.calib_depth()
+
+    def calib_rgb(self) -> np.ndarray:
+        return self.source.calib_rgb()
+
+    def require(self, modalities: Iterable[str]) -> None:
+        super().require(modalities)
+        self.source.require(modalities)
+
+    def length(self) -> Optional[int]:
+        return self.source.length()
+
+    def read(
+        self, i: int
+    ) -> Tuple[Optional[SE3], Optional[np.ndarray], Optional[np.ndarray]]:
+        return self.source.read(i)
+
+    def occupancy(self) -> int:
+        # Number of frames currently loaded (or being loaded) ahead
+        return (len(self._futures) if self._length is not None else
+                self._queue.qsize() + (self._peeked is not None))
+
+    def done(self) -> bool:
+        if self._length is not None:
+            return self._i >= self._length
+        elif self._producer is None:
+            # Nothing has been requested yet, so the source is still in sync
+            return self.source.done()
+        return self._peek() is _DONE
+
+    def next(
+        self, state: QuadricSlamState
+    ) -> Tuple[Optional[SE3], Optional[np.ndarray], Optional[np.ndarray]]:
+        if self._length is not None:
+            if self._i >= self._length:
+                raise self._exhausted()
+            self._fill()
+            f = self._futures.popleft()
+            self._i += 1
+            self._fill()
+            return f.result()
+
+        if self.source.uses_state:
+            if self.source.done():
+                raise self._exhausted()
+            return _load(self.source.next(state), self.required())
+
+        if self._producer is None:
+            self._producer = threading.Thread(target=self._produce,
+                                              args=(state,),
+                                              daemon=True)
+            self._producer.start()
+        x = self._peek()
+        if x is _DONE:
+            # (kept peeked, so later calls don't wait on the finished
+            # producer)
+            raise self._exhausted()
+        self._peeked = None
+        if isinstance(x, BaseException):
+            raise x
+        return x
+
+    def restart(self) -> None:
+        self.seek(0)
+
+    def seek(self, i: int) -> None:
+        # Drops everything loaded ahead, & starts loading again from frame i
+        self._shutdown_producer()
+        for f in self._futures:
+            f.cancel()
+        self._futures.clear()
+
+        if i == 0:
+            self.source.restart()
+        else:
+            self.source.seek(i)
+        self._length = (None
+                        if self.source.uses_state else self.source.length())
+        self._i = i
+        self._next_i = i
+        if self._length is not None and self._executor is None:
+            self._executor = (ProcessPoolExecutor(
+                self.workers,
+                initializer=_init_worker,
+                initargs=(self.source,)) if self.processes else
+                              ThreadPoolExecutor(self.workers))
+
+    def close(self) -> None:
+        self._shutdown_producer()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _exhausted(self) -> RuntimeError:
+        return RuntimeError("No frames left in '%s'." %
+                            type(self.source).__name__)
+
+    def _fill(self) -> None:
+        assert self._executor is not None and self._length is not None
+        while (len(self._futures) < self.depth and
+               self._next_i < self._length):
+            self._futures.append(
+                self._executor.submit(_read_in_worker, self._next_i,
+                                      self.required()) if self.processes else
+                self._executor.submit(_read, self.source, self._next_i,
+                                      self.required()))
+            self._next_i += 1
+
+    def _peek(self) -> Any:
+        if self._peeked is None:
+            self._peeked = self._queue.get()
+        return self._peeked
+
+    def _produce(self, state: QuadricSlamState) -> None:
+        try:
+            while not self._stop.is_set() and not self.source.done():
+                self._put(_load(self.source.next(state), self.required()))
+        except BaseException as e:
+            self._put(e)
+        self._put(_DONE)
+
+    def _put(self, x: Any) -> None:
+        # Blocks while the queue is full, unless we're asked to stop
+        while not self._stop.is_set():
+            try:
+                self._queue.put(x, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _shutdown_producer(self) -> None:
+        if self._producer is not None:
+            self._stop.set()
+            self._producer.join()
+        self._producer = None
+        self._stop = threading.Event()
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._peeked = None
@@ -7,7 +7,7 @@ import os
 import gtsam
 
 from ..quadricslam_states import QuadricSlamState
-from . import DataSource
+from . import DataSource, ImageFile
 
 
 class TumRgbd(DataSource):
@@ -90,14 +90,28 @@ class TumRgbd(DataSource):
         self.data_i += 1
         if i == 0:
             state.system.initial_pose = gtsam.Pose3(self._gt_to_SE3(i).A)
+        return self.read(i)
+
+    def length(self) -> int:
+        return self.data_length
+
+    def read(
+        self, i: int
+    ) -> Tuple[Optional[SE3], Optional[np.ndarray], Optional[np.ndarray]]:
+        if i == 0:
             return(self._gt_to_SE3(i),
-                    cv2.imread(os.path.join(self.path, cast(str, self.data['rgb'][i][1]))),
-                    cv2.imread(os.path.join(self.path, cast(str, self.data['depth'][i][1])), -1))
+                    ImageFile(os.path.join(self.path, cast(str, self.data['rgb'][i][1]))),
+                    ImageFile(os.path.join(self.path, cast(str, self.data['depth'][i][1])), -1))
         else:
             return (SE3() if i == 0 else self._gt_to_SE3(i) *
                     self._gt_to_SE3(i - 1).inv(),
-                    cv2.imread(os.path.join(self.path, cast(str, self.data['rgb'][i][1]))),
-                    cv2.imread(os.path.join(self.path, cast(str, self.data['depth'][i][1])), -1))
+                    ImageFile(os.path.join(self.path, cast(str, self.data['rgb'][i][1]))),
+                    ImageFile(os.path.join(self.path, cast(str, self.data['depth'][i][1])), -1))
 
     def restart(self) -> None:
         self.data_i = 0
+
+    def seek(self, i: int) -> None:
+        if not 0 <= i <= self.data_length:
+            raise ValueError("Frame %d is out of range." % i)
+        self.data_i = i
@@ -0,0 +1,98 @@
+from typing import Dict, Tuple
+import numpy as np
+
+# Summed-area tables (integral images) of a depth image, so the sum, mean,
+# variance, & number of valid pixels in any box come from 4 lookups per
+# table rather than a pass over the box. Pixels are valid if they're
+# positive & finite (missing depth is 0, or NaN for float images); invalid
+# pixels count as 0 in the sums. Each table is only built the first time
+# something needs it. StepState keeps one per step (see
+# StepState.depth_integral()).
+#
+# Boxes are (N,4) arrays of (xmin, ymin, xmax, ymax) pixel bounds, truncated
+# to integers like the initialisers always did, with exclusive maxima (like
+# slicing) & clipped to the image.
+
+
+def summed_area_table(image: np.ndarray) -> np.ndarray:
+    # (H+1,W+1) table of the sums of all pixels above & left of each pixel,
+    # so any box's sum takes 4 lookups (see box_sums())
+    sat = np.zeros((image.shape[0] + 1, image.shape[1] + 1))
+    np.cumsum(image, axis=0, dtype=np.float64, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def _clip(boxes: np.ndarray,
+          shape: Tuple[int, ...]) -> Tuple[np.ndarray, ...]:
+    h, w = shape[:2]
+    boxes = np.asarray(boxes).reshape(-1, 4).astype('int')
+    x0, x1 = np.clip(boxes[:, 0], 0, w), np.clip(boxes[:, 2], 0, w)
+    y0, y1 = np.clip(boxes[:, 1], 0, h), np.clip(boxes[:, 3], 0, h)
+    return x0, y0, np.maximum(x0, x1), np.maximum(y0, y1)
+
+
+def box_sums(sat: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    # Sums of pixels in boxes, from a summed-area table
+    x0, y0, x1, y1 = _clip(boxes, (sat.shape[0] - 1, sat.shape[1] - 1))
+    return sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
+
+
+def box_areas(boxes: np.ndarray, shape: Tuple[int, ...]) -> np.ndarray:
+    # Pixels in boxes, within an image of shape
+    x0, y0, x1, y1 = _clip(boxes, shape)
+    return (x1 - x0) * (y1 - y0)
+
+
+class DepthIntegral:
+
+    def __init__(self, depth: np.ndarray) -> None:
+        self.depth = depth
+        self.shape = depth.shape
+        self._tables: Dict[str, np.ndarray] = {}
+
+    def _table(self, name: str) -> np.ndarray:
+        # 'counts' of valid pixels, or 'sums' / 'squares' of valid depths
+        if name not in self._tables:
+            d = self.depth
+            valid = (d > 0) & np.isfinite(d)
+            if name == 'counts':
+                self._tables[name] = summed_area_table(valid)
+            else:
+                d = np.where(valid, d, 0).astype(np.float64)
+                self._tables[name] = summed_area_table(
+                    d * d if name == 'squares' else d)
+        return self._tables[name]
+
+    def areas(self, boxes: np.ndarray) -> np.ndarray:
+        # Pixels in each box (valid or not)
+        return box_areas(boxes, self.shape)
+
+    def counts(self, boxes: np.ndarray) -> np.ndarray:
+        # Valid pixels in each box
+        return box_sums(self._table('counts'), boxes)
+
+    def sums(self, boxes: np.ndarray) -> np.ndarray:
+        # Sums of the valid depths in each box
+        return box_sums(self._table('sums'), boxes)
+
+    def means(self, boxes: np.ndarray) -> np.ndarray:
+        # Mean valid depth in each box (NaN if it has no valid pixels)
+        n = self.counts(boxes)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(n > 0, self.sums(boxes) / n, np.nan)
+
+    def variances(self, boxes: np.ndarray) -> np.ndarray:
+        # Variance of the valid depths in each box (NaN if it has no valid
+        # pixels)
+        n = self.counts(boxes)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            m = self.sums(boxes) / n
+            v = box_sums(self._table('squares'), boxes) / n - m * m
+        # (cancellation can leave tiny negative variances for flat boxes)
+        return np.where(n > 0, np.maximum(v, 0), np.nan)
+
+    @property
+    def nbytes(self) -> int:
+        # Memory used by the tables built so far
+        return sum(t.nbytes for t in self._tables.values())
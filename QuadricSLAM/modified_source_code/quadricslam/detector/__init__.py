@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from typing import FrozenSet, List, Optional
 import numpy as np
 
 from ..quadricslam_states import Detection, QuadricSlamState
@@ -7,6 +7,9 @@ from ..quadricslam_states import Detection, QuadricSlamState
 
 class Detector(ABC):
 
+    # Images the detector reads from each step (see DataSource.require())
+    modalities: FrozenSet[str] = frozenset({'rgb'})
+
     def __init__(self) -> None:
         pass
 
@@ -0,0 +1,160 @@
+from contextlib import contextmanager
+from typing import (Callable, Dict, Iterator, List, Optional, Sequence,
+                    Tuple)
+import csv
+import json
+import numpy as np
+import threading
+import time
+
+# Built-in instrumentation for QuadricSlam. Each step gets a record of the
+# wall & CPU time (of the thread running it) spent in each stage, and
+# counters (e.g. number of factors, or variables relinearised by iSAM2).
+# Work done once at the end of spin() (batch optimisation, refinement) is
+# recorded in a separate 'spin' record.
+#
+# Records are passed to on_record as each step finishes, and can be dumped to
+# JSON or CSV. Stages are timed with time.perf_counter() & time.thread_time(),
+# so overhead is a few microseconds per stage.
+#
+# Note that images are loaded lazily, so decoding time is charged to the
+# first stage that uses an image rather than to 'load'.
+
+
+class StepRecord:
+
+    def __init__(self, i: Optional[int]) -> None:
+        # i is None for the 'spin' record
+        self.i = i
+        self.wall: Dict[str, float] = {}
+        self.cpu: Dict[str, float] = {}
+        self.counters: Dict[str, float] = {}
+
+    def to_dict(self) -> Dict:
+        return {
+            'i': self.i,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'counters': self.counters
+        }
+
+
+class Instrumentation:
+
+    def __init__(
+            self,
+            on_record: Optional[Callable[[StepRecord], None]] = None,
+            summary: bool = True,
+            percentiles: Sequence[float] = (50, 90, 99)) -> None:
+        # summary prints a summary of stage times when spin() finishes
+        self.on_record = on_record
+        self.summary = summary
+        self.percentiles = percentiles
+        self.reset()
+
+    def reset(self) -> None:
+        self.records: List[StepRecord] = []
+        self.spin = StepRecord(None)
+        self._open: Dict[int, StepRecord] = {}
+        self._lock = threading.Lock()
+
+    def record(self, i: Optional[int]) -> StepRecord:
+        # Record for step i (stages of a step may run on different threads)
+        if i is None:
+            return self.spin
+        with self._lock:
+            return self._open.setdefault(i, StepRecord(i))
+
+    @staticmethod
+    def now() -> Tuple[float, float]:
+        return time.perf_counter(), time.thread_time()
+
+    def add(self, i: Optional[int], name: str, since: Tuple[float,
+                                                          float]) -> None:
+        # Charges the time since 'since' (from now()) to a stage of step i
+        r = self.record(i)
+        w, c = Instrumentation.now()
+        r.wall[name] = r.wall.get(name, 0) + w - since[0]
+        r.cpu[name] = r.cpu.get(name, 0) + c - since[1]
+
+    @contextmanager
+    def stage(self, i: Optional[int], name: str) -> Iterator[None]:
+        since = Instrumentation.now()
+        try:
+            yield
+        finally:
+            self.add(i, name, since)
+
+    def count(self, i: Optional[int], name: str, value: float) -> None:
+        self.record(i).counters[name] = value
+
+    def finish(self, i: int) -> None:
+        with self._lock:
+            r = self._open.pop(i, None)
+        if r is None:
+            return
+        self.records.append(r)
+        if self.on_record:
+            self.on_record(r)
+
+    def stages(self) -> List[str]:
+        # Stage names in the order they were first seen
+        return list(
+            dict.fromkeys(k for r in self.records for k in r.wall.keys()))
+
+    def counter_names(self) -> List[str]:
+        return list(
+            dict.fromkeys(k for r in self.records for k in r.counters.keys()))
+
+    def summarise(self) -> Dict[str, Dict[str, float]]:
+        # Per stage count, total, & percentiles of wall time per step (ms),
+        # plus total CPU time
+        out = {}
+        for s in self.stages():
+            ws = np.array([r.wall[s] for r in self.records if s in r.wall
+                          ]) * 1e3
+            out[s] = {'steps': len(ws), 'total_ms': ws.sum()}
+            out[s].update({
+                'p%g_ms' % p: v
+                for p, v in zip(self.percentiles,
+                                np.percentile(ws, self.percentiles))
+            })
+            out[s]['cpu_ms'] = 1e3 * sum(
+                r.cpu[s] for r in self.records if s in r.cpu)
+        return out
+
+    def format_summary(self) -> str:
+        ss = self.summarise()
+        cols = ['steps', 'total_ms'
+               ] + ['p%g_ms' % p for p in self.percentiles] + ['cpu_ms']
+        lines = ['%-12s' % 'stage' + ''.join('%12s' % c for c in cols)]
+        lines += [
+            '%-12s' % s + ''.join('%12.3f' % v[c] for c in cols)
+            for s, v in ss.items()
+        ]
+        lines += [
+            '%-12s%12.3f (%s)' % (s, self.spin.wall[s] * 1e3, 'spin')
+            for s in self.spin.wall.keys()
+        ]
+        return '\n'.join(lines)
+
+    def to_json(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(
+                {
+                    'steps': [r.to_dict() for r in self.records],
+                    'spin': self.spin.to_dict()
+                }, f)
+
+    def to_csv(self, path: str) -> None:
+        # One row per step (the 'spin' record is JSON only)
+        stages = self.stages()
+        counters = self.counter_names()
+        with open(path, 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(['i'] + ['%s_wall' % s for s in stages] +
+                       ['%s_cpu' % s for s in stages] + counters)
+            for r in self.records:
+                w.writerow([r.i] + [r.wall.get(s, '') for s in stages] +
+                           [r.cpu.get(s, '') for s in stages] +
+                           [r.counters.get(c, '') for c in counters])
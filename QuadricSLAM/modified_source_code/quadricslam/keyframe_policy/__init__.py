@@ -0,0 +1,20 @@
+from abc import ABC, abstractmethod
+from typing import FrozenSet
+
+from ..quadricslam_states import QuadricSlamState
+
+
+class KeyframePolicy(ABC):
+
+    # Images the policy reads from each step (see DataSource.require())
+    modalities: FrozenSet[str] = frozenset()
+
+    def __init__(self) -> None:
+        pass
+
+    @abstractmethod
+    def is_keyframe(self, state: QuadricSlamState) -> bool:
+        # Decides whether the current step (with its odometry & detections)
+        # becomes a pose in the graph. The last keyframe is
+        # state.prev_keyframe (None if there's been no keyframe yet).
+        pass
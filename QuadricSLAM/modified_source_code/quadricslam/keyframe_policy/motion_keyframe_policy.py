@@ -0,0 +1,42 @@
+import numpy as np
+
+from ..quadricslam_states import QuadricSlamState
+from . import KeyframePolicy
+
+# Makes a keyframe whenever the camera has moved far enough (translation in
+# the units of the odometry, rotation in radians) since the last keyframe, the
+# set of detected labels changes, or max_gap frames have passed. Frames
+# without odometry are always keyframes.
+
+
+class MotionKeyframePolicy(KeyframePolicy):
+
+    def __init__(self,
+                 translation: float = 0.05,
+                 rotation: float = np.radians(5),
+                 max_gap: int = 10,
+                 label_changes: bool = True) -> None:
+        super().__init__()
+        self.translation = translation
+        self.rotation = rotation
+        self.max_gap = max_gap
+        self.label_changes = label_changes
+
+    def is_keyframe(self, state: QuadricSlamState) -> bool:
+        assert state.this_step is not None
+        k = state.prev_keyframe
+        n = state.this_step
+        if k is None or k.odom is None or n.odom is None:
+            return True
+        elif n.i - k.i >= self.max_gap:
+            return True
+        elif self.label_changes and (set(d.label for d in n.detections) !=
+                                     set(d.label for d in k.detections)):
+            return True
+
+        # Motion since the last keyframe (odometry is camera to world)
+        T = np.linalg.solve(np.asarray(k.odom), np.asarray(n.odom))
+        return bool(
+            np.linalg.norm(T[:3, 3]) >= self.translation or
+            np.arccos(np.clip((np.trace(T[:3, :3]) - 1) / 2, -1, 1)) >=
+            self.rotation)
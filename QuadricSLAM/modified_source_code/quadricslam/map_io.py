@@ -0,0 +1,412 @@
+from typing import (IO, Any, Dict, Iterator, List, Optional, Sequence,
+                    Tuple)
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+from .quadricslam_states import QuadricSlamState
+
+# Compact binary storage for maps & trajectories (replacing dumping nested
+# lists to output.json). A map file is a 16 byte header followed by chunks,
+# each a 16 byte chunk header & a payload padded to 8 bytes:
+#
+#   header:  b'QSLAMMAP', uint32 version, uint32 reserved
+#   chunk:   4 byte tag, uint32 reserved, uint64 payload length, payload
+#
+#   'META'   JSON object describing the run
+#   'LABL'   JSON list of labels, appended to the file's label table
+#   'STEP'   int64 (step, poses, quadrics, reserved), then contiguous arrays:
+#              pose keys (int64), poses (float64, 3x4 rows of the 4x4),
+#              quadric keys (int64), quadric poses (float64, 3x4),
+#              quadric radii (float64, 3), quadric labels (int32, into the
+#              label table)
+#
+# All numbers are little endian. A STEP chunk holds the estimates written at
+# that step; MapWriter only writes estimates that changed since they were
+# last written, so a streamed incremental run stores each step's changes &
+# the map at any step is the latest estimate of every key up to it (steps
+# where nothing changed have no chunk). MapWriter flushes after every
+# flush_every STEP chunks, so a crash only loses the chunks since the last
+# flush; a truncated final chunk is ignored by the reader.
+#
+# MapReader memory maps the file, so opening a map only reads the chunk
+# headers & arrays are views of the file. to_json() writes the same JSON
+# the examples used to (for the postprocessing notebooks).
+
+MAGIC = b'QSLAMMAP'
+MAP_VERSION = 1
+_HEADER = struct.Struct('<8sII')
+_CHUNK = struct.Struct('<4sIQ')
+_STEP = struct.Struct('<4q')
+
+# Bytes per pose & per quadric in a STEP chunk
+POSE_BYTES = 8 + 12 * 8
+QUADRIC_BYTES = 8 + 12 * 8 + 3 * 8 + 4
+
+
+def _pad(n: int) -> int:
+    return -n % 8
+
+
+def _rows(poses: np.ndarray) -> np.ndarray:
+    # (N,4,4) -> (N,12)
+    return np.ascontiguousarray(poses[:, :3, :], dtype='<f8').reshape(-1, 12)
+
+
+def _matrices(rows: np.ndarray) -> np.ndarray:
+    # (N,12) -> (N,4,4)
+    out = np.zeros((len(rows), 4, 4))
+    out[:, :3, :] = rows.reshape(-1, 3, 4)
+    out[:, 3, 3] = 1
+    return out
+
+
+def state_arrays(
+    state: QuadricSlamState
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+           List[Any]]:
+    # (pose keys, poses, quadric keys, quadric poses, radii, labels) of the
+    # current estimates
+    s = state.system
+    ps = state.keys.poses(s.estimates)
+    qs = state.keys.quadrics(s.estimates)
+    return (np.fromiter(ps.keys(), dtype=np.int64, count=len(ps)),
+            np.array([p.matrix() for p in ps.values()]).reshape(-1, 4, 4),
+            np.fromiter(qs.keys(), dtype=np.int64, count=len(qs)),
+            np.array([q.pose().matrix() for q in qs.values()
+                     ]).reshape(-1, 4, 4),
+            np.array([q.radii() for q in qs.values()]).reshape(-1, 3),
+            [s.labels.get(k, '') for k in qs.keys()])
+
+
+class _Latest:
+    # Latest written row of each key (sorted by key), to find what changed
+
+    def __init__(self, width: int) -> None:
+        self.keys = np.empty((0,), dtype=np.int64)
+        self.rows = np.empty((0, width))
+
+    def changed(self, keys: np.ndarray, rows: np.ndarray,
+                tolerance: float) -> np.ndarray:
+        # Mask of rows that are new, or differ by more than tolerance, which
+        # become the latest rows
+        i = np.searchsorted(self.keys, keys)
+        found = i < len(self.keys)
+        found[found] = self.keys[i[found]] == keys[found]
+        mask = ~found
+        mask[found] = np.abs(rows[found] - self.rows[i[found]]).max(
+            axis=1, initial=0) > tolerance
+        self.rows[i[found & mask]] = rows[found & mask]
+        if np.any(~found):
+            ks = np.concatenate([self.keys, keys[~found]])
+            rs = np.concatenate([self.rows, rows[~found]])
+            order = np.argsort(ks, kind='stable')
+            self.keys, self.rows = ks[order], rs[order]
+        return mask
+
+
+class MapWriter:
+
+    def __init__(self,
+                 path: str,
+                 meta: Optional[Dict[str, Any]] = None,
+                 tolerance: float = 0.0,
+                 flush_every: int = 1) -> None:
+        # Estimates that moved by no more than tolerance (in any element of
+        # the pose or radii) since they were last written aren't written
+        # again. The file is flushed after every flush_every STEP chunks (so
+        # readers of a live map see them), or only on close() if 0.
+        self.path = path
+        self.tolerance = tolerance
+        self.flush_every = flush_every
+        self._unflushed = 0
+        self.bytes = 0
+        self._labels: Dict[str, int] = {}
+        self._poses = _Latest(12)
+        self._quadrics = _Latest(15)
+        self._f: Optional[IO[bytes]] = open(path, 'wb')
+        self._write(_HEADER.pack(MAGIC, MAP_VERSION, 0))
+        if meta is not None:
+            self._chunk(b'META', json.dumps(meta).encode())
+
+    def __enter__(self) -> 'MapWriter':
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def __call__(self, state: QuadricSlamState) -> None:
+        # (so a writer can be used as QuadricSlam's on_new_estimate)
+        self.write_state(state)
+
+    def _write(self, b: bytes) -> None:
+        assert self._f is not None
+        self._f.write(b)
+        self.bytes += len(b)
+
+    def _chunk(self, tag: bytes, *parts: bytes) -> None:
+        n = sum(len(p) for p in parts)
+        self._write(_CHUNK.pack(tag, 0, n + _pad(n)))
+        for p in parts:
+            self._write(p)
+        self._write(b'\0' * _pad(n))
+
+    def write(self, step: int, pose_keys: np.ndarray, poses: np.ndarray,
+              quadric_keys: np.ndarray, quadric_poses: np.ndarray,
+              radii: np.ndarray, labels: Sequence[Any]) -> None:
+        # Writes the estimates at a step (poses are 4x4), skipping any that
+        # haven't changed
+        pose_keys = np.asarray(pose_keys, dtype=np.int64)
+        quadric_keys = np.asarray(quadric_keys, dtype=np.int64)
+        prs = _rows(np.asarray(poses).reshape(-1, 4, 4))
+        qrs = np.hstack([
+            _rows(np.asarray(quadric_poses).reshape(-1, 4, 4)),
+            np.asarray(radii, dtype='<f8').reshape(-1, 3)
+        ])
+        pm = self._poses.changed(pose_keys, prs, self.tolerance)
+        qm = self._quadrics.changed(quadric_keys, qrs, self.tolerance)
+        if not pm.any() and not qm.any():
+            return
+
+        new = list(
+            dict.fromkeys(l for l, m in zip(labels, qm)
+                          if m and l not in self._labels))
+        if new:
+            for l in new:
+                self._labels[l] = len(self._labels)
+            self._chunk(b'LABL', json.dumps(new).encode())
+
+        qrs = qrs[qm]
+        self._chunk(
+            b'STEP', _STEP.pack(step, int(pm.sum()), len(qrs), 0),
+            pose_keys[pm].astype('<i8').tobytes(),
+            prs[pm].tobytes(), quadric_keys[qm].astype('<i8').tobytes(),
+            np.ascontiguousarray(qrs[:, :12]).tobytes(),
+            np.ascontiguousarray(qrs[:, 12:]).tobytes(),
+            np.array([self._labels[l] for l, m in zip(labels, qm) if m],
+                     dtype='<i4').tobytes())
+        self._unflushed += 1
+        if self.flush_every and self._unflushed >= self.flush_every:
+            self.flush()
+
+    def write_state(self,
+                    state: QuadricSlamState,
+                    step: Optional[int] = None) -> None:
+        # Writes the current estimates, at the current step by default
+        if step is None:
+            n = state.this_step or state.prev_step
+            step = -1 if n is None else n.i
+        self.write(step, *state_arrays(state))
+
+    def flush(self) -> None:
+        if self._f is not None:
+            self._f.flush()
+        self._unflushed = 0
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+def save_map(path: str,
+             state: QuadricSlamState,
+             meta: Optional[Dict[str, Any]] = None) -> None:
+    # Writes the current estimates as a single step map
+    with MapWriter(path, meta) as w:
+        w.write_state(state)
+
+
+class MapStep:
+
+    def __init__(self, step: int, pose_keys: np.ndarray, poses: np.ndarray,
+                 quadric_keys: np.ndarray, quadric_poses: np.ndarray,
+                 radii: np.ndarray, labels: np.ndarray) -> None:
+        # Poses are (N,12) rows of the 4x4 (views of the file)
+        self.step = step
+        self.pose_keys = pose_keys
+        self.poses = poses
+        self.quadric_keys = quadric_keys
+        self.quadric_poses = quadric_poses
+        self.radii = radii
+        self.labels = labels
+
+
+class MapReader:
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._mm = np.memmap(path, dtype=np.uint8, mode='r')
+        if len(self._mm) < _HEADER.size:
+            raise ValueError("'%s' isn't a map file." % path)
+        magic, version, _ = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("'%s' isn't a map file." % path)
+        elif version != MAP_VERSION:
+            raise ValueError("Map version %d isn't supported." % version)
+
+        self.meta: Dict[str, Any] = {}
+        self.labels: List[Any] = []
+        self.steps: List[MapStep] = []
+        self.chunk_bytes: Dict[str, int] = {}
+        self.truncated = False
+        o = _HEADER.size
+        while o + _CHUNK.size <= len(self._mm):
+            tag, _, n = _CHUNK.unpack_from(self._mm, o)
+            p = o + _CHUNK.size
+            if p + n > len(self._mm):
+                self.truncated = True
+                break
+            self._read_chunk(tag, p, n)
+            k = tag.decode('ascii', 'replace')
+            self.chunk_bytes[k] = self.chunk_bytes.get(k, 0) + _CHUNK.size + n
+            o = p + n
+        self.truncated |= o != len(self._mm)
+
+    def _array(self, o: int, dtype: str, n: int) -> np.ndarray:
+        return np.frombuffer(self._mm, dtype=dtype, count=n, offset=o)
+
+    def _read_chunk(self, tag: bytes, o: int, n: int) -> None:
+        if tag == b'META':
+            self.meta.update(json.loads(bytes(self._mm[o:o + n]).rstrip(b'\0')))
+        elif tag == b'LABL':
+            self.labels += json.loads(bytes(self._mm[o:o + n]).rstrip(b'\0'))
+        elif tag == b'STEP':
+            step, n_p, n_q, _ = _STEP.unpack_from(self._mm, o)
+            o += _STEP.size
+            pk = self._array(o, '<i8', n_p)
+            o += 8 * n_p
+            ps = self._array(o, '<f8', 12 * n_p).reshape(-1, 12)
+            o += 96 * n_p
+            qk = self._array(o, '<i8', n_q)
+            o += 8 * n_q
+            qp = self._array(o, '<f8', 12 * n_q).reshape(-1, 12)
+            o += 96 * n_q
+            qr = self._array(o, '<f8', 3 * n_q).reshape(-1, 3)
+            o += 24 * n_q
+            ql = self._array(o, '<i4', n_q)
+            self.steps.append(MapStep(step, pk, ps, qk, qp, qr, ql))
+        # (unknown chunks are skipped, so newer writers can add chunks)
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    def __iter__(self) -> Iterator[MapStep]:
+        return iter(self.steps)
+
+    def _latest(self, keys: List[np.ndarray],
+                rows: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        # Latest row of each key (sorted by key)
+        if not keys:
+            return np.empty((0,), dtype=np.int64), np.empty((0, 0))
+        ks = np.concatenate(keys)
+        rs = np.concatenate(rows)
+        # (unique takes the first occurrence, so search in reverse)
+        u, i = np.unique(ks[::-1], return_index=True)
+        return u, rs[::-1][i]
+
+    def _upto(self, step: Optional[int],
+              chunks: Optional[int]) -> List[MapStep]:
+        # STEP chunks written at or before a step (default all), or the
+        # first number of chunks
+        if chunks is not None:
+            return self.steps[:chunks]
+        elif step is not None:
+            return [s for s in self.steps if s.step <= step]
+        return self.steps
+
+    def trajectory(
+            self,
+            step: Optional[int] = None,
+            chunks: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # (keys, 4x4 poses) as of a step (default the last), or the first
+        # number of STEP chunks
+        ss = self._upto(step, chunks)
+        ks, rs = self._latest([s.pose_keys for s in ss],
+                              [s.poses for s in ss])
+        return ks, _matrices(rs.reshape(-1, 12))
+
+    def quadrics(
+        self,
+        step: Optional[int] = None,
+        chunks: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[Any]]:
+        # (keys, 4x4 poses, radii, labels) as of a step (default the last),
+        # or the first number of STEP chunks
+        ss = self._upto(step, chunks)
+        ks, rs = self._latest([s.quadric_keys for s in ss], [
+            np.hstack([s.quadric_poses, s.radii, s.labels[:, np.newaxis]])
+            for s in ss
+        ])
+        rs = rs.reshape(-1, 16)
+        return (ks, _matrices(rs[:, :12]), rs[:, 12:15],
+                [self.labels[int(l)] for l in rs[:, 15]])
+
+    def footprint(self) -> Dict[str, Any]:
+        # Storage used by the file, & by the final map per pose & per object
+        pks, _ = self.trajectory()
+        qks, _, _, labels = self.quadrics()
+        label_bytes = self.chunk_bytes.get('LABL', 0)
+        final = (len(pks) * POSE_BYTES + len(qks) * QUADRIC_BYTES +
+                 label_bytes)
+        return {
+            'file_bytes': len(self._mm),
+            'chunk_bytes': self.chunk_bytes,
+            'steps': len(self.steps),
+            'poses': len(pks),
+            'objects': len(qks),
+            'pose_records': sum(len(s.pose_keys) for s in self.steps),
+            'object_records': sum(len(s.quadric_keys) for s in self.steps),
+            'bytes_per_pose': POSE_BYTES,
+            'bytes_per_object':
+                QUADRIC_BYTES + label_bytes / max(1, len(qks)),
+            'final_map_bytes': final,
+            'file_bytes_per_pose': len(self._mm) / max(1, len(pks)),
+            'file_bytes_per_object': len(self._mm) / max(1, len(qks))
+        }
+
+    def to_json(self, path: str, step: Optional[int] = None) -> None:
+        write_json(path, *self.trajectory(step), *self.quadrics(step))
+
+
+def write_json(path: str, pose_keys: np.ndarray, poses: np.ndarray,
+               quadric_keys: np.ndarray, quadric_poses: np.ndarray,
+               radii: np.ndarray, labels: Sequence[Any]) -> None:
+    # The JSON the examples used to write ({"poses", "quadrics", "labels"},
+    # keyed by gtsam key)
+    with open(path, 'w') as f:
+        json.dump(
+            {
+                'poses': {
+                    int(k): T.tolist() for k, T in zip(pose_keys, poses)
+                },
+                'quadrics': {
+                    int(k): {
+                        'pose': T.tolist(),
+                        'centroid': T[:3, 3].tolist(),
+                        'radii': r.tolist()
+                    } for k, T, r in zip(quadric_keys, quadric_poses, radii)
+                },
+                'labels': {int(k): l for k, l in zip(quadric_keys, labels)}
+            }, f)
+
+
+def save_json(path: str, state: QuadricSlamState) -> None:
+    write_json(path, *state_arrays(state))
+
+
+if __name__ == '__main__':
+    # python3 -m quadricslam.map_io MAP [JSON]
+    #   prints a map's footprint, & exports it to JSON if asked
+    if len(sys.argv) < 2:
+        print("ERROR: Path to a map is a required argument.")
+        sys.exit(1)
+    r = MapReader(sys.argv[1])
+    print(json.dumps(r.footprint(), indent=2))
+    if len(sys.argv) > 2:
+        r.to_json(sys.argv[2])
+        print("Wrote '%s' (%d bytes)" %
+              (sys.argv[2], os.path.getsize(sys.argv[2])))
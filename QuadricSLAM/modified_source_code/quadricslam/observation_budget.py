@@ -0,0 +1,131 @@
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+from .quadricslam_states import Detection, QuadricSlamState
+
+# Caps the number of box factors kept for each quadric, so optimisation cost
+# grows with the number of objects rather than frames x objects. Every
+# observation of a quadric is kept until it reaches max_observations. After
+# that a new observation only gets a factor by replacing the kept observation
+# that adds the least, in which case the superseded factor is removed from
+# the graph.
+#
+# Observations are compared by viewpoint: the angle between their bearings
+# (the world frame ray through the box centre) plus baseline_weight times the
+# distance between their camera centres. An observation's score is its
+# distance to the nearest other kept observation, scaled by the box quality
+# (boxes within border pixels of the image edge are likely truncated, and
+# count for truncated_quality). Boxes are scored from odometry alone, so
+# this works before anything has an estimate (i.e. in batch mode).
+#
+# In fixed-lag mode factors are never replaced (old ones leave the smoother
+# by marginalisation instead), and the cap only counts observations from
+# poses still in the window.
+
+
+class Observation:
+
+    def __init__(self, index: int, pose_key: int, centre: np.ndarray,
+                 bearing: np.ndarray, quality: float) -> None:
+        self.index = index
+        self.pose_key = pose_key
+        self.centre = centre
+        self.bearing = bearing
+        self.quality = quality
+
+
+class ObservationBudget:
+
+    def __init__(self,
+                 max_observations: int = 20,
+                 baseline_weight: float = 1.0,
+                 image_size: Optional[Tuple[float, float]] = None,
+                 border: float = 5,
+                 truncated_quality: float = 0.5) -> None:
+        # image_size defaults to twice the principal point
+        if max_observations < 1:
+            raise ValueError("Observation budget must be positive.")
+        self.max_observations = max_observations
+        self.baseline_weight = baseline_weight
+        self.image_size = image_size
+        self.border = border
+        self.truncated_quality = truncated_quality
+        self.reset()
+
+    def reset(self) -> None:
+        self.observations: Dict[int, List[Observation]] = {}
+        self.added = 0
+        self.dropped = 0
+        self.replaced = 0
+
+    def report(self) -> Dict[str, int]:
+        # Counts of box factors added (including replacements), dropped
+        # outright, & removed by replacement
+        return {
+            'added': self.added,
+            'dropped': self.dropped,
+            'replaced': self.replaced
+        }
+
+    def _observation(self, state: QuadricSlamState, d: Detection,
+                     index: int) -> Observation:
+        s = state.system
+        n = state.this_step
+        assert s.calib_rgb is not None and n is not None
+        fx, fy, skew, u0, v0 = s.calib_rgb
+        w, h = ((2 * u0, 2 * v0)
+                if self.image_size is None else self.image_size)
+        x0, y0, x1, y1 = d.bounds
+
+        u, v = (x0 + x1) / 2, (y0 + y1) / 2
+        T = np.asarray(n.odom)
+        b = T[:3, :3] @ np.array([(u - u0 - skew * (v - v0) / fy) / fx,
+                                  (v - v0) / fy, 1])
+        truncated = (x0 < self.border or y0 < self.border or
+                     x1 > w - self.border or y1 > h - self.border)
+        return Observation(index, d.pose_key, T[:3, 3].copy(),
+                           b / np.linalg.norm(b),
+                           self.truncated_quality if truncated else 1.0)
+
+    def admit(self, state: QuadricSlamState, d: Detection,
+              index: int) -> Tuple[bool, Optional[int]]:
+        # Decides whether the detection gets a box factor (which will have
+        # index in the graph), and the index of the factor it replaces (if
+        # any)
+        s = state.system
+        kept = self.observations.setdefault(d.quadric_key, [])
+        if s.lag is not None:
+            kept[:] = [
+                o for o in kept
+                if o.pose_key in s.stamps or o.pose_key == d.pose_key
+            ]
+        o = self._observation(state, d, index)
+        if len(kept) < self.max_observations:
+            kept.append(o)
+            self.added += 1
+            return True, None
+        elif s.lag is not None:
+            self.dropped += 1
+            return False, None
+
+        # Score everything as if the new observation were kept too
+        xs = kept + [o]
+        bs = np.array([x.bearing for x in xs])
+        cs = np.array([x.centre for x in xs])
+        ds = (np.arccos(np.clip(bs @ bs.T, -1, 1)) + self.baseline_weight *
+              np.linalg.norm(cs[:, np.newaxis] - cs[np.newaxis], axis=2))
+        np.fill_diagonal(ds, np.inf)
+        scores = ds.min(axis=1) * np.array([x.quality for x in xs])
+
+        # Observations from this pose may still be waiting to go to the
+        # optimiser, so they can't be replaced
+        scores[:-1][[x.pose_key == o.pose_key for x in kept]] = np.inf
+        i = int(np.argmin(scores[:-1]))
+        if scores[-1] <= scores[i]:
+            self.dropped += 1
+            return False, None
+        replaced = kept[i].index
+        kept[i] = o
+        self.added += 1
+        self.replaced += 1
+        return True, replaced
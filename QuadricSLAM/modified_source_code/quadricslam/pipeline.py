@@ -0,0 +1,164 @@
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+import queue
+import threading
+import time
+
+# Runs a chain of stages concurrently, each on its own thread, connected by
+# bounded queues. The first stage is an iterator producing items, and every
+# later stage is a function applied to each item from the stage before it.
+# Items come out of run() in the order the source produced them, and a full
+# queue blocks the stage feeding it (so no stage runs more than `depth` items
+# ahead of the next).
+#
+# An exception in any stage is re-raised from run() once the items before it
+# have come out.
+
+_DONE = object()
+
+
+class _Failure:
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+class StageStats:
+    # Work done by a stage, & occupancy of the queue it feeds (sampled each
+    # time an item is taken from it)
+
+    def __init__(self, name: str, depth: int) -> None:
+        self.name = name
+        self.depth = depth
+        self.items = 0
+        self.busy = 0.0
+        self.max_occupancy = 0
+        self._occupancy_sum = 0
+        self._samples = 0
+
+    def sample(self, occupancy: int) -> None:
+        self.max_occupancy = max(self.max_occupancy, occupancy)
+        self._occupancy_sum += occupancy
+        self._samples += 1
+
+    def mean_occupancy(self) -> float:
+        return self._occupancy_sum / max(1, self._samples)
+
+    def report(self) -> Dict[str, float]:
+        return {
+            'items': self.items,
+            'busy': self.busy,
+            'depth': self.depth,
+            'max_occupancy': self.max_occupancy,
+            'mean_occupancy': self.mean_occupancy()
+        }
+
+
+class Pipeline:
+
+    def __init__(self,
+                 source: Tuple[str, Iterator[Any]],
+                 stages: Sequence[Tuple[str, Callable[[Any], Any]]] = (),
+                 depth: int = 2) -> None:
+        if depth < 1:
+            raise ValueError("Queue depth must be positive.")
+        self.source = source
+        self.stages = list(stages)
+        self.depth = depth
+
+        names = [source[0]] + [n for n, _ in self.stages]
+        self.stats = [StageStats(n, depth) for n in names]
+        self._queues: List[queue.Queue] = [
+            queue.Queue(maxsize=depth) for _ in names
+        ]
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def occupancy(self) -> Dict[str, int]:
+        # Items currently waiting in the queue after each stage
+        return {st.name: q.qsize() for st, q in zip(self.stats, self._queues)}
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        return {st.name: st.report() for st in self.stats}
+
+    def run(self) -> Iterator[Any]:
+        self._threads = [
+            threading.Thread(target=self._run_source, daemon=True)
+        ] + [
+            threading.Thread(target=self._run_stage, args=(i + 1, fn),
+                             daemon=True)
+            for i, (_, fn) in enumerate(self.stages)
+        ]
+        for t in self._threads:
+            t.start()
+        try:
+            while True:
+                x = self._get(len(self._queues) - 1)
+                if x is _DONE:
+                    return
+                elif isinstance(x, _Failure):
+                    raise x.error
+                yield x
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _get(self, i: int) -> Any:
+        # Blocks while the queue is empty, unless we're asked to stop
+        while not self._stop.is_set():
+            try:
+                occupancy = self._queues[i].qsize()
+                x = self._queues[i].get(timeout=0.1)
+                self.stats[i].sample(occupancy)
+                return x
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _put(self, i: int, x: Any) -> bool:
+        # Blocks while the queue is full, unless we're asked to stop
+        while not self._stop.is_set():
+            try:
+                self._queues[i].put(x, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run_source(self) -> None:
+        it = self.source[1]
+        while True:
+            t = time.perf_counter()
+            try:
+                x = next(it)
+            except StopIteration:
+                break
+            except BaseException as e:
+                self._put(0, _Failure(e))
+                return
+            self.stats[0].busy += time.perf_counter() - t
+            self.stats[0].items += 1
+            if not self._put(0, x):
+                return
+        self._put(0, _DONE)
+
+    def _run_stage(self, i: int, fn: Callable[[Any], Any]) -> None:
+        while True:
+            x = self._get(i - 1)
+            if x is _DONE or isinstance(x, _Failure):
+                self._put(i, x)
+                return
+            t = time.perf_counter()
+            try:
+                y = fn(x)
+            except BaseException as e:
+                self._put(i, _Failure(e))
+                return
+            self.stats[i].busy += time.perf_counter() - t
+            self.stats[i].items += 1
+            if not self._put(i, y):
+                return
@@ -0,0 +1,332 @@
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from contextlib import contextmanager
+import json
+import math
+import os
+import platform
+import sys
+import threading
+import time
+import numpy as np
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from scipy.stats import t as student_t
+except ImportError:
+    student_t = None
+
+# In-process resource profiler. A background thread samples the process' CPU
+# time & resident memory rate_hz times a second, tagging each sample with the
+# current phase (set by QuadricSlam as it moves between stages, or by the
+# caller). This replaces polling a subprocess with psutil once a second,
+# which missed short runs entirely, & counted interpreter start-up and
+# output writing as SLAM.
+#
+# CPU utilisation is reported as a percentage of the cores this process may
+# run on (so 100% is every available core busy). Time & CPU spent in each
+# phase are also accounted exactly at phase changes, rather than from the
+# samples.
+#
+# Each run produces one report (a JSON-serialisable dict), and
+# aggregate_reports() combines the reports of repeated runs into means with
+# confidence intervals.
+
+REPORT_VERSION = 1
+MB = 1024 * 1024
+
+
+def available_cores() -> int:
+    # Cores this process is allowed to run on (respects taskset / cgroups
+    # affinity where the platform exposes it)
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _rss() -> float:
+    # Current resident set size (bytes), or NaN if unavailable
+    if psutil is not None:
+        return float(psutil.Process().memory_info().rss)
+    try:
+        with open('/proc/self/statm') as f:
+            return float(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return math.nan
+
+
+def _peak_rss() -> float:
+    # Peak resident set size over the life of the process (bytes)
+    if resource is not None:
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # (kilobytes on Linux, bytes on macOS)
+        return float(r if sys.platform == 'darwin' else r * 1024)
+    if psutil is not None:
+        m = psutil.Process().memory_info()
+        return float(getattr(m, 'peak_wset', m.rss))
+    return math.nan
+
+
+def _stats(xs: np.ndarray) -> Dict[str, float]:
+    if len(xs) == 0:
+        return {k: math.nan for k in ('mean', 'min', 'max', 'p50', 'p90')}
+    return {
+        'mean': float(np.nanmean(xs)),
+        'min': float(np.nanmin(xs)),
+        'max': float(np.nanmax(xs)),
+        'p50': float(np.nanpercentile(xs, 50)),
+        'p90': float(np.nanpercentile(xs, 90))
+    }
+
+
+class ResourceProfiler:
+
+    def __init__(self,
+                 rate_hz: float = 50,
+                 label: Optional[str] = None,
+                 cores: Optional[int] = None) -> None:
+        # cores defaults to the cores available to this process
+        if not 1 <= rate_hz <= 1000:
+            raise ValueError("Sample rate must be between 1 and 1000 Hz.")
+        self.rate_hz = rate_hz
+        self.label = label
+        self.cores = available_cores() if cores is None else cores
+        self.meta: Dict[str, Any] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        # (wall, cpu, rss, phase) per sample
+        self.samples: List[Tuple[float, float, float, Optional[str]]] = []
+        self.phases: Dict[str, List[float]] = {}
+        self.current: Optional[str] = None
+        self._phase_since: Optional[Tuple[float, float]] = None
+        self.start_time: Optional[float] = None
+        self.stop_time: Optional[float] = None
+        self._cpu_start = 0.0
+        self._cpu_stop = 0.0
+
+    def __enter__(self) -> 'ResourceProfiler':
+        self.start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.stop()
+
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        # (keeps any phase set before starting)
+        if self.running():
+            return
+        current = self.current
+        self.reset()
+        self._stop.clear()
+        self.start_time = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self.set_phase(current)
+        self._sample()
+        self._thread = threading.Thread(target=self._run,
+                                        name='ResourceProfiler',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if not self.running():
+            return
+        self._stop.set()
+        assert self._thread is not None
+        self._thread.join()
+        self._thread = None
+        self._sample()
+        with self._lock:
+            self._close_phase()
+        self.stop_time = time.perf_counter()
+        self._cpu_stop = time.process_time()
+
+    def set_phase(self, name: Optional[str]) -> None:
+        # Tags everything from now on with phase 'name' (None for untagged)
+        with self._lock:
+            self._close_phase()
+            self.current = name
+            if self.start_time is not None and self.stop_time is None:
+                self._phase_since = (time.perf_counter(),
+                                     time.process_time())
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        # Tags a block with phase 'name', restoring the previous phase after
+        previous = self.current
+        self.set_phase(name)
+        try:
+            yield
+        finally:
+            self.set_phase(previous)
+
+    def _close_phase(self) -> None:
+        # Charges the time since the last phase change to the current phase
+        if self._phase_since is None:
+            return
+        if self.current is not None:
+            p = self.phases.setdefault(self.current, [0.0, 0.0, 0])
+            p[0] += time.perf_counter() - self._phase_since[0]
+            p[1] += time.process_time() - self._phase_since[1]
+            p[2] += 1
+        self._phase_since = None
+
+    def _sample(self) -> None:
+        self.samples.append((time.perf_counter(), time.process_time(),
+                             _rss(), self.current))
+
+    def _run(self) -> None:
+        # Samples on a fixed schedule (so slow samples don't drift the rate)
+        period = 1 / self.rate_hz
+        next_t = time.perf_counter() + period
+        while not self._stop.wait(max(0, next_t - time.perf_counter())):
+            self._sample()
+            next_t += period
+
+    def report(self) -> Dict[str, Any]:
+        # Summary of the run (profiling must have been stopped)
+        if self.start_time is None or self.stop_time is None:
+            raise RuntimeError("Profiler must be started and stopped "
+                               "before reporting.")
+        ss = self.samples
+        wall = np.array([s[0] for s in ss])
+        cpu = np.array([s[1] for s in ss])
+        rss = np.array([s[2] for s in ss]) / MB
+        tags = [s[3] for s in ss]
+
+        # Utilisation over each interval, tagged with the phase at its end
+        dt = np.diff(wall)
+        util = 100 * np.diff(cpu) / np.where(dt > 0, dt, np.nan) / self.cores
+        util_tags = tags[1:]
+
+        phases = {}
+        for name, (w, c, entries) in self.phases.items():
+            us = util[[t == name for t in util_tags]]
+            ms = rss[[t == name for t in tags]]
+            phases[name] = {
+                'wall': w,
+                'cpu_seconds': c,
+                'cpu_percent': 100 * c / w / self.cores if w > 0 else math.nan,
+                'entries': entries,
+                'samples': len(us),
+                'cpu_percent_samples': _stats(us),
+                'rss_mb': _stats(ms)
+            }
+
+        duration = self.stop_time - self.start_time
+        cpu_seconds = self._cpu_stop - self._cpu_start
+        return {
+            'version': REPORT_VERSION,
+            'label': self.label,
+            'meta': self.meta,
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'rate_hz': self.rate_hz,
+            'cores': self.cores,
+            'samples': len(ss),
+            'duration': duration,
+            'cpu_seconds': cpu_seconds,
+            'cpu_percent': (100 * cpu_seconds / duration / self.cores
+                            if duration > 0 else math.nan),
+            'cpu_percent_samples': _stats(util),
+            'rss_mb': _stats(rss),
+            'peak_rss_mb': _peak_rss() / MB,
+            'phases': phases
+        }
+
+    def to_json(self, path: str) -> Dict[str, Any]:
+        r = self.report()
+        with open(path, 'w') as f:
+            json.dump(r, f, indent=2)
+        return r
+
+
+def _leaves(d: Dict[str, Any],
+            prefix: str = '') -> Iterator[Tuple[str, float]]:
+    # Numeric values of a nested report, keyed by dotted path
+    for k, v in d.items():
+        if isinstance(v, dict):
+            yield from _leaves(v, prefix + k + '.')
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            yield prefix + k, float(v)
+
+
+def _t(confidence: float, dof: int) -> float:
+    # Two-sided Student's t critical value (normal approximation without
+    # scipy)
+    if student_t is not None:
+        return float(student_t.ppf((1 + confidence) / 2, dof))
+    return {0.9: 1.645, 0.95: 1.96, 0.99: 2.576}.get(confidence, 1.96)
+
+
+def aggregate_reports(reports: Sequence[Dict[str, Any]],
+                      confidence: float = 0.95) -> Dict[str, Dict[str, float]]:
+    # Mean, standard deviation, & confidence interval of every numeric value
+    # across the reports of repeated runs (metadata like the sample rate is
+    # included too, which is an easy way to spot mismatched runs)
+    if not reports:
+        raise ValueError("No reports to aggregate.")
+    values: Dict[str, List[float]] = {}
+    for r in reports:
+        for k, v in _leaves({
+                k: v
+                for k, v in r.items()
+                if k not in ('version', 'meta')
+        }):
+            values.setdefault(k, []).append(v)
+
+    out = {}
+    for k, vs in values.items():
+        xs = np.array([v for v in vs if not math.isnan(v)])
+        n = len(xs)
+        mean = float(xs.mean()) if n else math.nan
+        sd = float(xs.std(ddof=1)) if n > 1 else math.nan
+        h = _t(confidence, n - 1) * sd / math.sqrt(n) if n > 1 else math.nan
+        out[k] = {
+            'runs': n,
+            'mean': mean,
+            'sd': sd,
+            'ci_low': mean - h,
+            'ci_high': mean + h
+        }
+    return out
+
+
+def load_reports(paths: Sequence[str]) -> List[Dict[str, Any]]:
+    reports = []
+    for p in paths:
+        with open(p) as f:
+            reports.append(json.load(f))
+    return reports
+
+
+def format_aggregate(aggregate: Dict[str, Dict[str, float]],
+                     keys: Optional[Sequence[str]] = None) -> str:
+    keys = (keys if keys is not None else [
+        k for k in aggregate
+        if k in ('duration', 'cpu_seconds', 'cpu_percent', 'rss_mb.mean',
+                 'rss_mb.max', 'peak_rss_mb') or
+        (k.startswith('phases.') and
+         k.endswith(('.wall', '.cpu_percent')))
+    ])
+    lines = ['%-32s%6s%14s%14s%24s' % ('metric', 'runs', 'mean', 'sd', 'ci')]
+    for k in keys:
+        a = aggregate[k]
+        lines.append('%-32s%6d%14.3f%14.3f%24s' %
+                     (k, a['runs'], a['mean'], a['sd'],
+                      '[%.3f, %.3f]' % (a['ci_low'], a['ci_high'])))
+    return '\n'.join(lines)
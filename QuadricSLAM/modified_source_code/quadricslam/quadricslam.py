@@ -1,6 +1,7 @@
-from itertools import groupby
 from types import FunctionType
-from typing import Callable, Dict, List, Optional, Union
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+import copy
+import time
 
 import gtsam
 import gtsam_quadrics
@@ -10,18 +11,30 @@ from spatialmath import SE3
 from .data_associator import DataAssociator
 from .data_source import DataSource
 from .detector import Detector
-from .quadricslam_states import QuadricSlamState, StepState, SystemState
+from .checkpoint import Checkpointer, restore_checkpoint
+from .instrumentation import Instrumentation
+from .profiler import ResourceProfiler
+from .keyframe_policy import KeyframePolicy
+from .observation_budget import ObservationBudget
+from .pipeline import Pipeline
+from .refinement import QuadricRefiner
+from .quadricslam_states import (DetectionStore,
+                                 FixedLagSmootherKeyTimestampMap,
+                                 QuadricSlamState, StepState, SystemState)
 from .utils import (
     QuadricInitialiser,
     initialise_quadric_ray_intersection,
-    new_factors,
-    new_values,
     ps_and_qs_from_values,
 )
 from .visual_odometry import VisualOdometry
 import matplotlib.pyplot as plt
 
 
+# Standard deviation of the prior on a quadric that rejoins the fixed-lag
+# window, if its marginal covariance couldn't be computed when it left
+MARGINAL_SIGMA = 0.1
+
+
 class QuadricSlam:
 
     def __init__(
@@ -30,6 +43,8 @@ class QuadricSlam:
         visual_odometry: Optional[VisualOdometry] = None,
         detector: Optional[Detector] = None,
         associator: Optional[DataAssociator] = None,
+        keyframe_policy: Optional[KeyframePolicy] = None,
+        observation_budget: Optional[ObservationBudget] = None,
         initial_pose: Optional[SE3] = None,
         noise_prior: np.ndarray = np.array([0] * 6, dtype=np.float64),
         noise_odom: np.ndarray = np.array([0.01] * 6, dtype=np.float64),
@@ -40,7 +55,14 @@ class QuadricSlam:
                                          gtsam.GaussNewtonParams]] = None,
         on_new_estimate: Optional[Callable[[QuadricSlamState], None]] = None,
         quadric_initialiser:
-        QuadricInitialiser = initialise_quadric_ray_intersection
+        QuadricInitialiser = initialise_quadric_ray_intersection,
+        optimiser_lag: Optional[float] = None,
+        optimiser_lag_unit: str = 'frames',
+        refiner: Optional[QuadricRefiner] = None,
+        mapping_only: bool = False,
+        instrumentation: Optional[Instrumentation] = None,
+        profiler: Optional[ResourceProfiler] = None,
+        checkpointer: Optional[Checkpointer] = None
     ) -> None:
         # TODO this needs a default data associator, we can't do anything
         # meaningful if this is None...
@@ -51,10 +73,38 @@ class QuadricSlam:
         self.data_source = data_source
         self.detector = detector
         self.visual_odometry = visual_odometry
+        self.keyframe_policy = keyframe_policy
+        self.observation_budget = observation_budget
+
+        # Mapping-only mode trusts odometry, so the trajectory is never
+        # optimised & quadrics are only refined against it (in batch)
+        if mapping_only and optimiser_batch is False:
+            raise ValueError("ERROR: Mapping-only mode runs in batch.")
+        self.mapping_only = mapping_only
+        self.refiner = (QuadricRefiner()
+                        if mapping_only and refiner is None else refiner)
+        if mapping_only:
+            optimiser_batch = True
 
         self.on_new_estimate = on_new_estimate
+        self.pipeline: Optional[Pipeline] = None
+        self.instrumentation = instrumentation
+        # (the profiler is only tagged with the phase we're in, starting &
+        # stopping it is up to the caller)
+        self.profiler = profiler
+        self.checkpointer = checkpointer
         self.quadric_initialiser = quadric_initialiser
 
+        # Let the data source know which images will actually be used (images
+        # are loaded lazily regardless, so undeclared use still works)
+        self.modalities = frozenset().union(*[
+            getattr(c, 'modalities', frozenset()) for c in [
+                detector, visual_odometry, associator, keyframe_policy,
+                quadric_initialiser
+            ] if c is not None
+        ])
+        self.data_source.require(self.modalities)
+
         # Bail if optimiser settings and modes aren't compatible
         if (optimiser_batch == True and
                 type(optimiser_params) == gtsam.ISAM2Params):
@@ -78,9 +128,173 @@ class QuadricSlam:
                 noise_odom=noise_odom,
                 noise_boxes=noise_boxes,
                 optimiser_batch=type(optimiser_params) != gtsam.ISAM2Params,
-                optimiser_params=optimiser_params))
+                optimiser_params=optimiser_params,
+                optimiser_lag=optimiser_lag,
+                optimiser_lag_unit=optimiser_lag_unit))
         self.reset()
 
+    def _now(self) -> Optional[Tuple[float, float]]:
+        # Start of a timed stage (None if we're not instrumented)
+        return None if self.instrumentation is None else Instrumentation.now()
+
+    def _timed(self, i: Optional[int], stage: str,
+               since: Optional[Tuple[float, float]]) -> None:
+        if self.instrumentation is not None and since is not None:
+            self.instrumentation.add(i, stage, since)
+
+    def _phase(self, name: Optional[str]) -> None:
+        if self.profiler is not None:
+            self.profiler.set_phase(name)
+
+    def _count(self, i: Optional[int], counter: str, value: float) -> None:
+        if self.instrumentation is not None:
+            self.instrumentation.count(i, counter, value)
+
+    def _finish(self, n: StepState) -> None:
+        if self.instrumentation is None:
+            return
+        s = self.state.system
+        self._count(n.i, 'detections', len(n.detections))
+        self._count(n.i, 'associated', len(n.new_associated))
+        self._count(n.i, 'factors', s.graph.size())
+        self._count(n.i, 'values', s.estimates.size())
+        self.instrumentation.finish(n.i)
+
+    def add_factor(self, factor: gtsam.NonlinearFactor) -> Optional[int]:
+        # All factors must come through here so incremental mode can hand
+        # exactly the new ones to the optimiser. Returns the factor's index in
+        # the graph, which is also its index in iSAM2 (which appends factors
+        # in the order they're given, unless params.findUnusedFactorSlots).
+        # Returns None in fixed-lag mode, where there's no graph to index
+        # (& factors can't be removed).
+        s = self.state.system
+        if s.lag is None:
+            # (the full graph isn't kept in fixed-lag mode, so memory stays
+            # flat)
+            s.graph.add(factor)
+        if not s.optimiser_batch:
+            s.pending_factors.add(factor)
+
+        # Quadrics seen again after leaving the fixed-lag window rejoin it
+        if (s.lag is not None and
+                type(factor) == gtsam_quadrics.BoundingBoxFactor and
+                factor.objectKey() in s.marginals):
+            self._revive_quadric(factor.objectKey())
+
+        self._index_initial(factor)
+        return None if s.lag is not None else s.graph.size() - 1
+
+    def _index_initial(self, factor: gtsam.NonlinearFactor) -> None:
+        # Index anything that will need an initial estimate
+        s = self.state.system
+        if (type(factor) == gtsam.PriorFactorPose3 and
+                not s.estimates.exists(factor.keys()[0])):
+            s.init_priors.append(factor)
+        elif (type(factor) == gtsam.BetweenFactorPose3 and
+              not s.estimates.exists(factor.keys()[1])):
+            s.init_betweens.setdefault(factor.keys()[0], []).append(factor)
+        elif (type(factor) == gtsam_quadrics.BoundingBoxFactor and
+              not s.estimates.exists(factor.objectKey())):
+            s.init_boxes.setdefault(factor.objectKey(), []).append(factor)
+
+    def remove_factor(self, index: int) -> None:
+        # Removes a factor that has already been handed to the optimiser (not
+        # supported in fixed-lag mode)
+        s = self.state.system
+        assert s.lag is None
+        factor = s.graph.at(index)
+        if type(factor) == gtsam_quadrics.BoundingBoxFactor:
+            # Removed boxes mustn't be used to initialise their quadric
+            # (which may not have been initialised yet in batch mode)
+            fs = s.init_boxes.get(factor.objectKey(), [])
+            i = next((i for i, f in enumerate(fs)
+                      if f.poseKey() == factor.poseKey() and np.array_equal(
+                          f.measurement().vector(),
+                          factor.measurement().vector())), None)
+            if i is not None:
+                del fs[i]
+                if not fs:
+                    del s.init_boxes[factor.objectKey()]
+        s.graph.remove(index)
+        s.removed_factors.append(index)
+        if not s.optimiser_batch:
+            s.pending_removals.append(index)
+
+    def add_estimate(
+        self, key: int, value: Union[gtsam.Pose3,
+                                     gtsam_quadrics.ConstrainedDualQuadric]
+    ) -> None:
+        s = self.state.system
+        for vs in ([s.estimates] if s.optimiser_batch else
+                   [s.estimates, s.pending_values]):
+            if type(value) == gtsam_quadrics.ConstrainedDualQuadric:
+                value.addToValues(vs, key)
+            else:
+                vs.insert(key, value)
+
+    def _revive_quadric(self, key: int) -> None:
+        # Re-adds a marginalised quadric to the fixed-lag smoother at its last
+        # estimate, with a prior standing in for everything marginalised
+        s = self.state.system
+        cov = s.marginals.pop(key)
+        q = gtsam_quadrics.ConstrainedDualQuadric.getFromValues(
+            s.estimates, key)
+        q.addToValues(s.pending_values, key)
+        self.add_factor(
+            gtsam_quadrics.PriorFactorConstrainedDualQuadric(
+                key, q,
+                gtsam.noiseModel.Isotropic.Sigma(9, MARGINAL_SIGMA)
+                if cov is None else gtsam.noiseModel.Gaussian.Covariance(cov)))
+
+    def _update_fixed_lag(self, n: StepState) -> None:
+        s = self.state.system
+        if s.optimiser is None:
+            s.optimiser = s.optimiser_type(s.lag, s.optimiser_params)
+
+        # Every key touched this step is stamped with the step's time, so only
+        # keys untouched within the lag are marginalised (mirroring the
+        # smoother, which marginalises keys older than the newest - lag)
+        ts = FixedLagSmootherKeyTimestampMap()
+        for k in set(s.pending_factors.keyVector()) | set(
+                s.pending_values.keys()):
+            ts.insert((k, n.stamp))
+            s.stamps[k] = n.stamp
+        ms = [k for k, t in s.stamps.items() if t < n.stamp - s.lag]
+
+        # Marginal covariances of departing quadrics have to be taken while
+        # they're still in the smoother
+        qs = [k for k in ms if self.state.keys.lookup(k)[0] == 'q']
+        covs: Dict[int, Optional[np.ndarray]] = {k: None for k in qs}
+        if qs:
+            try:
+                isam = s.optimiser.getISAM2()
+                covs = {k: isam.marginalCovariance(k) for k in qs}
+            except RuntimeError:
+                pass
+
+        try:
+            s.optimiser.update(s.pending_factors, s.pending_values, ts)
+        except RuntimeError:
+            # See the iSAM2 case in step() (keys are only marginalised after
+            # a successful update)
+            return
+        for k in ms:
+            del s.stamps[k]
+        s.marginals.update(covs)
+
+        # Estimates outside the window are kept, so the window's estimates
+        # are merged over the top
+        es = s.optimiser.calculateEstimate()
+        for k in es.keys():
+            if s.estimates.exists(k):
+                s.estimates.erase(k)
+            if self.state.keys.lookup(k)[0] == 'q':
+                gtsam_quadrics.ConstrainedDualQuadric.getFromValues(
+                    es, k).addToValues(s.estimates, k)
+            else:
+                s.estimates.insert(k, es.atPose3(k))
+        self.state.keys.invalidate(es.keys())
+
     # the same function is used in both optimising by batch and incrementatl optimisation.
     # so in batch optimisation, the s.estimates is empty till the end and then only all the 
     # values from the factor graph are dumped into the initial estimate and optimised on that
@@ -96,65 +310,120 @@ class QuadricSlam:
         # - guess quadrics using Euclidean mean of all observations
         s = self.state.system
 
-        fs = [s.graph.at(i) for i in range(0, s.graph.nrFactors())]
-
         # Start with prior factors
-        for pf in [
-                f for f in fs if type(f) == gtsam.PriorFactorPose3 and
-                not s.estimates.exists(f.keys()[0])
-        ]:
-            s.estimates.insert(pf.keys()[0], pf.prior())
-
-        # Add all between factors one-by-one (should never be any remaining,
-        # but if they are just dump them at the origin after the main loop)
-        bfs = [f for f in fs if type(f) == gtsam.BetweenFactorPose3]
-        done = False
-        while not done:
-            bf = next((f for f in bfs if s.estimates.exists(f.keys()[0]) and
-                       not s.estimates.exists(f.keys()[1])), None)
-            if bf is None:
-                done = True
-                continue
-            s.estimates.insert(
-                bf.keys()[1],
-                s.estimates.atPose3(bf.keys()[0]) * bf.measured())
-            bfs.remove(bf)
-        for bf in [
-                f for f in bfs if not all([
-                    s.estimates.exists(f.keys()[i])
-                    for i in range(0, len(f.keys()))
-                ])
-        ]:
-            s.estimates.insert(bf.keys()[1], gtsam.Pose3())
-
-        # Add all quadric factors
-        _ok = lambda x: x.objectKey()
-        bbs = sorted([
-            f for f in fs if type(f) == gtsam_quadrics.BoundingBoxFactor and
-            not s.estimates.exists(f.objectKey())
-        ],
-                     key=_ok)
-        for qbbs in [list(v) for k, v in groupby(bbs, _ok)]:
-            self.quadric_initialiser(
-                [s.estimates.atPose3(bb.poseKey()) for bb in qbbs],
-                [bb.measurement() for bb in qbbs],
-                self.state).addToValues(s.estimates, qbbs[0].objectKey())
-
-    def spin(self) -> None:
-        while not self.data_source.done():
-            self.step()
-
-        if self.state.system.optimiser_batch:
-            self.guess_initial_values()
-            s = self.state.system
-            s.optimiser = s.optimiser_type(s.graph, s.estimates,
-                                           s.optimiser_params)
-            s.estimates = s.optimiser.optimize()
-
-            if self.on_new_estimate:
-                self.on_new_estimate(self.state)
+        for pf in s.init_priors:
+            if not s.estimates.exists(pf.keys()[0]):
+                self.add_estimate(pf.keys()[0], pf.prior())
+        s.init_priors = []
+
+        # Dead reckon along between factors, starting from every pose that
+        # has an estimate and is waiting on an outgoing factor
+        ks = [k for k in s.init_betweens.keys() if s.estimates.exists(k)]
+        while ks:
+            k = ks.pop()
+            for bf in s.init_betweens.pop(k, []):
+                if not s.estimates.exists(bf.keys()[1]):
+                    self.add_estimate(
+                        bf.keys()[1],
+                        s.estimates.atPose3(k) * bf.measured())
+                    ks.append(bf.keys()[1])
+
+        # There should never be any remaining, but if there are just dump them
+        # at the origin
+        for bfs in s.init_betweens.values():
+            for bf in bfs:
+                if not s.estimates.exists(bf.keys()[1]):
+                    self.add_estimate(bf.keys()[1], gtsam.Pose3())
+        s.init_betweens = {}
+
+        # Add all quadrics that are waiting on an initial estimate (all at
+        # once if the initialiser has a batched version)
+        batch = getattr(self.quadric_initialiser, 'batch', None)
+        ks = [k for k in sorted(s.init_boxes.keys())
+              if not s.estimates.exists(k)]
+        if batch is not None and ks:
+            qbbs = [bb for k in ks for bb in s.init_boxes[k]]
+            cs, rs, radii = batch(
+                np.array([s.estimates.atPose3(bb.poseKey()).matrix()
+                          for bb in qbbs]),
+                np.array([bb.measurement().vector() for bb in qbbs]),
+                np.repeat(np.arange(len(ks)),
+                          [len(s.init_boxes[k]) for k in ks]), self.state)
+            for k, c, R, r in zip(ks, cs, rs, radii):
+                self.add_estimate(
+                    k,
+                    gtsam_quadrics.ConstrainedDualQuadric(
+                        gtsam.Pose3(gtsam.Rot3(R), gtsam.Point3(c)), r))
+        else:
+            for k in ks:
+                qbbs = s.init_boxes[k]
+                self.add_estimate(
+                    k,
+                    self.quadric_initialiser(
+                        [s.estimates.atPose3(bb.poseKey()) for bb in qbbs],
+                        [bb.measurement() for bb in qbbs], self.state))
+        s.init_boxes = {}
+
+    def spin(self, pipelined: bool = False, depth: int = 2) -> None:
+        # Pipelined mode loads & perceives (visual odometry & detection)
+        # upcoming steps on background threads while the current step is
+        # being associated & optimised, with up to `depth` steps waiting
+        # between each stage. Results are identical to stepping in turn.
+        if pipelined:
+            # (stages overlap, so the profiler can't tell them apart)
+            self._phase('steps')
+            self._spin_pipelined(depth)
+        else:
+            while not self.data_source.done():
+                self.step()
 
-        #pos, quad = ps_and_qs_from_values(self.state.system.estimates)
+        s = self.state.system
+        if s.optimiser_batch:
+            self._phase('initialise')
+            t = self._now()
+            # (init_boxes can also hold quadrics that already have an
+            # estimate, which aren't initialised again; only counted
+            # when instrumented, as counting visits every entry)
+            if self.instrumentation is not None:
+                self._count(
+                    None, 'new_quadrics',
+                    sum(not s.estimates.exists(k)
+                        for k in s.init_boxes))
+            self.guess_initial_values()
+            self._timed(None, 'initialise', t)
+            if not self.mapping_only:
+                self._phase('optimise')
+                t = self._now()
+                s.optimiser = s.optimiser_type(s.graph, s.estimates,
+                                               s.optimiser_params)
+                s.estimates = s.optimiser.optimize()
+                self.state.keys.touch()
+                self._timed(None, 'optimise', t)
+
+        # Quadrics are refined separately with the trajectory held fixed
+        # (which in mapping-only mode is the trajectory from odometry)
+        if self.refiner is not None:
+            self._phase('refine')
+            t = self._now()
+            self._count(None, 'refined', self.refiner.refine(self.state))
+            self._timed(None, 'refine', t)
+        self._phase(None)
+
+        if (s.optimiser_batch or
+                self.refiner is not None) and self.on_new_estimate:
+            self.on_new_estimate(self.state)
+
+        if self.checkpointer is not None:
+            self.checkpointer.flush()
+
+        if self.instrumentation is not None:
+            self._count(None, 'factors', s.graph.size())
+            self._count(None, 'values', s.estimates.size())
+            if self.instrumentation.summary:
+                print(self.instrumentation.format_summary())
+
+        #pos, quad = ps_and_qs_from_values(self.state.system.estimates,
+        #                                  self.state.keys)
         # data to be recorded. pos, quad, labels
         # print(self.state.this_step.i)
         # # data to be recorded. pos, quad, labels
@@ -163,19 +432,68 @@ class QuadricSlam:
         #print(self.state.system.labels) # to get the label for the quadric id
         #input("wait")
 
-    def step(self) -> None:
-        # Setup state for the current step
-        s = self.state.system
-        p = self.state.prev_step
-        n = StepState(
-            0 if self.state.prev_step is None else self.state.prev_step.i + 1)
-        self.state.this_step = n
+    def _spin_pipelined(self, depth: int) -> None:
+
+        def load() -> Iterator[StepState]:
+            prev = self.state.prev_step
+            while not self.data_source.done():
+                n = self._new_step(prev)
+                self._load(self._stage_state(n, prev))
+                prev = n
+                yield n
+
+        prev = [self.state.prev_step]
 
+        def perceive(n: StepState) -> StepState:
+            self._perceive(self._stage_state(n, prev[0]))
+            prev[0] = n
+            return n
+
+        # (kept after spinning, for its stats)
+        self.pipeline = Pipeline(('load', load()), [('perceive', perceive)],
+                                 depth)
+        for n in self.pipeline.run():
+            self.state.this_step = n
+            self._update()
+
+    def step(self) -> None:
+        # Runs each stage of a step in turn (see spin() for running them
+        # concurrently)
+        self.state.this_step = self._new_step(self.state.prev_step)
+        self._phase('load')
+        self._load(self.state)
+        self._phase('perceive')
+        self._perceive(self.state)
+        self._phase('update')
+        self._update()
+
+    def _new_step(self, prev_step: Optional[StepState]) -> StepState:
+        # Setup state for the step after prev_step
+        n = StepState(0 if prev_step is None else prev_step.i + 1,
+                      self.state.keys)
+        if self.state.system.lag_unit == 'seconds':
+            n.stamp = time.monotonic() - self.state.system.start_time
+        return n
+
+    def _stage_state(self, this_step: StepState,
+                     prev_step: Optional[StepState]) -> QuadricSlamState:
+        # View of the state for a stage running ahead of the rest of the
+        # system (everything but the steps is shared)
+        state = copy.copy(self.state)
+        state.this_step = this_step
+        state.prev_step = prev_step
+        return state
+
+    def _load(self, state: QuadricSlamState) -> None:
         # 0 8646911284551352320
         # print(self.state.this_step.i, self.state.this_step.pose_key)
+        assert state.this_step is not None
+        n = state.this_step
 
         # Get latest data from the scene (odom, images, and detections)
-        n.odom, n.rgb, n.depth = (self.data_source.next(self.state))
+        t = self._now()
+        n.odom, n.rgb, n.depth = (self.data_source.next(state))
+        self._timed(n.i, 'load', t)
         # print("rgb", n.rgb)
         # print("rgb", n.rgb.shape)
         # print("depth", n.depth)
@@ -183,32 +501,65 @@ class QuadricSlam:
         # print("from gt", n.odom)
         # if self.state.this_step.i==2:
         #     raise("testing")
+
+    def _perceive(self, state: QuadricSlamState) -> None:
+        assert state.this_step is not None
+        n = state.this_step
         if self.visual_odometry is not None:
-            n.odom = self.visual_odometry.odom(self.state)
+            t = self._now()
+            n.odom = self.visual_odometry.odom(state)
+            self._timed(n.i, 'odometry', t)
             print("from visual", n.odom)
         # example is {tv, [358.126, 1.7884141, 587.1226, 154.95697], None, 8646911284551352386}
         # {label, bounds, quadric key, pose key} - posekey increments by 1 after each iteration
-        n.detections = (self.detector.detect(self.state)
+        t = self._now()
+        n.detections = (self.detector.detect(state)
                         if self.detector else [])
+        self._timed(n.i, 'detect', t)
+
+    def _update(self) -> None:
+        # Associates the current step's detections, & adds it to the graph
+        s = self.state.system
+        assert self.state.this_step is not None
+        n = self.state.this_step
         # print(n.detections[0].label, n.detections[0].bounds, n.detections[0].quadric_key, n.detections[0].pose_key)
         # if self.state.this_step.i==2:
         #     raise("testing")
         # print(n.detections[0].label, n.detections[0].bounds, n.detections[0].quadric_key, n.detections[0].pose_key)
-        n.new_associated, s.associated, s.unassociated = (
-            self.associator.associate(self.state))
 
-        # Extract some labels
+        # Frames that aren't keyframes never make it into the graph (their
+        # odometry is folded into the next keyframe's between factor)
+        t = self._now()
+        if (self.keyframe_policy is not None and
+                not self.keyframe_policy.is_keyframe(self.state)):
+            self._timed(n.i, 'keyframe', t)
+            self._advance(n)
+            self._checkpoint(n)
+            self._finish(n)
+            return
+        self._timed(n.i, 'keyframe', t)
+        k = self.state.prev_keyframe
+
+        t = self._now()
+        n.new_associated, associated, s.unassociated = (
+            self.associator.associate(self.state))
+        if associated is not s.associated:
+            # (rebuilding the store from a returned list would cost the
+            # whole history every step)
+            raise TypeError(
+                "'%s' must append new detections to state.system.associated "
+                "& return it." % type(self.associator).__name__)
+        self._timed(n.i, 'associate', t)
+
+        # Labels are kept up to date by the store as detections are added
         # TODO handle cases where different labels used for a single quadric???
-        # add the label along with the quadric number used for that.
-        s.labels = {
-            d.quadric_key: d.label
-            for d in s.associated
-            if d.quadric_key is not None
-        }
+        # (the label of its first detection is used)
+        s.labels = s.associated.labels
 
        
         # # Add new pose to the factor graph
-        if p is None:
+        t = self._now()
+        if k is None:
             #print(n.odom)
             #print(s.initial_pose)
             #print(s.labels)
@@ -223,7 +574,7 @@ class QuadricSlam:
             # s.initial_pose = gtsam.Pose3() # CASE 1 -> START AT ORIGIN
             s.initial_pose = gtsam.Pose3(gtsam.Rot3(n.odom[:3,:3]), gtsam.Point3(n.odom[:3, 3])) # CASE 1 -> START AT ACTUAL POSITION
             # print(s.initial_pose)
-            s.graph.add(
+            self.add_factor(
                 gtsam.PriorFactorPose3(n.pose_key, s.initial_pose,
                                        s.noise_prior))
         else:
@@ -247,7 +598,7 @@ class QuadricSlam:
             # print(n.odom)
             # print(np.dot(odometry_numpy, p.odom))
 
-            pose_1 = gtsam.Pose3(gtsam.Rot3(p.odom[:3,:3]), gtsam.Point3(p.odom[:3, 3]))
+            pose_1 = gtsam.Pose3(gtsam.Rot3(k.odom[:3,:3]), gtsam.Point3(k.odom[:3, 3]))
             pose_2 = gtsam.Pose3(gtsam.Rot3(n.odom[:3,:3]), gtsam.Point3(n.odom[:3, 3]))
             odometry = pose_1.between(pose_2) # CASE 2 -> n.odom = np.dot(p.odom, odometry)
 
@@ -260,11 +611,12 @@ class QuadricSlam:
             # print(n.odom)
             # print(np.dot(p.odom, odometry_numpy))
 
-            s.graph.add(
+            # (spanning every frame since the last keyframe)
+            self.add_factor(
                 gtsam.BetweenFactorPose3(
-                    p.pose_key, n.pose_key,
+                    k.pose_key, n.pose_key,
                     gtsam.Pose3(odometry),
-                    s.noise_odom))
+                    s.odometry_noise(n.i - k.i)))
 
         # Add any newly associated detections to the factor graph
         for d in n.new_associated:
@@ -272,47 +624,126 @@ class QuadricSlam:
                 print("WARN: skipping associated detection with "
                       "quadric_key == None")
                 continue
-            s.graph.add(
+            if self.observation_budget is not None:
+                keep, replaced = self.observation_budget.admit(
+                    self.state, d, s.graph.size())
+                if not keep:
+                    continue
+                elif replaced is not None:
+                    self.remove_factor(replaced)
+            self.add_factor(
                 gtsam_quadrics.BoundingBoxFactor(
                     gtsam_quadrics.AlignedBox2(d.bounds),
                     gtsam.Cal3_S2(s.calib_rgb), d.pose_key, d.quadric_key,
                     s.noise_boxes))
+        self._timed(n.i, 'graph', t)
 
         # Optimise if we're in iterative mode
         if not s.optimiser_batch:
+            t = self._now()
+            # (init_boxes can also hold quadrics that already have an
+            # estimate, which aren't initialised again; only counted
+            # when instrumented, as counting visits every entry)
+            if self.instrumentation is not None:
+                self._count(
+                    n.i, 'new_quadrics',
+                    sum(not s.estimates.exists(k)
+                        for k in s.init_boxes))
             self.guess_initial_values()
-            if s.optimiser is None:
-                s.optimiser = s.optimiser_type(s.optimiser_params)
-            try:
-                # pu.db
-                s.optimiser.update(
-                    new_factors(s.graph, s.optimiser.getFactorsUnsafe()),
-                    new_values(s.estimates,
-                               s.optimiser.getLinearizationPoint()))
-                s.estimates = s.optimiser.calculateEstimate()
-            except RuntimeError as e:
-                # For handling gtsam::InderminantLinearSystemException:
-                #   https://gtsam.org/doxygen/a03816.html
-                pass
+            self._timed(n.i, 'initialise', t)
+
+            t = self._now()
+            if s.lag is not None:
+                self._update_fixed_lag(n)
+            else:
+                if s.optimiser is None:
+                    s.optimiser = s.optimiser_type(s.optimiser_params)
+                try:
+                    # pu.db
+                    if s.pending_removals:
+                        r = s.optimiser.update(
+                            s.pending_factors, s.pending_values,
+                            gtsam.KeyVector(s.pending_removals))
+                    else:
+                        r = s.optimiser.update(s.pending_factors,
+                                               s.pending_values)
+                    self._count(n.i, 'relinearised',
+                                r.getVariablesRelinearized())
+                    s.estimates = s.optimiser.calculateEstimate()
+                    # (only the spheres of quadrics in this step's delta are
+                    # refreshed in the spatial index)
+                    self.state.keys.touch(
+                        list(s.pending_factors.keyVector()) +
+                        list(s.pending_values.keys()))
+                except RuntimeError as e:
+                    # For handling gtsam::InderminantLinearSystemException:
+                    #   https://gtsam.org/doxygen/a03816.html
+                    pass
+            # iSAM2 adds new factors & values before it eliminates, so the
+            # delta is consumed even if the update above threw (the old
+            # graph diffing silently skipped them on the next step too)
+            s.pending_factors = gtsam.NonlinearFactorGraph()
+            s.pending_values = gtsam.Values()
+            s.pending_removals = []
+            self._timed(n.i, 'optimise', t)
             if self.on_new_estimate:
                 self.on_new_estimate(self.state)
 
+        self._advance(n)
+        self.state.prev_keyframe = n
+        self._checkpoint(n)
+        self._finish(n)
+
+    def _advance(self, n: StepState) -> None:
+        # Makes n the previous step, so the step before it is no longer
+        # needed (its caches are freed, keeping memory bounded)
+        prev = self.state.prev_step
         self.state.prev_step = n
+        if prev is not None and prev is not n:
+            prev.release()
+
+    def _checkpoint(self, n: StepState) -> None:
+        # (the checkpoint is written in the background)
+        if self.checkpointer is not None and self.checkpointer.due(n):
+            t = self._now()
+            self.checkpointer.save(self)
+            self._timed(n.i, 'checkpoint', t)
+
+    def restore(self, path: str) -> None:
+        # Restores the state saved in a checkpoint (see checkpoint.py), after
+        # which spin() carries on from the frame after it
+        restore_checkpoint(self, path)
 
     def reset(self) -> None:
         self.data_source.restart()
 
         s = self.state.system
-        s.associated = []
+        s.associated = DetectionStore()
         s.unassociated = []
-        s.labels = {}
+        s.labels = s.associated.labels
         s.graph = gtsam.NonlinearFactorGraph()
         s.estimates = gtsam.Values()
-        s.optimiser = (None if s.optimiser_batch else s.optimiser_type(
-            s.optimiser_params))
+        s.pending_factors = gtsam.NonlinearFactorGraph()
+        s.pending_values = gtsam.Values()
+        s.pending_removals = []
+        s.removed_factors = []
+        s.init_priors = []
+        s.init_betweens = {}
+        s.init_boxes = {}
+        if self.observation_budget is not None:
+            self.observation_budget.reset()
+        if self.instrumentation is not None:
+            self.instrumentation.reset()
+        s.optimiser = (None if s.optimiser_batch or s.lag is not None else
+                       s.optimiser_type(s.optimiser_params))
+        s.stamps = {}
+        s.marginals = {}
+        s.start_time = time.monotonic()
 
         s.calib_depth = self.data_source.calib_depth()
         s.calib_rgb = self.data_source.calib_rgb()
 
+        self.state.keys.invalidate()
         self.state.prev_step = None
+        self.state.prev_keyframe = None
         self.state.this_step = None
@@ -1,8 +1,34 @@
+from array import array
 from spatialmath import SE3
-from typing import Dict, List, Optional, Union
+from typing import (Callable, Dict, Iterable, Iterator, List, Optional, Set,
+                    Tuple, Union)
 import gtsam
+import gtsam_quadrics
 import numpy as np
 
+from .depth_integral import DepthIntegral
+from .spatial_index import QuadricSpatialIndex
+
+# The fixed-lag smoother lives in gtsam_unstable for older gtsam versions
+try:
+    from gtsam import (FixedLagSmootherKeyTimestampMap,
+                       IncrementalFixedLagSmoother)
+except ImportError:
+    try:
+        from gtsam_unstable import (FixedLagSmootherKeyTimestampMap,
+                                    IncrementalFixedLagSmoother)
+    except ImportError:
+        FixedLagSmootherKeyTimestampMap = None
+        IncrementalFixedLagSmoother = None
+
+LAG_UNITS = ('frames', 'seconds')
+
+# Images can be deferred by providing a callable that loads them, which is only
+# called if (and when) the image is first accessed
+ImageLoader = Callable[[], Optional[np.ndarray]]
+
+MODALITIES = ('rgb', 'depth')
+
 
 def qi(i: int) -> int:
     return int(gtsam.symbol('q', i))
@@ -12,6 +38,180 @@ def xi(i: int) -> int:
     return int(gtsam.symbol('x', i))
 
 
+class KeyRegistry:
+    # Records the type ('x' for poses, 'q' for quadrics) and index of each key
+    # as it is allocated, so keys never have to be parsed back out of a
+    # gtsam.Symbol. Also serves typed views of a Values object, which are
+    # cached until the values change, and a spatial index of the quadrics,
+    # which is maintained across values (see touch()).
+
+    # gtsam.Symbol stores its character in the top 8 bits of the key
+    _INDEX_BITS = 56
+
+    def __init__(self, spatial_tolerance: float = 0.1) -> None:
+        self.keys: Dict[int, Tuple[str, int]] = {}
+        self.spatial_tolerance = spatial_tolerance
+        self._spatial_index: Optional[QuadricSpatialIndex] = None
+        self._spatial_keys: List[int] = []
+        self._spatial_rows: Dict[int, int] = {}
+        self.invalidate()
+
+    def _allocate(self, c: str, i: int) -> int:
+        k = int(gtsam.symbol(c, i))
+        self.keys[k] = (c, i)
+        return k
+
+    def qi(self, i: int) -> int:
+        return self._allocate('q', i)
+
+    def xi(self, i: int) -> int:
+        return self._allocate('x', i)
+
+    def lookup(self, key: int) -> Tuple[str, int]:
+        # Keys we didn't allocate (e.g. from hand built graphs) are decoded
+        # straight from the Symbol bit layout once, then remembered
+        r = self.keys.get(key)
+        if r is None:
+            r = (chr(key >> KeyRegistry._INDEX_BITS),
+                 key & ((1 << KeyRegistry._INDEX_BITS) - 1))
+            self.keys[key] = r
+        return r
+
+    def invalidate(self, quadrics: Optional[Iterable[int]] = None) -> None:
+        # Must be called if values are changed in place without changing
+        # their size (swapping in a new Values object is detected for free).
+        # Quadrics whose estimates changed are passed on to touch().
+        self._clear_view()
+        self.touch(quadrics)
+
+    def touch(self, quadrics: Optional[Iterable[int]] = None) -> None:
+        # Marks the quadrics whose estimates have changed (all of them if
+        # None), so their bounding spheres are refreshed the next time the
+        # spatial index is used. The index outlives any one Values object,
+        # so this must also be called when new values are swapped in. Any
+        # keys that aren't quadrics are ignored.
+        if quadrics is None:
+            self._touched_all = True
+            self._touched: Set[int] = set()
+        else:
+            self._touched.update(quadrics)
+
+    def _clear_view(self) -> None:
+        self._values: Optional[gtsam.Values] = None
+        self._size = -1
+        self._typed: Dict[str, List[int]] = {}
+        self._positions: Optional[Dict[int, int]] = None
+        self._poses: Optional[Dict[int, gtsam.Pose3]] = None
+        self._quadrics: Optional[Dict[
+            int, gtsam_quadrics.ConstrainedDualQuadric]] = None
+        self._quadric_matrices: Optional[np.ndarray] = None
+        self._next_q: Optional[int] = None
+
+    def _view(self, values: gtsam.Values) -> Dict[str, List[int]]:
+        if values is not self._values or values.size() != self._size:
+            self._clear_view()
+            self._values = values
+            self._size = values.size()
+            self._typed = {'x': [], 'q': []}
+            for k in values.keys():
+                c = self.lookup(k)[0]
+                if c in self._typed:
+                    self._typed[c].append(k)
+        return self._typed
+
+    def pose_keys(self, values: gtsam.Values) -> List[int]:
+        return self._view(values)['x']
+
+    def quadric_keys(self, values: gtsam.Values) -> List[int]:
+        return self._view(values)['q']
+
+    def poses(self, values: gtsam.Values) -> Dict[int, gtsam.Pose3]:
+        # Returned dict is shared with the cache, so don't modify it
+        ks = self.pose_keys(values)
+        if self._poses is None:
+            self._poses = {k: values.atPose3(k) for k in ks}
+        return self._poses
+
+    def quadrics(
+        self, values: gtsam.Values
+    ) -> Dict[int, gtsam_quadrics.ConstrainedDualQuadric]:
+        # Returned dict is shared with the cache, so don't modify it
+        ks = self.quadric_keys(values)
+        if self._quadrics is None:
+            self._quadrics = {
+                k: gtsam_quadrics.ConstrainedDualQuadric.getFromValues(
+                    values, k) for k in ks
+            }
+        return self._quadrics
+
+    def quadric_matrices(self, values: gtsam.Values) -> np.ndarray:
+        # (M,4,4) stack of dual quadric matrices, in quadric_keys() order
+        qs = self.quadrics(values)
+        if self._quadric_matrices is None:
+            self._quadric_matrices = (np.array(
+                [q.matrix() for q in qs.values()],
+                dtype=np.float64).reshape(-1, 4, 4))
+        return self._quadric_matrices
+
+    def spatial_index(self, values: gtsam.Values) -> QuadricSpatialIndex:
+        # Index rows are in the order quadrics were added to it, which can
+        # differ from quadric_keys() (see quadric_positions()). Only new &
+        # touched quadrics are fetched from the values, unless quadrics have
+        # been removed (or everything was touched), when it's rebuilt.
+        ks = self.quadric_keys(values)
+        new = [k for k in ks if k not in self._spatial_rows]
+        if (self._spatial_index is None or self._touched_all or
+                len(self._spatial_rows) + len(new) != len(ks)):
+            self._spatial_keys = list(ks)
+            self._spatial_rows = {k: i for i, k in enumerate(ks)}
+            self._spatial_index = QuadricSpatialIndex(
+                *self._spheres(values, ks), self.spatial_tolerance)
+        else:
+            changed = [
+                k for k in self._touched if k in self._spatial_rows and
+                values.exists(k)
+            ] + new
+            for k in new:
+                self._spatial_rows[k] = len(self._spatial_keys)
+                self._spatial_keys.append(k)
+            if changed:
+                self._spatial_index.set(
+                    np.array([self._spatial_rows[k] for k in changed]),
+                    *self._spheres(values, changed))
+        self._touched_all = False
+        self._touched = set()
+        return self._spatial_index
+
+    @staticmethod
+    def _spheres(values: gtsam.Values,
+                 ks: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        qs = [
+            gtsam_quadrics.ConstrainedDualQuadric.getFromValues(values, k)
+            for k in ks
+        ]
+        return (np.array([q.centroid() for q in qs]).reshape(-1, 3),
+                np.array([np.max(q.radii()) for q in qs]))
+
+    def quadric_positions(self, values: gtsam.Values,
+                          rows: np.ndarray) -> np.ndarray:
+        # Positions in quadric_keys() of the quadrics at spatial index rows
+        # (sorted)
+        ks = self.quadric_keys(values)
+        if self._positions is None:
+            self._positions = {k: i for i, k in enumerate(ks)}
+        return np.sort(
+            np.array([self._positions[self._spatial_keys[r]] for r in rows],
+                     dtype=int))
+
+    def next_quadric_index(self, values: gtsam.Values) -> int:
+        # One past the highest index of any quadric that has a value
+        ks = self.quadric_keys(values)
+        if self._next_q is None:
+            self._next_q = (0 if len(ks) == 0 else
+                            max(self.keys[k][1] for k in ks) + 1)
+        return self._next_q
+
+
 class Detection:
 
     def __init__(self,
@@ -25,19 +225,164 @@ class Detection:
         self.quadric_key = quadric_key
 
 
+class DetectionStore:
+    # Append-only store of detections, kept as columns of NumPy arrays (with
+    # -1 for a missing quadric key) that grow geometrically. Detections are
+    # copied in on append, and materialised as new Detection objects when
+    # read back out.
+    #
+    # Also maintains indexes of detections by quadric & by pose, and the label
+    # of each quadric (the label of its first detection).
+
+    def __init__(self,
+                 detections: Iterable[Detection] = (),
+                 capacity: int = 1024) -> None:
+        self._n = 0
+        self._bounds = np.empty((capacity, 4), dtype=np.float64)
+        self._pose_keys = np.empty((capacity,), dtype=np.int64)
+        self._quadric_keys = np.empty((capacity,), dtype=np.int64)
+        self._label_ids = np.empty((capacity,), dtype=np.int32)
+
+        self.label_table: List[str] = []
+        self._label_index: Dict[str, int] = {}
+        self._by_quadric: Dict[int, array] = {}
+        self._by_pose: Dict[int, array] = {}
+        self.labels: Dict[int, str] = {}
+
+        self.extend(detections)
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __iter__(self) -> Iterator[Detection]:
+        return (self[i] for i in range(self._n))
+
+    def __getitem__(self, i: int) -> Detection:
+        if not -self._n <= i < self._n:
+            raise IndexError("Detection index %d out of range." % i)
+        i %= self._n
+        qk = int(self._quadric_keys[i])
+        return Detection(label=self.label_table[self._label_ids[i]],
+                         bounds=self._bounds[i].copy(),
+                         pose_key=int(self._pose_keys[i]),
+                         quadric_key=None if qk == -1 else qk)
+
+    def __contains__(self, d: Detection) -> bool:
+        # Detections match if they have the same pose, label, & bounds
+        if d.label not in self._label_index:
+            return False
+        rs = self.for_pose(d.pose_key)
+        return bool(
+            np.any((self._label_ids[rs] == self._label_index[d.label]) &
+                   (self._bounds[rs] == np.asarray(d.bounds)).all(axis=1)))
+
+    def _grow(self) -> None:
+        c = max(1, 2 * len(self._pose_keys))
+        for k in ('_bounds', '_pose_keys', '_quadric_keys', '_label_ids'):
+            a = getattr(self, k)
+            b = np.empty((c,) + a.shape[1:], dtype=a.dtype)
+            b[:self._n] = a[:self._n]
+            setattr(self, k, b)
+
+    def append(self, d: Detection) -> None:
+        if self._n == len(self._pose_keys):
+            self._grow()
+        i = self._n
+        self._bounds[i] = d.bounds
+        self._pose_keys[i] = d.pose_key
+        self._quadric_keys[i] = -1 if d.quadric_key is None else d.quadric_key
+        self._label_ids[i] = self._label_index.setdefault(
+            d.label, len(self.label_table))
+        if self._label_ids[i] == len(self.label_table):
+            self.label_table.append(d.label)
+        self._n += 1
+
+        self._by_pose.setdefault(d.pose_key, array('q')).append(i)
+        if d.quadric_key is not None:
+            self._by_quadric.setdefault(d.quadric_key, array('q')).append(i)
+            self.labels.setdefault(d.quadric_key, d.label)
+
+    def extend(self, detections: Iterable[Detection]) -> None:
+        for d in detections:
+            self.append(d)
+
+    def bounds(self) -> np.ndarray:
+        return self._bounds[:self._n]
+
+    def pose_keys(self) -> np.ndarray:
+        return self._pose_keys[:self._n]
+
+    def quadric_keys(self) -> np.ndarray:
+        return self._quadric_keys[:self._n]
+
+    def label_ids(self) -> np.ndarray:
+        return self._label_ids[:self._n]
+
+    def for_quadric(self, quadric_key: int) -> np.ndarray:
+        # Indices of the detections associated with a quadric
+        return np.array(self._by_quadric.get(quadric_key, ()), dtype=np.int64)
+
+    def for_pose(self, pose_key: int) -> np.ndarray:
+        # Indices of the detections made from a pose
+        return np.array(self._by_pose.get(pose_key, ()), dtype=np.int64)
+
+
 class StepState:
 
-    def __init__(self, i: int) -> None:
+    def __init__(self, i: int, keys: Optional[KeyRegistry] = None) -> None:
         self.i = i
-        self.pose_key = xi(i)
+        self.pose_key = xi(i) if keys is None else keys.xi(i)
+
+        # Time of the step, in the units of the fixed-lag smoother's lag
+        self.stamp = float(i)
 
-        self.rgb: Optional[np.ndarray] = None
-        self.depth: Optional[np.ndarray] = None
+        self._rgb: Union[None, np.ndarray, ImageLoader] = None
+        self._depth: Union[None, np.ndarray, ImageLoader] = None
+        self._depth_integral: Optional[DepthIntegral] = None
         self.odom: Optional[SE3] = None
 
         self.detections: List[Detection] = []
         self.new_associated: List[Detection] = []
 
+    @property
+    def rgb(self) -> Optional[np.ndarray]:
+        if callable(self._rgb):
+            self._rgb = self._rgb()
+        return self._rgb
+
+    @rgb.setter
+    def rgb(self, rgb: Union[None, np.ndarray, ImageLoader]) -> None:
+        self._rgb = rgb
+
+    @property
+    def depth(self) -> Optional[np.ndarray]:
+        if callable(self._depth):
+            self._depth = self._depth()
+        return self._depth
+
+    @depth.setter
+    def depth(self, depth: Union[None, np.ndarray, ImageLoader]) -> None:
+        self._depth = depth
+        self._depth_integral = None
+
+    def depth_integral(self) -> DepthIntegral:
+        # Summed-area tables of the depth image, for O(1) box depth stats
+        # (built lazily, & kept until release() once the step is neither the
+        # current nor the previous step)
+        if self._depth_integral is None:
+            assert self.depth is not None
+            self._depth_integral = DepthIntegral(self.depth)
+        return self._depth_integral
+
+    def release(self) -> None:
+        # Frees caches derived from the step's images
+        self._depth_integral = None
+
+    def loaded(self, modality: str) -> bool:
+        # True if the modality isn't still waiting to be loaded (checking
+        # this never triggers a load)
+        return not callable(getattr(self, '_' + modality))
+
 
 class SystemState:
 
@@ -51,6 +396,8 @@ class SystemState:
         optimiser_params: Union[gtsam.ISAM2Params,
                                 gtsam.LevenbergMarquardtParams,
                                 gtsam.GaussNewtonParams],
+        optimiser_lag: Optional[float] = None,
+        optimiser_lag_unit: str = 'frames',
     ) -> None:
         self.initial_pose = gtsam.Pose3(initial_pose.A)
         self.noise_prior = gtsam.noiseModel.Diagonal.Sigmas(noise_prior)
@@ -64,24 +411,83 @@ class SystemState:
             gtsam.GaussNewtonOptimizer if type(optimiser_params)
             == gtsam.GaussNewtonParams else gtsam.LevenbergMarquardtOptimizer)
 
-        self.associated: List[Detection] = []
+        # Fixed-lag mode smooths over only the poses & quadrics touched within
+        # the last 'lag' frames (or seconds). Keys that leave the window are
+        # marginalised out of the optimiser, but keep their last estimate.
+        self.lag = optimiser_lag
+        self.lag_unit = optimiser_lag_unit
+        if self.lag is not None:
+            if optimiser_batch:
+                raise ValueError("ERROR: Can't run fixed-lag mode in batch.")
+            elif self.lag <= 0 or self.lag_unit not in LAG_UNITS:
+                raise ValueError(
+                    "ERROR: Lag must be positive, & one of %s." % (LAG_UNITS,))
+            elif IncrementalFixedLagSmoother is None:
+                raise ImportError(
+                    "Fixed-lag mode needs gtsam's fixed-lag smoother "
+                    "(gtsam_unstable).")
+            self.optimiser_type = IncrementalFixedLagSmoother
+
+        self.associated = DetectionStore()
         self.unassociated: List[Detection] = []
 
-        self.labels: Dict[int, str] = {}
+        # Label of each quadric, kept up to date by the associated store
+        self.labels: Dict[int, str] = self.associated.labels
 
         self.graph = gtsam.NonlinearFactorGraph()
         self.estimates = gtsam.Values()
 
+        # Factors & values added since the last incremental update. These are
+        # recorded as they're added and handed straight to the optimiser, so
+        # we never have to diff the whole graph to find what's new.
+        self.pending_factors = gtsam.NonlinearFactorGraph()
+        self.pending_values = gtsam.Values()
+
+        # Indices of factors to remove from the optimiser at the next
+        # incremental update
+        self.pending_removals: List[int] = []
+
+        # Indices of every factor removed from the graph (its slot is left
+        # empty, so later indices don't change)
+        self.removed_factors: List[int] = []
+
+        # Factors whose keys don't have an initial estimate yet, indexed by
+        # the key that unblocks them (between factors by their source pose,
+        # box factors by their quadric). Only these are visited when guessing
+        # initial values.
+        self.init_priors: List[gtsam.PriorFactorPose3] = []
+        self.init_betweens: Dict[int, List[gtsam.BetweenFactorPose3]] = {}
+        self.init_boxes: Dict[int,
+                              List[gtsam_quadrics.BoundingBoxFactor]] = {}
+
         self.optimiser = None
 
+        # Fixed-lag bookkeeping: latest timestamp of each key still in the
+        # smoother, the marginal covariance of each quadric that has left it
+        # (None if it couldn't be computed), & when the run started
+        self.stamps: Dict[int, float] = {}
+        self.marginals: Dict[int, Optional[np.ndarray]] = {}
+        self.start_time = 0.0
+
         self.calib_depth: Optional[float] = None
         self.calib_rgb: Optional[np.ndarray] = None
 
+    def odometry_noise(self, frames: int) -> gtsam.noiseModel.Diagonal:
+        # Noise of odometry composed over a number of frames (e.g. across
+        # frames that weren't keyframes). Each frame's noise is independent,
+        # so sigmas grow with the square root of the number of frames.
+        if frames <= 1:
+            return self.noise_odom
+        return gtsam.noiseModel.Diagonal.Sigmas(self.noise_odom.sigmas() *
+                                                np.sqrt(frames))
+
 
 class QuadricSlamState:
 
     def __init__(self, system: SystemState) -> None:
         self.system = system
+        self.keys = KeyRegistry()
 
         self.prev_step: Optional[StepState] = None
+        self.prev_keyframe: Optional[StepState] = None
         self.this_step: Optional[StepState] = None
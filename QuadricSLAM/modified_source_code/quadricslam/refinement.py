@@ -0,0 +1,121 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import gtsam
+import gtsam_quadrics
+import numpy as np
+import os
+
+from .quadricslam_states import QuadricSlamState
+
+# Refines every quadric on its own with the trajectory held fixed. With fixed
+# poses a quadric's box factors only depend on that quadric, so the map
+# splits into many small (9 DOF) problems that are solved in parallel across
+# a pool of processes, rather than as one big gtsam solve.
+#
+# Problems are shipped to workers as plain NumPy arrays (gtsam objects don't
+# pickle), & the results are written back into SystemState.estimates.
+# Quadrics with fewer than min_observations boxes, or whose solve fails, keep
+# their current estimate.
+
+# (key, pose, radii, boxes, poses, calib, sigmas, max_iterations, tolerance)
+Problem = Tuple[int, np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                np.ndarray, np.ndarray, int, float]
+
+
+def _solve(problem: Problem) -> Optional[Tuple[int, np.ndarray, np.ndarray]]:
+    key, pose, radii, boxes, poses, calib, sigmas, its, tol = problem
+    q_key = int(gtsam.symbol('q', 0))
+    cal = gtsam.Cal3_S2(calib)
+    noise = gtsam.noiseModel.Diagonal.Sigmas(sigmas)
+
+    graph = gtsam.NonlinearFactorGraph()
+    values = gtsam.Values()
+    gtsam_quadrics.ConstrainedDualQuadric(gtsam.Pose3(pose),
+                                          radii).addToValues(values, q_key)
+    for i, (b, p) in enumerate(zip(boxes, poses)):
+        x_key = int(gtsam.symbol('x', i))
+        values.insert(x_key, gtsam.Pose3(p))
+        graph.add(gtsam.NonlinearEqualityPose3(x_key, gtsam.Pose3(p)))
+        graph.add(
+            gtsam_quadrics.BoundingBoxFactor(gtsam_quadrics.AlignedBox2(b),
+                                             cal, x_key, q_key, noise))
+
+    params = gtsam.LevenbergMarquardtParams()
+    params.setMaxIterations(its)
+    params.setRelativeErrorTol(tol)
+    try:
+        result = gtsam.LevenbergMarquardtOptimizer(graph, values,
+                                                   params).optimize()
+    except RuntimeError:
+        return None
+    q = gtsam_quadrics.ConstrainedDualQuadric.getFromValues(result, q_key)
+    return key, q.pose().matrix(), q.radii()
+
+
+class QuadricRefiner:
+
+    def __init__(self,
+                 workers: Optional[int] = None,
+                 processes: bool = True,
+                 min_observations: int = 3,
+                 max_iterations: int = 20,
+                 relative_error_tol: float = 1e-5) -> None:
+        # workers defaults to the number of cores
+        self.workers = os.cpu_count() if workers is None else workers
+        self.processes = processes
+        self.min_observations = min_observations
+        self.max_iterations = max_iterations
+        self.relative_error_tol = relative_error_tol
+
+    def problems(self, state: QuadricSlamState) -> List[Problem]:
+        # Boxes come from the graph's box factors, or the associated
+        # detections in fixed-lag mode (where the graph isn't kept)
+        s = state.system
+        assert s.calib_rgb is not None
+        if s.lag is None:
+            obs = [(f.objectKey(), f.poseKey(), f.measurement().vector())
+                   for f in (s.graph.at(i) for i in range(s.graph.size()))
+                   if type(f) == gtsam_quadrics.BoundingBoxFactor]
+        else:
+            obs = [(d.quadric_key, d.pose_key, d.bounds)
+                   for d in s.associated
+                   if d.quadric_key is not None]
+
+        by_quadric: Dict[int, List[Tuple[int, np.ndarray]]] = {}
+        for q, x, b in obs:
+            if s.estimates.exists(q) and s.estimates.exists(x):
+                by_quadric.setdefault(q, []).append((x, b))
+
+        qs = state.keys.quadrics(s.estimates)
+        ps = state.keys.poses(s.estimates)
+        sigmas = s.noise_boxes.sigmas()
+        return [(k, qs[k].pose().matrix(), qs[k].radii(),
+                 np.array([b for _, b in xbs], dtype=np.float64),
+                 np.array([ps[x].matrix() for x, _ in xbs]),
+                 np.asarray(s.calib_rgb, dtype=np.float64), sigmas,
+                 self.max_iterations, self.relative_error_tol)
+                for k, xbs in sorted(by_quadric.items())
+                if len(xbs) >= self.min_observations]
+
+    def refine(self, state: QuadricSlamState) -> int:
+        # Refines quadric estimates in place, returning how many changed
+        s = state.system
+        ps = self.problems(state)
+        if not ps:
+            return 0
+        with (ProcessPoolExecutor(self.workers) if self.processes else
+              ThreadPoolExecutor(self.workers)) as e:
+            rs = [
+                r for r in e.map(_solve,
+                                 ps,
+                                 chunksize=max(
+                                     1, len(ps) // (4 * self.workers)))
+                if r is not None
+            ]
+
+        for k, pose, radii in rs:
+            s.estimates.erase(k)
+            gtsam_quadrics.ConstrainedDualQuadric(
+                gtsam.Pose3(pose), radii).addToValues(s.estimates, k)
+        state.keys.invalidate([k for k, _, _ in rs])
+        return len(rs)
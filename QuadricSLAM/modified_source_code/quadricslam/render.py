@@ -0,0 +1,228 @@
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import multiprocessing as mp
+import numpy as np
+import os
+import time
+
+from .map_io import MapReader
+from .visualisation import MapArtists, _MapState, assign_colours, map_limits
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Offscreen rendering of a streamed map (see map_io.py) to a video or a PNG
+# sequence, with a frame for every STEP chunk (i.e. every step the estimates
+# changed at). Frames are drawn with MapArtists on Agg canvases (no display
+# needed) by a pool of processes, each rendering blocks of consecutive
+# frames: a block starts from the map as of its first frame & merges each
+# step's changes in turn, so every frame costs only its own changes & the
+# draw.
+#
+# The camera either stays 'fixed' (showing the final map, or the limits
+# given), or 'follow's the latest pose showing a box of a given radius
+# around it. A map still being written by a running session can be rendered
+# as it grows (live=True), until it stops growing.
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov')
+FOURCC = {'.mp4': 'mp4v', '.avi': 'MJPG', '.mkv': 'mp4v', '.mov': 'mp4v'}
+
+# Per worker process state (set by _init_worker())
+_worker: Dict[str, Any] = {}
+
+
+def _step_rows(r: MapReader,
+               i: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray,
+                                np.ndarray, List[Any]]:
+    s = r.steps[i]
+    return (s.pose_keys, s.poses, s.quadric_keys,
+            np.hstack([s.quadric_poses, s.radii]),
+            [r.labels[l] for l in s.labels.tolist()])
+
+
+def _state_at(r: MapReader, i: int) -> _MapState:
+    # Map as of the i'th STEP chunk (empty if i < 0)
+    state = _MapState()
+    if i >= 0:
+        pks, ps = r.trajectory(chunks=i + 1)
+        qks, qps, radii, labels = r.quadrics(chunks=i + 1)
+        state.merge(pks, ps[:, :3, :].reshape(-1, 12), qks,
+                    np.hstack([qps[:, :3, :].reshape(-1, 12), radii]),
+                    labels)
+    return state
+
+
+def _init_worker(path: str, options: Dict[str, Any]) -> None:
+    w, h = options['size']
+    dpi = options['dpi']
+    fig = Figure(figsize=(w / dpi, h / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(projection='3d')
+    ax.view_init(elev=options['elev'], azim=options['azim'])
+    _worker.update(path=path,
+                   options=options,
+                   reader=MapReader(path),
+                   fig=fig,
+                   artists=MapArtists(ax,
+                                      options['sz'],
+                                      options['stride'],
+                                      legend=options['legend']))
+
+
+def _limits(limits: Any, ps: np.ndarray) -> Any:
+    o = _worker['options']
+    if o['camera'] == 'fixed' or not len(ps):
+        return limits
+    c = ps[-1, :3, 3]
+    return c - o['radius'], c + o['radius']
+
+
+def _render_block(
+    task: Tuple[Sequence[int], Any, Dict[str, Any]]
+) -> List[Tuple[int, Optional[np.ndarray]]]:
+    # Renders frames (increasing STEP chunk indices) over the fixed camera's
+    # limits, with the label colours picked by render_map() (so they're the
+    # same in every process), returning BGR images (or writing PNGs, when
+    # rendering to a directory)
+    frames, limits, colours = task
+    r, o = _worker['reader'], _worker['options']
+    if frames[-1] >= len(r):
+        r = _worker['reader'] = MapReader(_worker['path'])
+    fig, artists = _worker['fig'], _worker['artists']
+    artists.colours.update(colours)
+
+    out: List[Tuple[int, Optional[np.ndarray]]] = []
+    state = _state_at(r, frames[0] - 1)
+    i = frames[0]
+    for f in frames:
+        while i <= f:
+            state.merge(*_step_rows(r, i))
+            i += 1
+        ps, qps, radii, labels = state.arrays()
+        artists.update(ps, qps, radii, labels, _limits(limits, ps))
+        if o['title']:
+            fig.suptitle('step %d' % r.steps[f].step)
+        fig.canvas.draw()
+        im = cv2.cvtColor(np.asarray(fig.canvas.buffer_rgba()),
+                          cv2.COLOR_RGBA2BGR)
+        if o['directory'] is None:
+            out.append((f, im))
+        else:
+            cv2.imwrite(
+                os.path.join(o['directory'],
+                             'frame_%06d.png' % (f // o['every'])), im)
+            out.append((f, None))
+    return out
+
+
+def render_map(path: str,
+               output: str,
+               camera: str = 'fixed',
+               fps: float = 30.0,
+               size: Tuple[int, int] = (1280, 720),
+               dpi: int = 100,
+               every: int = 1,
+               elev: float = 30.0,
+               azim: float = -60.0,
+               radius: Optional[float] = None,
+               limits: Optional[Tuple[Sequence[float],
+                                      Sequence[float]]] = None,
+               processes: Optional[int] = None,
+               block_size: int = 16,
+               live: bool = False,
+               poll: float = 1.0,
+               idle: float = 10.0,
+               sz: int = 50,
+               stride: int = 4,
+               legend: bool = True,
+               title: bool = True) -> int:
+    # Renders the map at path to output (a video if it has a video
+    # extension, otherwise a directory of frame_NNNNNN.png), a frame for
+    # every every'th STEP chunk, returning the number of frames.
+    #
+    # camera is 'fixed' (over limits, default those of the final map) or
+    # 'follow' (over a box radius around the latest pose, default a quarter
+    # of the final map's size). With live, frames are rendered as the map
+    # grows, checking every poll seconds until it hasn't grown for idle
+    # seconds (a fixed camera without limits then grows with the map).
+    if cv2 is None:
+        raise ImportError("Rendering maps requires OpenCV (cv2).")
+    if camera not in ('fixed', 'follow'):
+        raise ValueError("Camera '%s' isn't 'fixed' or 'follow'." % camera)
+
+    r = MapReader(path)
+    lo, hi = map_limits(*r.trajectory()[1:], *r.quadrics()[1:3])
+    if radius is None:
+        radius = 0.25 * float(np.max(hi - lo))
+    if limits is not None:
+        lo, hi = np.asarray(limits[0]), np.asarray(limits[1])
+    fixed_limits = limits is not None or not live
+
+    ext = os.path.splitext(output)[1].lower()
+    video = None
+    directory = None
+    if ext not in VIDEO_EXTENSIONS:
+        directory = output
+        os.makedirs(directory, exist_ok=True)
+
+    options = {
+        'camera': camera,
+        'size': size,
+        'dpi': dpi,
+        'every': every,
+        'elev': elev,
+        'azim': azim,
+        'radius': radius,
+        'directory': directory,
+        'sz': sz,
+        'stride': stride,
+        'legend': legend,
+        'title': title
+    }
+
+    n = 0
+    done = 0
+    colours: Dict[str, Any] = {}
+    last_size, last_growth = -1, time.monotonic()
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(processes,
+                  initializer=_init_worker,
+                  initargs=(path, options)) as pool:
+        while True:
+            frames = list(range(done, len(r), every))
+            if frames:
+                if not fixed_limits:
+                    lo, hi = map_limits(*r.trajectory()[1:],
+                                        *r.quadrics()[1:3])
+                assign_colours(r.labels, colours)
+                tasks = [(frames[i:i + block_size], (lo, hi), colours)
+                         for i in range(0, len(frames), block_size)]
+                for block in pool.imap(_render_block, tasks):
+                    for _, im in block:
+                        if directory is None:
+                            if video is None:
+                                video = cv2.VideoWriter(
+                                    output,
+                                    cv2.VideoWriter_fourcc(*FOURCC[ext]),
+                                    fps, (im.shape[1], im.shape[0]))
+                            video.write(im)
+                        n += 1
+                done = frames[-1] + every
+            if not live:
+                break
+
+            # (a half written final chunk is rendered once it's complete)
+            s = os.path.getsize(path)
+            if s != last_size:
+                last_size, last_growth = s, time.monotonic()
+            elif time.monotonic() - last_growth > idle:
+                break
+            time.sleep(poll)
+            r = MapReader(path)
+
+    if video is not None:
+        video.release()
+    return n
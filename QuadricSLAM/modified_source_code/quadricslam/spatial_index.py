@@ -0,0 +1,112 @@
+from scipy.spatial import cKDTree
+from typing import Tuple
+import numpy as np
+
+# Spatial index over the quadrics in a map, used to cheaply find the quadrics
+# that could possibly be seen from a camera before doing any projection. Each
+# quadric is represented by its centroid, and a bounding sphere with radius
+# equal to its largest semi-axis.
+#
+# The index is maintained alongside the estimates rather than rebuilt with
+# them: set() updates (or appends) the spheres of quadrics that changed, and
+# the KD-tree is only rebuilt once an indexed centroid has moved more than
+# `tolerance` from where the tree has it, or once enough spheres have been
+# appended since the last build. Appended spheres are checked directly until
+# then, & tree queries are padded by the tolerance, so results are always the
+# same as a freshly built index's.
+
+
+class QuadricSpatialIndex:
+
+    def __init__(self,
+                 centroids: np.ndarray,
+                 radii: np.ndarray,
+                 tolerance: float = 0.1) -> None:
+        self.tolerance = tolerance
+        self.centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 3)
+        self.radii = np.asarray(radii, dtype=np.float64).reshape(-1)
+        self.builds = 0
+        self._build()
+
+    def __len__(self) -> int:
+        return len(self.centroids)
+
+    def _build(self) -> None:
+        self.max_radius = 0 if len(self.radii) == 0 else self.radii.max()
+        self._tree_centroids = self.centroids.copy()
+        self.tree = (None
+                     if len(self.centroids) == 0 else cKDTree(self.centroids))
+        self.builds += 1
+
+    def set(self, rows: np.ndarray, centroids: np.ndarray,
+            radii: np.ndarray) -> None:
+        # Sets the bounding spheres at rows, where rows from len(self) onwards
+        # (in order) are appended
+        rows = np.asarray(rows, dtype=int).reshape(-1)
+        centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 3)
+        radii = np.asarray(radii, dtype=np.float64).reshape(-1)
+        grow = rows >= len(self)
+        if grow.any():
+            self.centroids = np.vstack([self.centroids, centroids[grow]])
+            self.radii = np.concatenate([self.radii, radii[grow]])
+        self.centroids[rows] = centroids
+        self.radii[rows] = radii
+        if len(radii):
+            self.max_radius = max(self.max_radius, radii.max())
+
+        # Rebuild once the tree is too far out of date to be worth padding
+        n = len(self._tree_centroids)
+        indexed = rows[rows < n]
+        if (len(self) - n > max(16, n // 8) or np.any(
+                np.linalg.norm(self.centroids[indexed] -
+                               self._tree_centroids[indexed],
+                               axis=1) > self.tolerance)):
+            self._build()
+
+    def within(self, point: np.ndarray, distance: float) -> np.ndarray:
+        # Indices of quadrics whose bounding sphere comes within distance of
+        # the point (sorted, so results keep the map's order). The tree (&
+        # any spheres appended since it was built) give candidates, which are
+        # then checked against their current sphere.
+        n = len(self._tree_centroids)
+        rs = ([] if self.tree is None else self.tree.query_ball_point(
+            point, distance + self.max_radius + self.tolerance))
+        cs = np.concatenate([np.array(rs, dtype=int),
+                             np.arange(n, len(self))])
+        ok = (np.linalg.norm(self.centroids[cs] - point, axis=1) <=
+              distance + self.radii[cs])
+        return np.sort(cs[ok])
+
+    def in_frustum(self,
+                   pose: np.ndarray,
+                   calib: np.ndarray,
+                   image_size: Tuple[float, float],
+                   near: float = 0,
+                   far: float = np.inf) -> np.ndarray:
+        # Indices of quadrics whose bounding sphere intersects the viewing
+        # frustum of a camera at pose (4x4, camera to world) with calibration
+        # (fx, fy, skew, u0, v0) and image size (width, height). This is
+        # conservative; a sphere near a frustum corner may be kept even though
+        # it is just out of view.
+        cs = (np.arange(len(self)) if not np.isfinite(far) else self.within(
+            pose[:3, 3], far))
+        if len(cs) == 0:
+            return cs
+
+        # Bring candidate centroids into the camera frame
+        R, t = pose[:3, :3], pose[:3, 3]
+        ps = (self.centroids[cs] - t) @ R
+        rs = self.radii[cs]
+
+        # Inward facing normals of the 4 side planes (all through the camera
+        # centre), from requiring 0 <= u <= w and 0 <= v <= h
+        fx, fy, s, u0, v0 = calib
+        w, h = image_size
+        ns = np.array([[fx, s, u0], [-fx, -s, w - u0], [0, fy, v0],
+                       [0, -fy, h - v0]],
+                      dtype=np.float64)
+        ns /= np.linalg.norm(ns, axis=1)[:, np.newaxis]
+
+        ok = ((ps @ ns.T >= -rs[:, np.newaxis]).all(axis=1) &
+              (ps[:, 2] - near >= -rs) & (far - ps[:, 2] >= -rs))
+        return cs[ok]
@@ -1,14 +1,24 @@
-from typing import Callable, List
+from typing import Callable, List, Optional, Tuple
 import gtsam
 import gtsam_quadrics
 import numpy as np
 
-from .quadricslam_states import QuadricSlamState
+from .quadricslam_states import KeyRegistry, QuadricSlamState
 
 QuadricInitialiser = Callable[
     [List[gtsam.Pose3], List[gtsam_quadrics.AlignedBox2], QuadricSlamState],
     gtsam_quadrics.ConstrainedDualQuadric]
 
+# Initialises every quadric waiting on an estimate at once, from all of their
+# observations as (M,4,4) camera poses, (M,4) boxes, & the (M,) index of the
+# quadric each belongs to (grouped & numbered from 0), returning (N,3)
+# centres, (N,3,3) rotations, & (N,3) radii. A QuadricInitialiser with a
+# batched equivalent has it as its 'batch' attribute, which QuadricSlam uses
+# instead.
+BatchQuadricInitialiser = Callable[
+    [np.ndarray, np.ndarray, np.ndarray, QuadricSlamState],
+    Tuple[np.ndarray, np.ndarray, np.ndarray]]
+
 
 def initialise_quadric_from_depth(
         obs_poses: List[gtsam.Pose3],
@@ -54,6 +64,10 @@ def initialise_quadric_from_depth(
     return gtsam_quadrics.ConstrainedDualQuadric(quadric_pose, radii)
 
 
+# Images read by each initialiser (see DataSource.require())
+initialise_quadric_from_depth.modalities = frozenset({'depth'})
+
+
 def initialise_quadric_ray_intersection(
         obs_poses: List[gtsam.Pose3], boxes: List[gtsam_quadrics.AlignedBox2],
         state: QuadricSlamState) -> gtsam_quadrics.ConstrainedDualQuadric:
@@ -82,6 +96,165 @@ def initialise_quadric_ray_intersection(
         gtsam.Rot3(), gtsam.Point3(quadric_centroid), [1, 1, 0.1])
 
 
+def box_medians(image: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    # Medians of the valid (positive & finite) pixels in (N,4) integer boxes
+    # (as in depth_integral.box_sums()), NaN for boxes with no valid pixels
+    h, w = image.shape[:2]
+    out = np.full(len(boxes), np.nan)
+    for i, (x0, y0, x1, y1) in enumerate(boxes):
+        ps = image[max(y0, 0):min(y1, h), max(x0, 0):min(x1, w)]
+        ps = ps[(ps > 0) & np.isfinite(ps)]
+        if ps.size:
+            out[i] = np.median(ps)
+    return out
+
+
+def lookat_rotations(eyes: np.ndarray, targets: np.ndarray,
+                     ups: np.ndarray) -> np.ndarray:
+    # (N,3,3) rotations of PinholeCameraCal3_S2.Lookat(eye, target, up) for
+    # (N,3) eyes, targets, & up vectors
+    zs = targets - eyes
+    zs /= np.linalg.norm(zs, axis=1, keepdims=True)
+    xs = np.cross(-ups, zs)
+    xs /= np.linalg.norm(xs, axis=1, keepdims=True)
+    return np.stack([xs, np.cross(zs, xs), zs], axis=2)
+
+
+def initialise_quadrics_from_depth(
+        obs_poses: np.ndarray,
+        boxes: np.ndarray,
+        objects: np.ndarray,
+        state: QuadricSlamState,
+        object_depth: float = 0.1,
+        statistic: str = 'mean') -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Batched initialise_quadric_from_depth() (see BatchQuadricInitialiser),
+    # likewise only using the first observation of each quadric. A box's
+    # depth is its mean depth (matching the unbatched mean, so missing depth
+    # counts as 0), the mean of its valid depths (statistic='valid_mean'),
+    # or their median (statistic='median', more robust to background). The
+    # means come from the step's cached summed-area tables (see
+    # StepState.depth_integral()).
+    s = state.system
+    assert s.calib_rgb is not None
+    assert state.this_step is not None
+    n = state.this_step
+    assert n.depth is not None
+
+    first = np.flatnonzero(np.r_[True, objects[1:] != objects[:-1]])
+    poses, boxes = obs_poses[first], boxes[first]
+    Rs, ts = poses[:, :3, :3], poses[:, :3, 3]
+    fx, fy, _, px, py = s.calib_rgb
+
+    # get box depths
+    dboxes = boxes.astype('int')  # get discrete box bounds
+    if statistic == 'mean':
+        integral = n.depth_integral()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            depths = integral.sums(dboxes) / integral.areas(dboxes)
+    elif statistic == 'valid_mean':
+        depths = n.depth_integral().means(dboxes)
+    elif statistic == 'median':
+        depths = box_medians(n.depth, dboxes)
+    else:
+        raise ValueError("Box depth statistic '%s' isn't 'mean', "
+                         "'valid_mean', or 'median'." % statistic)
+
+    # compute the 3D points corrosponding to the box centers
+    xs = ((boxes[:, 0] + boxes[:, 2]) / 2 - px) * depths / fx
+    ys = ((boxes[:, 1] + boxes[:, 3]) / 2 - py) * depths / fy
+    centres = np.einsum('nij,nj->ni', Rs, np.stack([xs, ys, depths],
+                                                   axis=1)) + ts
+
+    # compute quadric rotations like .Lookat (with the same up vector, i.e.
+    # the point below the camera rather than the direction)
+    ups = -Rs[:, :, 1] + ts
+    rotations = lookat_rotations(ts, centres, ups)
+
+    # compute the quadric radii from the box shapes
+    txs = (boxes[:, 0] - px) * depths / fx
+    tys = (boxes[:, 1] - py) * depths / fy
+    radii = np.stack(
+        [np.abs(txs - xs),
+         np.abs(tys - ys),
+         np.full(len(xs), object_depth)],
+        axis=1)
+    return centres, rotations, radii
+
+
+initialise_quadrics_from_depth.modalities = frozenset({'depth'})
+initialise_quadric_from_depth.batch = initialise_quadrics_from_depth
+
+
+def initialise_quadrics_ray_intersection(
+        obs_poses: np.ndarray, boxes: np.ndarray, objects: np.ndarray,
+        state: QuadricSlamState) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Batched initialise_quadric_ray_intersection() (see
+    # BatchQuadricInitialiser), solving for every quadric's closest
+    # convergence point at once
+    ps = obs_poses[:, :3, 3]
+    vs = obs_poses[:, :3, 0]
+    i_minus_vs = np.eye(3) - (vs[:, :, np.newaxis] @ vs[:, np.newaxis, :])
+
+    # Sum each quadric's observations, then solve all the least squares
+    # problems together (pinv gives the same minimum norm solution as
+    # lstsq, but takes a stack of matrices)
+    n = int(objects[-1]) + 1 if len(objects) else 0
+    a, b = np.zeros((n, 3, 3)), np.zeros((n, 3, 1))
+    np.add.at(a, objects, i_minus_vs)
+    np.add.at(b, objects, i_minus_vs @ ps[:, :, np.newaxis])
+    centres = (np.linalg.pinv(a) @ b)[:, :, 0]
+
+    # Fudge the rest for now
+    # TODO do better...
+    return (centres, np.tile(np.eye(3), (n, 1, 1)),
+            np.tile([1, 1, 0.1], (n, 1)).astype(np.float64))
+
+
+initialise_quadric_ray_intersection.batch = (
+    initialise_quadrics_ray_intersection)
+
+
+def calib_matrix(calib: np.ndarray) -> np.ndarray:
+    # 3x3 camera matrix from (fx, fy, skew, u0, v0)
+    fx, fy, s, u0, v0 = calib
+    return np.array([[fx, s, u0], [0, fy, v0], [0, 0, 1]], dtype=np.float64)
+
+
+def project_quadrics(quadrics: np.ndarray, pose: np.ndarray,
+                     calib: np.ndarray) -> np.ndarray:
+    # Projects a (M,4,4) stack of dual quadric matrices into a camera at pose
+    # (4x4, camera to world), returning the (M,4) bounds (xmin, ymin, xmax,
+    # ymax) of each dual conic P Q* P^T. This replicates
+    # QuadricCamera.project(...).bounds() for all quadrics at once (including
+    # returning NaN for conics that aren't ellipses).
+    R, t = pose[:3, :3], pose[:3, 3]
+    P = calib_matrix(calib) @ np.hstack([R.T, -R.T @ t[:, np.newaxis]])
+    C = np.einsum('ij,mjk,lk->mil', P, quadrics, P)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dx = np.sqrt(C[:, 0, 2]**2 - C[:, 2, 2] * C[:, 0, 0])
+        dy = np.sqrt(C[:, 1, 2]**2 - C[:, 2, 2] * C[:, 1, 1])
+        return np.stack([(C[:, 0, 2] + dx) / C[:, 2, 2],
+                         (C[:, 1, 2] + dy) / C[:, 2, 2],
+                         (C[:, 0, 2] - dx) / C[:, 2, 2],
+                         (C[:, 1, 2] - dy) / C[:, 2, 2]],
+                        axis=1)
+
+
+def iou_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # (D,M) IOUs between (D,4) and (M,4) boxes, following AlignedBox2.iou()
+    # (non-intersecting boxes score 0, and NaN boxes score 0 as the
+    # associator has always done)
+    a, b = a[:, np.newaxis, :], b[np.newaxis, :, :]
+    w = np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    h = np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        i = w * h
+        ious = i / ((a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1]) +
+                    (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1]) - i)
+    ious[(w <= 0) | (h <= 0) | np.isnan(ious)] = 0
+    return ious
+
+
 def new_factors(current: gtsam.NonlinearFactorGraph,
                 previous: gtsam.NonlinearFactorGraph):
     # Figure out the new factors
@@ -114,7 +287,13 @@ def new_values(current: gtsam.Values, previous: gtsam.Values):
     return out
 
 
-def ps_and_qs_from_values(values: gtsam.Values):
+def ps_and_qs_from_values(values: gtsam.Values,
+                          keys: Optional[KeyRegistry] = None):
+    # Prefer the typed views kept by a key registry (copied, as callers are
+    # free to modify what is returned)
+    if keys is not None:
+        return dict(keys.poses(values)), dict(keys.quadrics(values))
+
     # TODO there's got to be a better way to access the typed values...
     return ({
         k: values.atPose3(k)
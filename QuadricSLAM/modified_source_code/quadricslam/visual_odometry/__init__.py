@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 from spatialmath import SE3
-from typing import Optional
+from typing import FrozenSet, Optional
 import numpy as np
 
 from ..quadricslam_states import QuadricSlamState
@@ -8,6 +8,9 @@ from ..quadricslam_states import QuadricSlamState
 
 class VisualOdometry(ABC):
 
+    # Images the odometry reads from each step (see DataSource.require())
+    modalities: FrozenSet[str] = frozenset({'rgb', 'depth'})
+
     def __init__(self) -> None:
         pass
 
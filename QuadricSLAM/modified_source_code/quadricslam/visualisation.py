@@ -1,10 +1,17 @@
 from distinctipy import get_colors
+from functools import lru_cache
 from matplotlib.patches import Patch
-from typing import Dict
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+from queue import Empty, Full
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 import gtsam
 import matplotlib.pyplot as plt
+import multiprocessing as mp
 import numpy as np
+import time
 
+from .map_io import _Latest, _matrices, _rows, state_arrays
+from .quadricslam_states import KeyRegistry, QuadricSlamState
 from .utils import ps_and_qs_from_values
 
 import pudb
@@ -57,13 +64,14 @@ def _set_axes_equal(ax):
 
 def visualise(values: gtsam.Values,
               labels: Dict[int, str],
-              block: bool = False):
+              block: bool = False,
+              keys: Optional[KeyRegistry] = None):
     # Generate colour swatch for our labels
     ls = set(labels.values())
     cs = {l: c for l, c in zip(ls, get_colors(len(ls)))}
 
     # Get latest pose & quadric estimates
-    full_ps, full_qs = ps_and_qs_from_values(values)
+    full_ps, full_qs = ps_and_qs_from_values(values, keys)
     sf = 0.1 * _scale_factor(full_ps.values(), full_qs.values())
     ps = [p.matrix() for p in full_ps.values()]
 
@@ -139,3 +147,317 @@ def visualise_ellipsoid(pose: np.ndarray, radii: np.ndarray, color):
         color=color,
         linewidth=0.5,
     )
+
+
+# Geometry shared by the persistent artists below (& the offscreen renderer),
+# all as arrays of line segments (...,2,3) so they can be drawn with a single
+# Line3DCollection each rather than an artist per line
+
+
+@lru_cache(maxsize=None)
+def unit_sphere_segments(sz: int = 50, stride: int = 4) -> np.ndarray:
+    # Wireframe of the unit sphere, sampled like visualise_ellipsoid() (an
+    # sz x sz grid, with every stride'th line of each direction drawn)
+    u, v = np.linspace(0, 2 * np.pi, sz), np.linspace(0, np.pi, sz)
+    grid = np.stack([
+        np.outer(np.cos(u), np.sin(v)),
+        np.outer(np.sin(u), np.sin(v)),
+        np.outer(np.ones_like(u), np.cos(v))
+    ],
+                    axis=-1)
+    lines = np.concatenate(
+        [grid[::stride, :, :],
+         grid[:, ::stride, :].transpose(1, 0, 2)])
+    segments = np.stack([lines[:, :-1, :], lines[:, 1:, :]], axis=2)
+    segments = segments.reshape(-1, 2, 3)
+    segments.flags.writeable = False
+    return segments
+
+
+def ellipsoid_segments(poses: np.ndarray,
+                       radii: np.ndarray,
+                       sz: int = 50,
+                       stride: int = 4) -> np.ndarray:
+    # Wireframes of N ellipsoids (poses Nx4x4, radii Nx3) as (N,M,2,3), by
+    # scaling, rotating, & translating the cached unit sphere
+    poses, radii = poses.reshape(-1, 4, 4), radii.reshape(-1, 3)
+    s = unit_sphere_segments(sz, stride)
+    return (np.einsum('mkj,nj,nij->nmki', s, radii, poses[:, :3, :3]) +
+            poses[:, None, None, :3, 3])
+
+
+def trajectory_segments(poses: np.ndarray) -> np.ndarray:
+    # Segments between consecutive positions of N poses, as (N-1,2,3)
+    ts = poses.reshape(-1, 4, 4)[:, :3, 3]
+    return np.stack([ts[:-1], ts[1:]], axis=1)
+
+
+def axes_segments(poses: np.ndarray, scale: float) -> np.ndarray:
+    # x, y, & z axes of N poses scaled to a length, as (N,3,2,3)
+    poses = poses.reshape(-1, 4, 4)
+    ts = poses[:, None, :3, 3]
+    return np.stack([ts.repeat(3, axis=1),
+                     ts + scale * poses[:, :3, :3].transpose(0, 2, 1)],
+                    axis=2)
+
+
+def map_limits(poses: np.ndarray, quadric_poses: np.ndarray,
+               radii: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Lower & upper corners of a box containing the poses & quadrics
+    pts = [poses.reshape(-1, 4, 4)[:, :3, 3]]
+    if len(radii):
+        cs = quadric_poses.reshape(-1, 4, 4)[:, :3, 3]
+        r = radii.reshape(-1, 3).max(axis=1, keepdims=True)
+        pts += [cs - r, cs + r]
+    pts = np.concatenate(pts)
+    if not len(pts):
+        return -np.ones(3), np.ones(3)
+    return pts.min(axis=0), pts.max(axis=0)
+
+
+def assign_colours(labels: Sequence[str],
+                   colours: Dict[str, Tuple[float, float, float]]) -> None:
+    # Adds colours for labels that don't have one yet, distinct from the
+    # existing ones (so a label keeps its colour as the map grows)
+    new = [l for l in dict.fromkeys(labels) if l not in colours]
+    if new:
+        colours.update(
+            zip(
+                new,
+                get_colors(len(new),
+                           exclude_colors=[(0, 0, 0), (1, 1, 1)] +
+                           list(colours.values()))))
+
+
+class MapArtists:
+    # Persistent artists drawing a map (trajectory, pose axes, & quadric
+    # wireframes) on a 3D axis, which update() changes in place rather than
+    # clearing & re-plotting the axis
+
+    AXIS_COLOURS = np.array([[1, 0, 0, 1], [0, 1, 0, 1], [0, 0, 1, 1]])
+
+    def __init__(self,
+                 ax: Any,
+                 sz: int = 50,
+                 stride: int = 4,
+                 legend: bool = True) -> None:
+        self.ax = ax
+        self.sz = sz
+        self.stride = stride
+        self.legend = legend
+        self.colours: Dict[str, Tuple[float, float, float]] = {}
+        self._shown: List[str] = []
+        self.trajectory = Line3DCollection([], colors='k')
+        self.axes = Line3DCollection([], linewidths=1)
+        self.quadrics = Line3DCollection([], linewidths=0.5)
+        for c in [self.trajectory, self.axes, self.quadrics]:
+            ax.add_collection(c, autolim=False)
+        ax.set_xlabel('x')
+        ax.set_ylabel('y')
+        ax.set_zlabel('z')
+
+    def _colours(self, labels: Sequence[str]) -> np.ndarray:
+        assign_colours(labels, self.colours)
+        shown = list(dict.fromkeys(labels))
+        if self.legend and shown != self._shown:
+            self._shown = shown
+            self.ax.legend(handles=[
+                Patch(facecolor=self.colours[l],
+                      edgecolor=self.colours[l],
+                      label=l) for l in shown
+            ])
+        return np.array([self.colours[l] for l in labels]).reshape(-1, 3)
+
+    def update(self,
+               poses: np.ndarray,
+               quadric_poses: np.ndarray,
+               radii: np.ndarray,
+               labels: Sequence[str],
+               limits: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> None:
+        # Draws the map with poses (Nx4x4, in trajectory order) & quadrics
+        # (Mx4x4 poses, Mx3 radii, M labels), over limits (lower & upper
+        # corners of the shown box, fitting the map by default)
+        poses = poses.reshape(-1, 4, 4)
+        radii = radii.reshape(-1, 3)
+        lo, hi = (map_limits(poses, quadric_poses, radii)
+                  if limits is None else limits)
+        sf = 0.1 * np.max((hi - lo)[:2])
+
+        self.trajectory.set_segments(trajectory_segments(poses))
+        alphas = np.linspace(0.2, 1, len(poses))[1:]
+        self.trajectory.set_color(
+            np.hstack([np.zeros((len(alphas), 3)), alphas[:, None]]))
+        self.axes.set_segments(axes_segments(poses, sf).reshape(-1, 2, 3))
+        self.axes.set_color(np.tile(self.AXIS_COLOURS, (len(poses), 1)))
+
+        segs = ellipsoid_segments(quadric_poses, radii, self.sz, self.stride)
+        self.quadrics.set_segments(segs.reshape(-1, 2, 3))
+        self.quadrics.set_color(
+            self._colours(labels).repeat(segs.shape[1], axis=0))
+
+        # Equal scale on every axis (see _set_axes_equal())
+        c, r = (lo + hi) / 2, 0.5 * np.max(hi - lo) or 1.0
+        self.ax.set_xlim3d([c[0] - r, c[0] + r])
+        self.ax.set_ylim3d([c[1] - r, c[1] + r])
+        self.ax.set_zlim3d([c[2] - r, c[2] + r])
+
+
+class _MapState:
+    # Latest estimate of every pose & quadric, from merged deltas
+
+    def __init__(self) -> None:
+        self.poses = _Latest(12)
+        self.quadrics = _Latest(15)
+        self.labels: Dict[int, str] = {}
+
+    def merge(self, pose_keys: np.ndarray, pose_rows: np.ndarray,
+              quadric_keys: np.ndarray, quadric_rows: np.ndarray,
+              labels: Sequence[str]) -> None:
+        # (a negative tolerance marks every row as changed)
+        self.poses.changed(pose_keys, pose_rows, -1.0)
+        self.quadrics.changed(quadric_keys, quadric_rows, -1.0)
+        self.labels.update(zip(quadric_keys.tolist(), labels))
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[str]]:
+        q = self.quadrics
+        return (_matrices(self.poses.rows), _matrices(q.rows[:, :12]),
+                q.rows[:, 12:], [self.labels[k] for k in q.keys.tolist()])
+
+
+def _visualiser_main(queue: Any, fps: float, block: bool,
+                     title: str) -> None:
+    # Body of the AsyncVisualiser process: merges every waiting delta, &
+    # redraws at most fps times a second (so deltas arriving between frames
+    # are only ever drawn in their latest state)
+    fig = plt.figure(title)
+    artists = MapArtists(fig.add_subplot(projection='3d'))
+    state = _MapState()
+    plt.show(block=False)
+
+    period = 1.0 / fps
+    last = -np.inf
+    dirty = done = False
+    while not done and plt.fignum_exists(fig.number):
+        wait = max(0.0, last + period - time.monotonic()) if dirty else period
+        msgs = []
+        try:
+            msgs.append(queue.get(timeout=wait))
+            while True:
+                msgs.append(queue.get_nowait())
+        except Empty:
+            pass
+        except (EOFError, OSError):
+            break
+        for m in msgs:
+            if m is None:
+                done = True
+            else:
+                state.merge(*m)
+                dirty = True
+
+        if dirty and time.monotonic() >= last + period:
+            artists.update(*state.arrays())
+            fig.canvas.draw_idle()
+            last = time.monotonic()
+            dirty = False
+        fig.canvas.flush_events()
+
+    if dirty:
+        artists.update(*state.arrays())
+    if done and block and plt.fignum_exists(fig.number):
+        plt.show(block=True)
+
+
+class AsyncVisualiser:
+    # Non-blocking replacement for visualise() as QuadricSlam's
+    # on_new_estimate, e.g.:
+    #
+    #   with AsyncVisualiser() as v:
+    #       QuadricSlam(..., on_new_estimate=v).spin()
+    #
+    # Rendering happens in a separate process with persistent artists (see
+    # MapArtists). Each call only sends the estimates that changed since
+    # they were last sent, & never waits on the renderer: while it is busy
+    # the changes are merged locally (keeping only each key's latest
+    # estimate), & sent as one delta once it is ready for more.
+
+    def __init__(self,
+                 fps: float = 10.0,
+                 tolerance: float = 0.0,
+                 block: bool = False,
+                 title: str = 'QuadricSLAM') -> None:
+        # Estimates that moved by no more than tolerance aren't sent again
+        # (as in MapWriter). If block, close() waits for the window to be
+        # closed. coalesced counts the calls whose changes had to wait for a
+        # later delta.
+        ctx = mp.get_context('spawn')
+        self.tolerance = tolerance
+        self.block = block
+        self.coalesced = 0
+        self._queue = ctx.Queue(maxsize=1)
+        self._process = ctx.Process(target=_visualiser_main,
+                                    args=(self._queue, fps, block, title),
+                                    daemon=True)
+        self._process.start()
+        self._poses = _Latest(12)
+        self._quadrics = _Latest(15)
+        self._pending_poses: Dict[int, np.ndarray] = {}
+        self._pending_quadrics: Dict[int, Tuple[np.ndarray, str]] = {}
+
+    def __enter__(self) -> 'AsyncVisualiser':
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def __call__(self, state: QuadricSlamState) -> None:
+        self.update(*state_arrays(state))
+
+    def update(self, pose_keys: np.ndarray, poses: np.ndarray,
+               quadric_keys: np.ndarray, quadric_poses: np.ndarray,
+               radii: np.ndarray, labels: Sequence[Any]) -> None:
+        # Queues the current estimates (poses are 4x4), without blocking
+        pose_keys = np.asarray(pose_keys, dtype=np.int64)
+        quadric_keys = np.asarray(quadric_keys, dtype=np.int64)
+        prs = _rows(np.asarray(poses).reshape(-1, 4, 4))
+        qrs = np.hstack([
+            _rows(np.asarray(quadric_poses).reshape(-1, 4, 4)),
+            np.asarray(radii, dtype='<f8').reshape(-1, 3)
+        ])
+        pm = self._poses.changed(pose_keys, prs, self.tolerance)
+        qm = self._quadrics.changed(quadric_keys, qrs, self.tolerance)
+        self._pending_poses.update(zip(pose_keys[pm].tolist(), prs[pm]))
+        self._pending_quadrics.update(
+            zip(quadric_keys[qm].tolist(),
+                zip(qrs[qm], (str(l) for l, m in zip(labels, qm) if m))))
+        self._send(block=False)
+
+    def _send(self, block: bool) -> bool:
+        if not self._pending_poses and not self._pending_quadrics:
+            return True
+        ps, qs = self._pending_poses, self._pending_quadrics
+        msg = (np.fromiter(ps.keys(), dtype=np.int64, count=len(ps)),
+               np.array(list(ps.values())).reshape(-1, 12),
+               np.fromiter(qs.keys(), dtype=np.int64, count=len(qs)),
+               np.array([r for r, _ in qs.values()]).reshape(-1, 15),
+               [l for _, l in qs.values()])
+        try:
+            self._queue.put(msg, block=block, timeout=1.0 if block else None)
+        except Full:
+            self.coalesced += 1
+            return False
+        self._pending_poses, self._pending_quadrics = {}, {}
+        return True
+
+    def close(self) -> None:
+        # Sends anything pending & stops the visualiser (after the window is
+        # closed, if block)
+        if not self._process.is_alive():
+            return
+        while not self._send(block=True):
+            if not self._process.is_alive():
+                return
+        self._queue.put(None)
+        self._process.join(None if self.block else 5.0)
+        if self._process.is_alive():
+            self._process.terminate()
@@ -10,14 +10,14 @@ import textwrap
 from quadricslam import QuadricSlam, visualise
 from quadricslam.data_source.BOP_YCB import BOP_YCB_dataset
 from quadricslam.detector.from_bbox import FromBbox
+from quadricslam.map_io import save_json, save_map
 
 
 from typing import Any, List, Optional, Tuple
 from quadricslam.data_associator.quadric_iou_associator import QuadricIouAssociator
 from quadricslam.visual_odometry.rgbd_cv2 import RgbdCv2
-from quadricslam.utils import initialise_quadric_from_depth, ps_and_qs_from_values
+from quadricslam.utils import initialise_quadric_from_depth
 
-import json
 import gtsam
 import gtsam_quadrics
 
@@ -26,7 +26,7 @@ import gtsam_quadrics
 def run():
 
     # Confirm dataset path is provided
-    if len(sys.argv) != 2:
+    if len(sys.argv) not in (2, 3):
         print("ERROR: Path to dataset is a required argument.")
         sys.exit(1)
     dataset_path = sys.argv[1]
@@ -46,42 +46,16 @@ def run():
         noise_odom = np.array([0.0] * 6, dtype=np.float64),
         on_new_estimate=(
             lambda state: visualise(state.system.estimates, state.system.
-                                    labels, state.system.optimiser_batch)))
+                                    labels, state.system.optimiser_batch,
+                                    state.keys)))
     q.spin()
     # visual_odometry=RgbdCv2()
 
-    # store as json
-    # estimated poses and quadric parameters
-    poses, quadrics = ps_and_qs_from_values(q.state.system.estimates)
-
-    # label for each quadric key
-    labels = q.state.system.labels
-
-    # convert from gtsam.pose3 format to numpy array for the values
-    keys = poses.keys()
-    for k in keys:
-        poses[k] = poses[k].matrix().tolist()
-
-    # 5 usefull functions to convert from ConstrainedDualQuadric to serializable format
-    # pose, radii, centroid, matrix, normalizedMatrix - Q / Q(3, 3)
-    # https://github.com/qcr/gtsam-quadrics/blob/master/gtsam_quadrics/geometry/ConstrainedDualQuadric.h
-    keys = quadrics.keys()
-    for k in keys:
-        temp = np.eye(4)
-        temp[:3, :3] = quadrics[k].pose().rotation().matrix()
-        temp[:3, 3] = quadrics[k].pose().translation()
-        quadrics[k] = {"pose": temp.tolist(),
-                       "centroid": quadrics[k].centroid().tolist(),
-                       "radii": quadrics[k].radii().tolist()
-                       }
-
-    # save as a dictionary
-    dict_list = {"poses": poses, "quadrics": quadrics, "labels": labels}
-    
-
-    # dump into JSON file
-    with open(dataset_path + "/output.json", "w") as json_file:
-        json.dump(dict_list, json_file)
+    # store the estimated poses, quadrics, & labels as a binary map (see
+    # quadricslam/map_io.py), & as JSON if asked
+    save_map(dataset_path + "/output.qmap", q.state)
+    if sys.argv[2:] == ["json"]:
+        save_json(dataset_path + "/output.json", q.state)
 
 if __name__ == '__main__':
     run()
@@ -10,81 +10,76 @@ import textwrap
 from quadricslam import QuadricSlam
 from quadricslam import visualise
 from quadricslam.data_source.BOP_YCB_test import BOP_YCB_dataset
+from quadricslam.data_source.prefetching import PrefetchingDataSource
 from quadricslam.detector.from_bbox import FromBbox
+from quadricslam.map_io import MapReader, MapWriter, save_json, save_map
 
 
 from typing import Any, List, Optional, Tuple
 from quadricslam.data_associator.quadric_iou_associator import QuadricIouAssociator
 from quadricslam.visual_odometry.rgbd_cv2 import RgbdCv2
-from quadricslam.utils import initialise_quadric_from_depth, ps_and_qs_from_values
+from quadricslam.utils import initialise_quadric_from_depth
 
-import json
 import gtsam
 import gtsam_quadrics
 
  
-def run():
-
-    # Confirm dataset path is provided
-    if len(sys.argv) != 3:
-        print("ERROR: Invalid number of arguments")
-        sys.exit(1)
-    dataset_path = sys.argv[1]
-    optimiser_batch = (sys.argv[2].lower() == "true") # True or False
+def make_quadricslam(dataset_path: str, optimiser_batch: bool,
+                     **kwargs: Any) -> QuadricSlam:
+    # QuadricSLAM set up for a BOP YCB-V scene (kwargs go to QuadricSlam)
 
     # Pull camera calibration parameters.
     # (fx, fy, skew, u0, v0) - (1,5,2,3,6)
     # camera_calib = np.array([517.3, 516.5, 0, 318.6, 255.3])
 
     # Run QuadricSLAM
-    q = QuadricSlam(
-        data_source=BOP_YCB_dataset(path=dataset_path),
+    return QuadricSlam(
+        data_source=PrefetchingDataSource(BOP_YCB_dataset(path=dataset_path)),
         detector=FromBbox(path=dataset_path),
         # TODO needs a viable data association approach
         associator=QuadricIouAssociator(),
         optimiser_batch=optimiser_batch,
-        quadric_initialiser = initialise_quadric_from_depth
+        quadric_initialiser = initialise_quadric_from_depth,
+        **kwargs
         )
     # noise_odom = np.array([0.0] * 6, dtype=np.float64)
     # on_new_estimate=(
     #         lambda state: visualise(state.system.estimates, state.system.
     #                                 labels, state.system.optimiser_batch))
-    
-    q.spin()
+
+
+def save_output(q: QuadricSlam, output_path: str) -> None:
+    # Estimated poses, quadrics, & labels as a binary map (see
+    # quadricslam/map_io.py), or as the old JSON if output_path ends in .json
+    if output_path.endswith('.json'):
+        save_json(output_path, q.state)
+    else:
+        save_map(output_path, q.state,
+                 {'optimiser_batch': q.state.system.optimiser_batch})
+
+
+def run():
+
+    # Confirm dataset path is provided (add 'json' to also export the map as
+    # JSON, for the postprocessing notebooks)
+    if len(sys.argv) not in (3, 4):
+        print("ERROR: Invalid number of arguments")
+        sys.exit(1)
+    dataset_path = sys.argv[1]
+    optimiser_batch = (sys.argv[2].lower() == "true") # True or False
+
+    # Estimates are streamed to the map as they're made (every step in
+    # incremental mode, once at the end in batch mode)
+    map_path = dataset_path + "/output_batch.qmap"
+    with MapWriter(map_path, {'dataset': dataset_path,
+                              'optimiser_batch': optimiser_batch}) as w:
+        q = make_quadricslam(dataset_path, optimiser_batch, on_new_estimate=w)
+        q.spin()
     # visual_odometry=RgbdCv2()
+    print(MapReader(map_path).footprint())
+    if sys.argv[3:] == ["json"]:
+        MapReader(map_path).to_json(dataset_path + "/output_batch.json")
 
-    # store as json
-    # estimated poses and quadric parameters
-    poses, quadrics = ps_and_qs_from_values(q.state.system.estimates)
-
-    # label for each quadric key
-    labels = q.state.system.labels
-
-    # convert from gtsam.pose3 format to numpy array for the values
-    keys = poses.keys()
-    for k in keys:
-        poses[k] = poses[k].matrix().tolist()
-
-    # 5 usefull functions to convert from ConstrainedDualQuadric to serializable format
-    # pose, radii, centroid, matrix, normalizedMatrix - Q / Q(3, 3)
-    # https://github.com/qcr/gtsam-quadrics/blob/master/gtsam_quadrics/geometry/ConstrainedDualQuadric.h
-    keys = quadrics.keys()
-    for k in keys:
-        temp = np.eye(4)
-        temp[:3, :3] = quadrics[k].pose().rotation().matrix()
-        temp[:3, 3] = quadrics[k].pose().translation()
-        quadrics[k] = {"pose": temp.tolist(),
-                       "centroid": quadrics[k].centroid().tolist(),
-                       "radii": quadrics[k].radii().tolist()
-                       }
-
-    # save as a dictionary
-    dict_list = {"poses": poses, "quadrics": quadrics, "labels": labels}
-    
-
-    # dump into JSON file
-    with open(dataset_path + "/output_batch.json", "w") as json_file:
-        json.dump(dict_list, json_file)
 
 if __name__ == '__main__':
     run()
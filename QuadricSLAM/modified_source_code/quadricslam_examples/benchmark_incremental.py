@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# Synthetic benchmark for QuadricSLAM. A camera circles a handful of quadrics
+# for a configurable number of frames.
+#
+# In incremental (iSAM2) mode the time taken by each step is reported in
+# blocks. Per-step cost should stay flat as the sequence grows (i.e. it should
+# only depend on what each step adds), so the run fails if the mean step time
+# of the last full block is more than MAX_GROWTH times that of the first.
+#
+# In batch mode the graph is built, and the time taken to guess initial values
+# for the whole graph is reported.
+#
+# With 'budget', box factors are capped per quadric by an ObservationBudget,
+# and the number of factors it added, dropped, & replaced is reported.
+#
+# Usage:
+#   python3 -m quadricslam_examples.benchmark_incremental [NUM_FRAMES] \
+#       [batch] [budget]
+
+from spatialmath import SE3
+from typing import List, Optional, Tuple
+import gtsam
+import gtsam_quadrics
+import numpy as np
+import sys
+import time
+
+from quadricslam import (DataAssociator, DataSource, Detection, Detector,
+                         ObservationBudget, QuadricSlam, QuadricSlamState, qi)
+
+CALIB = np.array([525, 525, 0, 320, 240])
+IMAGE_SIZE = (640, 480)
+BLOCK_SIZE = 100
+MAX_GROWTH = 2.0
+RADIUS = 3
+QUADRICS = [
+    gtsam_quadrics.ConstrainedDualQuadric(
+        gtsam.Pose3(gtsam.Rot3(), gtsam.Point3(x, y, 0)), [0.2, 0.2, 0.3])
+    for x, y in [(0, 0), (0.6, 0.3), (-0.5, 0.4), (0.3, -0.6), (-0.4, -0.5)]
+]
+
+
+def _pose(i: int, num_frames: int) -> gtsam.Pose3:
+    a = 2 * np.pi * i / num_frames
+    return gtsam.PinholeCameraCal3_S2.Lookat(
+        [RADIUS * np.cos(a), RADIUS * np.sin(a), 1], [0, 0, 0], [0, 0, 1],
+        gtsam.Cal3_S2(CALIB)).pose()
+
+
+class CircleData(DataSource):
+
+    def __init__(self, num_frames: int) -> None:
+        self.num_frames = num_frames
+        self.restart()
+
+    def calib_rgb(self) -> np.ndarray:
+        return CALIB
+
+    def done(self) -> bool:
+        return self.i == self.num_frames
+
+    def next(
+        self, state: QuadricSlamState
+    ) -> Tuple[Optional[SE3], Optional[np.ndarray], Optional[np.ndarray]]:
+        self.i += 1
+        return _pose(self.i - 1, self.num_frames).matrix(), None, None
+
+    def restart(self) -> None:
+        self.i = 0
+
+
+class ProjectedDetector(Detector):
+
+    def __init__(self, num_frames: int) -> None:
+        self.num_frames = num_frames
+
+    def detect(self, state: QuadricSlamState) -> List[Detection]:
+        n = state.this_step
+        pose = _pose(n.i, self.num_frames)
+        bs = [
+            gtsam_quadrics.QuadricCamera.project(q, pose,
+                                                 gtsam.Cal3_S2(CALIB)).bounds()
+            for q in QUADRICS
+        ]
+        return [
+            Detection(label=str(i), bounds=b.vector(), pose_key=n.pose_key)
+            for i, b in enumerate(bs) if b.xmin() >= 0 and b.ymin() >= 0 and
+            b.xmax() <= IMAGE_SIZE[0] and b.ymax() <= IMAGE_SIZE[1]
+        ]
+
+
+class GroundTruthAssociator(DataAssociator):
+
+    def associate(
+        self, state: QuadricSlamState
+    ) -> Tuple[List[Detection], List[Detection], List[Detection]]:
+        # Labels are quadric indices, so association is free (we only want to
+        # time the SLAM back-end here)
+        s = state.system
+        n = state.this_step
+        for d in n.detections:
+            d.quadric_key = qi(int(d.label))
+        s.associated.extend(n.detections)
+        return n.detections, s.associated, []
+
+
+def make_quadricslam(num_frames: int,
+                     batch: bool = False,
+                     budget: Optional[ObservationBudget] = None,
+                     **kwargs) -> QuadricSlam:
+    return QuadricSlam(data_source=CircleData(num_frames),
+                       detector=ProjectedDetector(num_frames),
+                       associator=GroundTruthAssociator(),
+                       observation_budget=budget,
+                       optimiser_batch=batch,
+                       **kwargs)
+
+
+def step_times(q: QuadricSlam) -> List[float]:
+    # Steps through the whole sequence, returning the time each step took
+    ts = []
+    while not q.data_source.done():
+        t = time.perf_counter()
+        q.step()
+        ts.append(time.perf_counter() - t)
+    return ts
+
+
+def block_means(ts: List[float]) -> np.ndarray:
+    # Mean step time of each full block of BLOCK_SIZE steps
+    n = len(ts) // BLOCK_SIZE
+    return np.reshape(ts[:n * BLOCK_SIZE], (n, BLOCK_SIZE)).mean(axis=1)
+
+
+def growth(ts: List[float]) -> float:
+    # Mean step time of the last full block relative to the first
+    bs = block_means(ts)
+    if len(bs) < 2:
+        raise ValueError("Need at least %d steps to measure growth." %
+                         (2 * BLOCK_SIZE))
+    return bs[-1] / bs[0]
+
+
+def run():
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 1500
+    batch = 'batch' in [a.lower() for a in sys.argv[2:]]
+    budget = (ObservationBudget()
+              if 'budget' in [a.lower() for a in sys.argv[2:]] else None)
+    q = make_quadricslam(num_frames, batch, budget)
+
+    if batch:
+        while not q.data_source.done():
+            q.step()
+        t = time.perf_counter()
+        q.guess_initial_values()
+        print("Initialised %d values from %d factors in %.3fms" %
+              (q.state.system.estimates.size(), q.state.system.graph.size(),
+               (time.perf_counter() - t) * 1e3))
+        if budget is not None:
+            print("Box factors: %s" % budget.report())
+        return
+
+    ts = step_times(q)
+    print("%-12s %-16s %s" % ("Frames", "Mean step (ms)", "Max step (ms)"))
+    for i in range(0, len(ts), BLOCK_SIZE):
+        b = np.array(ts[i:i + BLOCK_SIZE]) * 1e3
+        print("%-12s %-16.3f %.3f" %
+              ("%d-%d" % (i, i + len(b) - 1), b.mean(), b.max()))
+    print("\nTotal: %.3fs for %d frames (%d factors, %d values)" %
+          (np.sum(ts), num_frames, q.state.system.graph.size(),
+           q.state.system.estimates.size()))
+    if budget is not None:
+        print("Box factors: %s" % budget.report())
+
+    g = growth(ts)
+    print("Last / first block mean step time: %.2fx" % g)
+    assert g <= MAX_GROWTH, (
+        "Per-step cost grew %.2fx over the sequence (limit %.1fx)" %
+        (g, MAX_GROWTH))
+
+
+if __name__ == '__main__':
+    run()
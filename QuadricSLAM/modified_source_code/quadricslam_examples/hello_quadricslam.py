@@ -42,18 +42,14 @@ class DummyAssociator(DataAssociator):
 
         ds = new_ds + s.unassociated
         newly_associated = [
-            d for d in ds if d.label in set(d.label for d in s.associated) or
+            d for d in ds if d.label in set(s.labels.values()) or
             len([x for x in ds if x.label == d.label]) >= 3
         ]
         for d in newly_associated:
             d.quadric_key = gtsam.symbol(d.label[0], int(d.label[1:]))
-        return (newly_associated, [
-            d for d in ds + s.associated
-            if d in newly_associated or d in s.associated
-        ], [
-            d for d in ds + s.associated
-            if d not in newly_associated and d not in s.associated
-        ])
+        s.associated.extend(newly_associated)
+        return (newly_associated, s.associated,
+                [d for d in ds if d not in newly_associated])
 
 
 class DummyData(DataSource):
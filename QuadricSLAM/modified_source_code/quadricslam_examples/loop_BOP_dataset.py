@@ -1,17 +1,13 @@
-# create a loop to run through all the dataset
-import subprocess
-import psutil
-import time
+# Runs QuadricSLAM (batch & incremental) on every scene of a dataset. This
+# used to run scenes one at a time, see run_experiments.py for the sweep
+# runner (which runs scenes in parallel, and skips finished runs).
+import sys
 
+from quadricslam_examples.run_experiments import DEFAULT_CONFIG, run_sweep
 
-# Replace 'your_script.py' with the path to the Python file you want to run
-script_path = 'BOP_YCB_dataset_test.py'
-data_path = '/home/allen/Desktop/BOP_dataset_oaslam/ycbv/test/0000'
+# path to the folder containing the scenes (000048, 000049, ...)
+data_path = '/home/allen/Desktop/BOP_dataset_oaslam/ycbv/test/'
 
-for i in range(48,60):
-    # Run the Python script with arguments in a subprocess
-    print(i)
-    process_sub = subprocess.Popen(['python3', script_path, data_path+str(i)])
-
-    while process_sub.poll() is None:
-        time.sleep(5)
\ No newline at end of file
+if __name__ == '__main__':
+    run_sweep(sys.argv[1] if len(sys.argv) > 1 else data_path,
+              DEFAULT_CONFIG)
@@ -6,20 +6,18 @@ from quadricslam.data_associator.quadric_iou_associator import QuadricIouAssocia
 from quadricslam.data_source.realsense import RealSense
 from quadricslam.detector.faster_rcnn import FasterRcnn
 from quadricslam.visual_odometry.rgbd_cv2 import RgbdCv2
-from quadricslam.visualisation import visualise
+from quadricslam.visualisation import AsyncVisualiser
 
 
 def run():
-    with RealSense() as rs:
+    with RealSense() as rs, AsyncVisualiser() as v:
         q = QuadricSlam(
             data_source=rs,
             detector=FasterRcnn(),
             visual_odometry=RgbdCv2(),
             associator=QuadricIouAssociator(),
             optimiser_batch=False,
-            on_new_estimate=(
-                lambda state: visualise(state.system.estimates, state.system.
-                                        labels, state.system.optimiser_batch)),
+            on_new_estimate=v,
             quadric_initialiser=utils.initialise_quadric_from_depth)
         q.spin()
 
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+# Renders a map streamed by QuadricSLAM (e.g. output.qmap, see
+# quadricslam/map_io.py) to a video or a sequence of PNG frames, without a
+# display:
+#
+#   python3 -m quadricslam_examples.render_map MAP OUTPUT [CAMERA] [EVERY]
+#
+# OUTPUT is a video if it ends in .mp4 / .avi / .mkv / .mov, otherwise a
+# directory for the frames. CAMERA is 'fixed' (default) or 'follow', & a
+# frame is rendered for every EVERY'th step the map changed at (default 1).
+# Add 'live' to keep rendering a map that is still being written.
+
+import sys
+import time
+
+from quadricslam.render import render_map
+
+
+def run():
+    args = [a for a in sys.argv[1:] if a != 'live']
+    if len(args) < 2:
+        print("ERROR: Paths to a map & an output are required arguments.")
+        sys.exit(1)
+    t = time.monotonic()
+    n = render_map(args[0],
+                   args[1],
+                   camera=args[2] if len(args) > 2 else 'fixed',
+                   every=int(args[3]) if len(args) > 3 else 1,
+                   live='live' in sys.argv[1:])
+    print("Rendered %d frames to '%s' in %.1fs" %
+          (n, args[1], time.monotonic() - t))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+# Runs every method / configuration on every scene of a dataset, repeated a
+# number of times, across a pool of processes. Each run is pinned to its own
+# set of cores (and BLAS / OpenMP thread pools are capped to match), so runs
+# sharing the machine don't steal time from each other and timings stay
+# comparable with a run on an idle machine.
+#
+# Results are content-addressed: a run's directory is named by a hash of its
+# method configuration, the contents of the scene's annotation files (& the
+# listing of its images), and the repetition number. A run is built in a
+# '.partial' directory and only renamed into place (with a DONE marker) once
+# it has finished, so an interrupted sweep can simply be rerun & will skip
+# every run that already finished.
+#
+# Each run directory has run.json (what was run), profile.json (a
+# ResourceProfiler report for QuadricSLAM, or a summary from getrusage() for
+# commands like OA-SLAM), log.txt, and the method's output (output.qmap for
+# QuadricSLAM). index.json maps methods & scenes to run directories, and
+# summary.json aggregates the profiles of repeated runs.
+#
+# Methods are given as a JSON config, e.g.
+#   {
+#     "repetitions": 3,
+#     "cores_per_run": 1,
+#     "methods": [
+#       {"name": "quadricslam-batch", "method": "quadricslam",
+#        "optimiser_batch": true},
+#       {"name": "quadricslam-noisy", "method": "quadricslam",
+#        "optimiser_batch": false, "noise_odom": [0.05, 0.05, 0.05,
+#        0.05, 0.05, 0.05], "options": {"optimiser_lag": 50}},
+#       {"name": "oa-slam", "method": "command",
+#        "cwd": "/path/to/OA-SLAM/bin",
+#        "command": ["./oa-slam", "../Vocabulary/ORBvoc.txt",
+#                    "/path/to/camera_simulator.yaml", "{scene}/rgb/",
+#                    "{scene}/detections_yolov5.json", "null",
+#                    "points+objects", "{run}"],
+#        "outputs": ["{cwd}/{run}"]}
+#     ]
+#   }
+# Command arguments can use {scene} (the scene's path), {scene_name}, {run}
+# (a unique name for the run), {out} (the run's directory), and {cwd}.
+#
+# Usage:
+#   python3 -m quadricslam_examples.run_experiments DATASET_ROOT \
+#       [CONFIG_JSON] [RESULTS_DIR]
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RUNNER_VERSION = 1
+DONE = 'DONE'
+DEFAULT_CONFIG = {
+    'repetitions': 1,
+    'cores_per_run': 1,
+    'methods': [{
+        'name': 'quadricslam-batch',
+        'method': 'quadricslam',
+        'optimiser_batch': True
+    }, {
+        'name': 'quadricslam-incremental',
+        'method': 'quadricslam',
+        'optimiser_batch': False
+    }]
+}
+# Thread pools that would otherwise size themselves to the whole machine
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                    'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+IMAGE_FOLDERS = ('rgb', 'depth', 'mask', 'mask_visib')
+
+
+def find_scenes(root: str) -> List[str]:
+    # Scene folders (those with images) in a dataset, in order
+    return sorted(
+        os.path.join(root, d)
+        for d in os.listdir(root)
+        if not d.startswith('.') and
+        os.path.isdir(os.path.join(root, d, 'rgb')))
+
+
+def scene_fingerprint(scene: str) -> str:
+    # Hash of the contents of a scene's annotation files (poses,
+    # intrinsics, boxes, detections...), & the names and sizes of its images
+    # (hashing every image would take longer than some runs)
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(scene)):
+        p = os.path.join(scene, name)
+        if os.path.isfile(p) and not name.startswith(('.', 'output')):
+            if name.endswith('.bin'):
+                # (caches, like the scene manifest)
+                continue
+            h.update(name.encode())
+            with open(p, 'rb') as f:
+                for b in iter(lambda: f.read(1 << 20), b''):
+                    h.update(b)
+        elif name in IMAGE_FOLDERS and os.path.isdir(p):
+            for e in sorted(os.scandir(p), key=lambda e: e.name):
+                h.update(('%s/%s:%d' %
+                          (name, e.name, e.stat().st_size)).encode())
+    return h.hexdigest()
+
+
+def run_key(method: Dict[str, Any], fingerprint: str, repetition: int) -> str:
+    # (a method's name doesn't change what's run, so isn't part of the key)
+    return hashlib.sha256(
+        json.dumps(
+            {
+                'version': RUNNER_VERSION,
+                'method': {k: v for k, v in method.items() if k != 'name'},
+                'scene': fingerprint,
+                'repetition': repetition
+            },
+            sort_keys=True).encode()).hexdigest()
+
+
+class Run:
+
+    def __init__(self, method: Dict[str, Any], scene: str, repetition: int,
+                 key: str, results: str) -> None:
+        self.method = method
+        self.scene = scene
+        self.repetition = repetition
+        self.key = key
+        self.path = os.path.join(results, key[:2], key)
+
+    def done(self) -> bool:
+        return os.path.exists(os.path.join(self.path, DONE))
+
+    def spec(self) -> Dict[str, Any]:
+        return {
+            'key': self.key,
+            'method': self.method,
+            'scene': self.scene,
+            'scene_name': os.path.basename(os.path.normpath(self.scene)),
+            'repetition': self.repetition
+        }
+
+
+def plan(root: str, config: Dict[str, Any], results: str) -> List[Run]:
+    # Every run of the sweep, interleaved so early results cover every
+    # scene & method (runs with identical keys are only listed once)
+    runs: Dict[str, Run] = {}
+    scenes = [(s, scene_fingerprint(s)) for s in find_scenes(root)]
+    for r in range(config.get('repetitions', 1)):
+        for s, fp in scenes:
+            for m in config['methods']:
+                k = run_key(m, fp, r)
+                runs.setdefault(k, Run(m, s, r, k, results))
+    return list(runs.values())
+
+
+def core_slots(cores_per_run: int) -> List[List[int]]:
+    # Disjoint sets of cores (from those this process may use), one per
+    # concurrent run
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    n = max(1, len(cores) // cores_per_run)
+    return [
+        cores[i * cores_per_run:(i + 1) * cores_per_run] for i in range(n)
+    ]
+
+
+def _profile_command(run: Run, out: str, log: Any) -> Dict[str, Any]:
+    # Runs an external command (e.g. OA-SLAM), profiled with getrusage()
+    # (this process only ever runs one command, so the children's usage is
+    # the command's)
+    from quadricslam.profiler import MB, REPORT_VERSION, available_cores
+
+    m = run.method
+    cwd = m.get('cwd')
+    fmt = {
+        'scene': run.scene.rstrip('/'),
+        'scene_name': os.path.basename(os.path.normpath(run.scene)),
+        'run': 'run_' + run.key[:12],
+        'out': out,
+        'cwd': cwd or os.getcwd()
+    }
+    cmd = [a.format(**fmt) for a in m['command']]
+    t = time.perf_counter()
+    subprocess.run(cmd, cwd=cwd, stdout=log, stderr=subprocess.STDOUT,
+                   check=True)
+    duration = time.perf_counter() - t
+    for o in m.get('outputs', []):
+        src = o.format(**fmt)
+        if os.path.exists(src):
+            shutil.move(
+                src, os.path.join(out,
+                                  os.path.basename(os.path.normpath(src))))
+
+    cores = available_cores()
+    cpu_seconds = peak = float('nan')
+    if resource is not None:
+        r = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_seconds = r.ru_utime + r.ru_stime
+        peak = (r.ru_maxrss if sys.platform == 'darwin' else r.ru_maxrss *
+                1024) / MB
+    return {
+        'version': REPORT_VERSION,
+        'label': m.get('name'),
+        'meta': run.spec(),
+        'cores': cores,
+        'duration': duration,
+        'cpu_seconds': cpu_seconds,
+        'cpu_percent': 100 * cpu_seconds / duration / cores,
+        'peak_rss_mb': peak,
+        'phases': {}
+    }
+
+
+def _profile_quadricslam(run: Run, out: str) -> Dict[str, Any]:
+    import numpy as np
+    from quadricslam import ResourceProfiler
+    from quadricslam_examples.BOP_YCB_dataset_test import (make_quadricslam,
+                                                           save_output)
+
+    m = run.method
+    kwargs = dict(m.get('options', {}))
+    kwargs.update({
+        k: np.array(m[k], dtype=np.float64)
+        for k in ('noise_prior', 'noise_odom', 'noise_boxes')
+        if k in m
+    })
+    p = ResourceProfiler(rate_hz=m.get('rate_hz', 50), label=m.get('name'))
+    p.meta = run.spec()
+    q = make_quadricslam(run.scene, m.get('optimiser_batch', True),
+                         profiler=p, **kwargs)
+    with p:
+        q.spin()
+    save_output(q, os.path.join(out, 'output.qmap'))
+    return p.report()
+
+
+_slots: Any = None
+
+
+def _init_worker(slots: Any, threads: int) -> None:
+    global _slots
+    _slots = slots
+    for v in THREAD_VARIABLES:
+        os.environ[v] = str(threads)
+
+
+def _execute(run: Run) -> Tuple[str, Optional[str]]:
+    # Runs in a fresh worker process (so nothing, including peak memory,
+    # carries over between runs), pinned to a free set of cores. Returns the
+    # run's key & the error if it failed.
+    cores = _slots.get()
+    partial = run.path + '.partial'
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        with open(os.path.join(partial, 'run.json'), 'w') as f:
+            json.dump(dict(run.spec(), cores=cores), f, indent=2)
+
+        with open(os.path.join(partial, 'log.txt'), 'w') as log:
+            if run.method['method'] == 'quadricslam':
+                with contextlib.redirect_stdout(log):
+                    report = _profile_quadricslam(run, partial)
+            elif run.method['method'] == 'command':
+                report = _profile_command(run, partial, log)
+            else:
+                raise ValueError("Unknown method '%s'." %
+                                 run.method['method'])
+        with open(os.path.join(partial, 'profile.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        open(os.path.join(partial, DONE), 'w').close()
+
+        shutil.rmtree(run.path, ignore_errors=True)
+        os.rename(partial, run.path)
+        return run.key, None
+    except BaseException:
+        # (the partial directory is kept to debug from, & cleared on rerun)
+        return run.key, traceback.format_exc()
+    finally:
+        _slots.put(cores)
+
+
+def write_index(runs: Sequence[Run], results: str) -> None:
+    # Run directories of each method & scene, & aggregated profiles of
+    # repeated runs
+    from quadricslam import aggregate_reports
+
+    index: Dict[str, Dict[str, List[str]]] = {}
+    summary: Dict[str, Dict[str, Any]] = {}
+    for m_name, s_name, rs in _groups(runs):
+        done = [r for r in rs if r.done()]
+        index.setdefault(m_name, {})[s_name] = [
+            os.path.relpath(r.path, results) for r in done
+        ]
+        reports = []
+        for r in done:
+            with open(os.path.join(r.path, 'profile.json')) as f:
+                reports.append(json.load(f))
+        if reports:
+            summary.setdefault(m_name, {})[s_name] = aggregate_reports(reports)
+    with open(os.path.join(results, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    with open(os.path.join(results, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+
+def _groups(runs: Sequence[Run]) -> List[Tuple[str, str, List[Run]]]:
+    groups: Dict[Tuple[str, str], List[Run]] = {}
+    for r in runs:
+        name = r.method.get('name', r.method['method'])
+        groups.setdefault(
+            (name, os.path.basename(os.path.normpath(r.scene))), []).append(r)
+    return [(m, s, rs) for (m, s), rs in groups.items()]
+
+
+def run_sweep(root: str,
+              config: Dict[str, Any],
+              results: Optional[str] = None) -> List[Tuple[str, str]]:
+    # Runs everything in the sweep that hasn't already finished, returning
+    # the (key, error) of every failed run
+    results = os.path.join(root, 'results') if results is None else results
+    os.makedirs(results, exist_ok=True)
+    runs = plan(root, config, results)
+    pending = [r for r in runs if not r.done()]
+    cores_per_run = config.get('cores_per_run', 1)
+    slots = core_slots(cores_per_run)
+    print("%d runs (%d already done), %d at a time on %d core(s) each" %
+          (len(runs), len(runs) - len(pending), len(slots), cores_per_run))
+
+    failed = []
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    for s in slots:
+        queue.put(s)
+    pool = ctx.Pool(len(slots),
+                    initializer=_init_worker,
+                    initargs=(queue, cores_per_run),
+                    maxtasksperchild=1)
+    try:
+        for i, (key, error) in enumerate(
+                pool.imap_unordered(_execute, pending)):
+            print("[%d/%d] %s %s" % (i + 1, len(pending), key[:12],
+                                     'FAILED' if error else 'done'))
+            if error:
+                print(error)
+                failed.append((key, error))
+        pool.close()
+    except KeyboardInterrupt:
+        # Finished runs are kept, so rerunning picks up from here
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        write_index(runs, results)
+    return failed
+
+
+def run() -> None:
+    if len(sys.argv) < 2:
+        print("ERROR: Invalid number of arguments")
+        sys.exit(1)
+    config = DEFAULT_CONFIG
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            config = json.load(f)
+    failed = run_sweep(sys.argv[1], config,
+                       sys.argv[3] if len(sys.argv) > 3 else None)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    run()
@@ -1,59 +1,98 @@
-import subprocess
-import psutil
-import time
-
-# Replace 'your_script.py' with the path to the Python file you want to run
-script_path = 'BOP_YCB_dataset_test.py'
-data_path = '/home/allen/Desktop/BOP_dataset_quadricslam/ycbv/test/000048'
-
-
-# Run the Python script with arguments in a subprocess
-process_sub = subprocess.Popen(['python3', script_path, data_path])
-
-# Get the PID of the process
-process_pid = process_sub.pid
-
-print(f"Process PID: {process_pid}")
-
-process = psutil.Process(process_pid)
-
-
-# Initialize variables for monitoring
-cpu_percent_list = []
-ram_usage_list = []
-start_time = time.time()
-
-#num_cores = psutil.cpu_count(logical=False)
-
-# Monitor until the process dies
-while process_sub.poll() is None:
-    # Monitor CPU utilization
-    cpu_percent_list.append(process.cpu_percent(interval=1)/8)
-    # Monitor RAM utilization
-    ram_usage_list.append(process.memory_info().rss)
-    
-
-end_time = time.time()
-execution_time = end_time - start_time
-
-cpu_percent_list = cpu_percent_list[2:-2]
-ram_usage_list = ram_usage_list[2:-2]
-divisor = 1024 * 1024
-ram_usage_list = [element / divisor for element in ram_usage_list] # Convert from bytes to MB
-
-
-indices_to_remove = [index for index, value in enumerate(ram_usage_list) if value < 2]
-ram_usage_list = [value for index, value in enumerate(ram_usage_list) if index not in indices_to_remove]
-cpu_percent_list = [value for index, value in enumerate(cpu_percent_list) if index not in indices_to_remove]
-
-
-# Calculate average CPU and RAM utilization
-average_cpu_utilization = sum(cpu_percent_list) / len(cpu_percent_list)
-average_ram_utilization = sum(ram_usage_list) / len(ram_usage_list)
-
-
-print(f"Average CPU Utilization: {average_cpu_utilization:.2f}%")
-print("Min and Max CPU Utilization: ", min(cpu_percent_list), max(cpu_percent_list))
-print(f"Average RAM Utilization: {average_ram_utilization:.2f} MB")
-print("Min and Max RAM Utilization: ", min(ram_usage_list), max(ram_usage_list))
-print(f"Total Execution Time: {execution_time:.2f} seconds")
\ No newline at end of file
+#!/usr/bin/env python3
+
+# Records the CPU & RAM usage of QuadricSLAM on a BOP YCB-V scene, with a
+# ResourceProfiler sampling inside the process running SLAM (rather than
+# polling it from outside once a second). Only spin() is profiled, so
+# interpreter start-up, set up, and writing output aren't counted.
+#
+# Each run happens in a fresh process (so peak memory & caches from one run
+# don't leak into the next), and writes its own report. With more than one
+# run the reports are aggregated into means with 95% confidence intervals.
+#
+# Usage:
+#   python3 -m quadricslam_examples.system_prof_eval DATASET_PATH \
+#       [batch] [RUNS] [RATE_HZ]
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+import json
+import multiprocessing
+import os
+import sys
+
+from quadricslam import ResourceProfiler, aggregate_reports
+from quadricslam.profiler import format_aggregate
+
+
+def profile_run(dataset_path: str,
+                optimiser_batch: bool,
+                rate_hz: float = 50,
+                label: Optional[str] = None) -> Dict[str, Any]:
+    # Profiles one run of QuadricSLAM in this process
+    from quadricslam_examples.BOP_YCB_dataset_test import make_quadricslam
+
+    p = ResourceProfiler(rate_hz=rate_hz, label=label)
+    p.meta = {'dataset': dataset_path, 'optimiser_batch': optimiser_batch}
+    q = make_quadricslam(dataset_path, optimiser_batch, profiler=p)
+    with p:
+        q.spin()
+    return p.report()
+
+
+def profile_dataset(dataset_path: str,
+                    optimiser_batch: bool,
+                    runs: int = 1,
+                    rate_hz: float = 50,
+                    out_dir: Optional[str] = None) -> List[Dict[str, Any]]:
+    # Profiles 'runs' runs, each in a fresh process, writing each report to
+    # out_dir (defaults to the dataset folder)
+    out_dir = dataset_path if out_dir is None else out_dir
+    mode = 'batch' if optimiser_batch else 'incremental'
+    reports = []
+    for i in range(runs):
+        with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context('spawn')) as e:
+            r = e.submit(profile_run, dataset_path, optimiser_batch, rate_hz,
+                         '%s-%d' % (mode, i)).result()
+        with open(os.path.join(out_dir, 'profile_%s_%d.json' % (mode, i)),
+                  'w') as f:
+            json.dump(r, f, indent=2)
+        reports.append(r)
+    return reports
+
+
+def print_report(r: Dict[str, Any]) -> None:
+    print("Dataset: %s (%s)" % (r['meta']['dataset'], r['label']))
+    print("Cores available: %d, samples: %d at %g Hz" %
+          (r['cores'], r['samples'], r['rate_hz']))
+    print("Average CPU Utilization: %.2f%%" % r['cpu_percent'])
+    print("Min and Max CPU Utilization: %.2f%% %.2f%%" %
+          (r['cpu_percent_samples']['min'], r['cpu_percent_samples']['max']))
+    print("Average RAM Utilization: %.2f MB" % r['rss_mb']['mean'])
+    print("Min and Max RAM Utilization: %.2f MB %.2f MB" %
+          (r['rss_mb']['min'], r['rss_mb']['max']))
+    print("Peak RAM: %.2f MB" % r['peak_rss_mb'])
+    print("Total Execution Time: %.2f seconds" % r['duration'])
+    for name, ph in r['phases'].items():
+        print("  %-12s %8.2f s %8.2f%% CPU" %
+              (name, ph['wall'], ph['cpu_percent']))
+
+
+def run() -> None:
+    if len(sys.argv) < 2:
+        print("ERROR: Invalid number of arguments")
+        sys.exit(1)
+    dataset_path = sys.argv[1]
+    optimiser_batch = 'batch' in sys.argv[2:3]
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    rate_hz = float(sys.argv[4]) if len(sys.argv) > 4 else 50
+
+    reports = profile_dataset(dataset_path, optimiser_batch, runs, rate_hz)
+    for r in reports:
+        print_report(r)
+    if len(reports) > 1:
+        print(format_aggregate(aggregate_reports(reports)))
+
+
+if __name__ == '__main__':
+    run()
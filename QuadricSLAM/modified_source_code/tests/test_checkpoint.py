@@ -0,0 +1,86 @@
+import pytest
+
+gtsam = pytest.importorskip('gtsam')
+pytest.importorskip('gtsam_quadrics')
+
+import numpy as np
+
+from quadricslam import Checkpointer, QuadricSlam, latest_checkpoint
+from quadricslam_examples.benchmark_incremental import (CircleData,
+                                                        GroundTruthAssociator,
+                                                        ProjectedDetector)
+
+NUM_FRAMES = 60
+CHECKPOINT_AT = 40
+
+MODES = {
+    'batch': {
+        'optimiser_batch': True
+    },
+    'isam2': {
+        'optimiser_batch': False
+    },
+    'fixed_lag': {
+        'optimiser_batch': False,
+        'optimiser_lag': 10
+    }
+}
+
+
+class SeekableCircleData(CircleData):
+
+    def seek(self, i: int) -> None:
+        self.i = i
+
+
+def _quadricslam(mode, **kwargs):
+    return QuadricSlam(data_source=SeekableCircleData(NUM_FRAMES),
+                       detector=ProjectedDetector(NUM_FRAMES),
+                       associator=GroundTruthAssociator(),
+                       **MODES[mode],
+                       **kwargs)
+
+
+def _estimates(q):
+    keys = q.state.keys
+    es = q.state.system.estimates
+    return ({k: p.matrix() for k, p in keys.poses(es).items()}, {
+        k: np.concatenate([x.pose().matrix().ravel(),
+                           x.radii()]) for k, x in keys.quadrics(es).items()
+    })
+
+
+@pytest.mark.parametrize('mode', list(MODES))
+def test_resumed_run_matches_uninterrupted(tmp_path, mode):
+    q = _quadricslam(mode)
+    q.spin()
+    expected = _estimates(q)
+    sizes = (len(q.state.system.associated), q.state.system.graph.size())
+
+    # Run part way, checkpointing as we go
+    q = _quadricslam(mode,
+                     checkpointer=Checkpointer(str(tmp_path),
+                                               every=CHECKPOINT_AT // 2))
+    for _ in range(CHECKPOINT_AT):
+        q.step()
+    q.checkpointer.close()
+    path = latest_checkpoint(str(tmp_path))
+    assert path is not None and path.endswith('%08d.npz' %
+                                              (CHECKPOINT_AT - 1))
+
+    # Resume from the checkpoint in a fresh system, & finish the run
+    q = _quadricslam(mode)
+    q.restore(path)
+    assert q.data_source.i == CHECKPOINT_AT
+    q.spin()
+    assert (len(q.state.system.associated),
+            q.state.system.graph.size()) == sizes
+
+    # Synthetic data is noise free, so every mode lands on (nearly) the
+    # same estimates, resumed or not
+    tol = 1e-2 if mode == 'fixed_lag' else 1e-4
+    for e, r in zip(expected, _estimates(q)):
+        assert set(e) == set(r)
+        for k in e:
+            assert np.allclose(e[k], r[k], atol=tol)
+
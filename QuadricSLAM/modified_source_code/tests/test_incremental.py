@@ -0,0 +1,86 @@
+import pytest
+
+gtsam = pytest.importorskip('gtsam')
+pytest.importorskip('gtsam_quadrics')
+
+from quadricslam import ObservationBudget
+from quadricslam_examples.benchmark_incremental import (make_quadricslam,
+                                                        step_times)
+
+
+class RecordingISAM2:
+    # Delegates to iSAM2, recording the size of everything it's handed
+
+    def __init__(self, params: gtsam.ISAM2Params) -> None:
+        self.isam = gtsam.ISAM2(params)
+        self.updates = []
+
+    def update(self, factors, values, *args):
+        self.updates.append((factors.size(), values.size()))
+        return self.isam.update(factors, values, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.isam, name)
+
+
+def _pending(q):
+    s = q.state.system
+    return (s.pending_factors.size(), s.pending_values.size(),
+            len(s.pending_removals))
+
+
+def test_pending_cleared_after_each_update():
+    q = make_quadricslam(50)
+    while not q.data_source.done():
+        q.step()
+        assert _pending(q) == (0, 0, 0)
+    s = q.state.system
+    assert s.estimates.size() > 0
+    assert s.optimiser.getFactorsUnsafe().size() == s.graph.size()
+
+
+def test_reset_clears_pending():
+    q = make_quadricslam(50)
+    q.step()
+    s = q.state.system
+    q.add_factor(s.graph.at(0))
+    assert _pending(q)[0] == 1
+    q.reset()
+    assert _pending(q) == (0, 0, 0)
+    assert q.state.system.graph.size() == 0
+
+
+def test_budget_replaces_initial_boxes():
+    # In batch mode quadrics are only initialised by spin(), so the boxes
+    # they'll be initialised from must follow the budget's replacements
+    budget = ObservationBudget(max_observations=3)
+    q = make_quadricslam(30, batch=True, budget=budget)
+    step_times(q)
+    s = q.state.system
+    assert budget.report()['replaced'] > 0
+    assert s.init_boxes
+    for fs in s.init_boxes.values():
+        assert len(fs) <= budget.max_observations
+    assert sum(len(fs) for fs in s.init_boxes.values()) == sum(
+        len(os) for os in budget.observations.values())
+
+
+def test_updates_only_get_each_steps_additions():
+    q = make_quadricslam(50)
+    s = q.state.system
+    s.optimiser_type = RecordingISAM2
+    updated = 0
+    while not q.data_source.done():
+        nf, nv = s.graph.size(), s.estimates.size()
+        q.step()
+        if s.optimiser is None or len(s.optimiser.updates) == updated:
+            continue
+        updated += 1
+        assert len(s.optimiser.updates) == updated
+        fs, vs = s.optimiser.updates[-1]
+        assert fs == s.graph.size() - nf
+        assert vs == s.estimates.size() - nv
+        if updated > 1:
+            assert fs < s.graph.size()
+    assert updated > 1
+    assert s.optimiser.getFactorsUnsafe().size() == s.graph.size()
@@ -0,0 +1,100 @@
+import pytest
+
+gtsam = pytest.importorskip('gtsam')
+pytest.importorskip('gtsam_quadrics')
+
+import numpy as np
+from spatialmath import SE3
+
+from quadricslam import Detection, QuadricSlamState, StepState, SystemState
+from quadricslam.keyframe_policy.motion_keyframe_policy import (
+    MotionKeyframePolicy)
+from quadricslam_examples.benchmark_incremental import (_pose,
+                                                        make_quadricslam,
+                                                        step_times)
+
+
+def _step(state, i, odom, labels=('a',)):
+    n = StepState(i, state.keys)
+    n.odom = odom
+    n.detections = [
+        Detection(l, np.array([0, 0, 10, 10]), n.pose_key) for l in labels
+    ]
+    return n
+
+
+def _moved(t=(0, 0, 0), angle=0.0):
+    T = np.eye(4)
+    T[:3, :3] = gtsam.Rot3.Yaw(angle).matrix()
+    T[:3, 3] = t
+    return T
+
+
+def _is_keyframe(policy, odom, i=1, labels=('a',), k_odom=np.eye(4)):
+    state = QuadricSlamState(
+        SystemState(initial_pose=SE3(),
+                    noise_prior=np.zeros(6),
+                    noise_odom=np.full(6, 0.01),
+                    noise_boxes=np.full(4, 3.0),
+                    optimiser_batch=False,
+                    optimiser_params=gtsam.ISAM2Params()))
+    state.prev_keyframe = _step(state, 0, k_odom)
+    state.this_step = _step(state, i, odom, labels)
+    return policy.is_keyframe(state)
+
+
+def test_motion_thresholds():
+    p = MotionKeyframePolicy(translation=0.1, rotation=np.radians(5))
+    assert not _is_keyframe(p, np.eye(4))
+    assert not _is_keyframe(p, _moved(t=(0.05, 0.05, 0)))
+    assert _is_keyframe(p, _moved(t=(0.1, 0, 0)))
+    assert not _is_keyframe(p, _moved(angle=np.radians(4)))
+    assert _is_keyframe(p, _moved(angle=np.radians(6)))
+
+    # Motion is relative to the last keyframe
+    assert not _is_keyframe(p, _moved(t=(1.05, 0, 0)),
+                            k_odom=_moved(t=(1, 0, 0)))
+
+
+def test_label_changes():
+    assert _is_keyframe(MotionKeyframePolicy(), np.eye(4), labels=('b',))
+    assert _is_keyframe(MotionKeyframePolicy(), np.eye(4), labels=('a', 'b'))
+    assert not _is_keyframe(MotionKeyframePolicy(), np.eye(4),
+                            labels=('a', 'a'))
+    assert not _is_keyframe(MotionKeyframePolicy(label_changes=False),
+                            np.eye(4),
+                            labels=('b',))
+
+
+def test_max_gap_and_missing_odometry():
+    p = MotionKeyframePolicy(max_gap=5)
+    assert not _is_keyframe(p, np.eye(4), i=4)
+    assert _is_keyframe(p, np.eye(4), i=5)
+    assert _is_keyframe(p, None)
+    assert _is_keyframe(p, np.eye(4), k_odom=None)
+
+
+def test_between_factors_span_skipped_frames():
+    # Only max_gap makes keyframes, so every between factor spans 4 frames
+    num_frames = 30
+    q = make_quadricslam(num_frames,
+                         keyframe_policy=MotionKeyframePolicy(
+                             translation=np.inf,
+                             rotation=np.inf,
+                             max_gap=4,
+                             label_changes=False))
+    step_times(q)
+    s = q.state.system
+    bs = [
+        s.graph.at(i) for i in range(s.graph.size())
+        if isinstance(s.graph.at(i), gtsam.BetweenFactorPose3)
+    ]
+    assert len(bs) == (num_frames - 1) // 4
+    for f in bs:
+        i0, i1 = (q.state.keys.lookup(k)[1] for k in f.keys())
+        assert i1 - i0 == 4
+        assert f.measured().equals(
+            _pose(i0, num_frames).between(_pose(i1, num_frames)), 1e-6)
+        assert np.allclose(f.noiseModel().sigmas(),
+                           s.odometry_noise(4).sigmas())
+        assert np.allclose(f.noiseModel().sigmas(), 0.01 * 2)
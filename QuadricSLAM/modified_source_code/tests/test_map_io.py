@@ -0,0 +1,97 @@
+import pytest
+
+# (map_io itself is plain NumPy, but importing the package needs gtsam)
+pytest.importorskip('gtsam_quadrics')
+
+import json
+import numpy as np
+import os
+
+from quadricslam.map_io import MapReader, MapWriter
+
+
+def _poses(n, offset=0.0):
+    Ts = np.tile(np.eye(4), (n, 1, 1))
+    Ts[:, :3, 3] = np.arange(3 * n).reshape(n, 3) + offset
+    return Ts
+
+
+def _write_step(w, step, n_poses, offset=0.0):
+    # Poses 0..n_poses, & 2 quadrics (the second only from step 2 on)
+    nq = 1 if step < 2 else 2
+    w.write(step, np.arange(n_poses), _poses(n_poses, offset),
+            np.arange(100, 100 + nq), _poses(nq, offset),
+            np.full((nq, 3), 0.5), ['chair', 'table'][:nq])
+
+
+def _write(path, **kwargs):
+    w = MapWriter(path, {'run': 'test'}, **kwargs)
+    _write_step(w, 0, 2)
+    _write_step(w, 1, 2)  # (nothing changed, so no chunk)
+    _write_step(w, 2, 3, offset=0.5)
+    return w
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'map.qmap')
+    _write(path).close()
+    r = MapReader(path)
+    assert r.meta == {'run': 'test'}
+    assert not r.truncated
+    assert [s.step for s in r] == [0, 2]
+
+    # Maps are looked up by step, not chunk
+    for step in (0, 1):
+        ks, Ts = r.trajectory(step)
+        assert list(ks) == [0, 1]
+        assert np.array_equal(Ts, _poses(2))
+    ks, Ts = r.trajectory()
+    assert list(ks) == [0, 1, 2]
+    assert np.array_equal(Ts, _poses(3, 0.5))
+    assert list(r.trajectory(chunks=1)[0]) == [0, 1]
+
+    ks, Ts, radii, labels = r.quadrics()
+    assert list(ks) == [100, 101]
+    assert np.array_equal(Ts, _poses(2, 0.5))
+    assert np.array_equal(radii, np.full((2, 3), 0.5))
+    assert labels == ['chair', 'table']
+    assert r.quadrics(1)[3] == ['chair']
+
+
+def test_flushed_while_writing(tmp_path):
+    path = str(tmp_path / 'map.qmap')
+    w = _write(path)
+    assert [s.step for s in MapReader(path)] == [0, 2]
+    w.close()
+
+    w = _write(path, flush_every=0)
+    assert os.path.getsize(path) < w.bytes
+    w.close()
+    assert len(MapReader(path)) == 2
+
+
+def test_truncated(tmp_path):
+    path = str(tmp_path / 'map.qmap')
+    _write(path).close()
+    with open(path, 'rb') as f:
+        b = f.read()
+    with open(path, 'wb') as f:
+        f.write(b[:-10])
+    r = MapReader(path)
+    assert r.truncated
+    assert [s.step for s in r] == [0]
+    assert list(r.trajectory()[0]) == [0, 1]
+
+
+def test_to_json(tmp_path):
+    path = str(tmp_path / 'map.qmap')
+    _write(path).close()
+    r = MapReader(path)
+    r.to_json(str(tmp_path / 'map.json'), step=1)
+    with open(str(tmp_path / 'map.json')) as f:
+        out = json.load(f)
+    assert set(out['poses']) == {'0', '1'}
+    assert np.array_equal(out['poses']['1'], _poses(2)[1])
+    assert out['quadrics']['100']['radii'] == [0.5] * 3
+    assert out['quadrics']['100']['centroid'] == _poses(1)[0, :3, 3].tolist()
+    assert out['labels'] == {'100': 'chair'}
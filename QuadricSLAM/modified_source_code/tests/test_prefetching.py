@@ -0,0 +1,81 @@
+import pytest
+
+pytest.importorskip('gtsam_quadrics')
+
+import numpy as np
+
+from quadricslam.data_source import DataSource
+from quadricslam.data_source.prefetching import PrefetchingDataSource
+
+N = 5
+
+
+class Sequential(DataSource):
+
+    def __init__(self) -> None:
+        self.restart()
+
+    def calib_rgb(self):
+        return np.array([1, 1, 0, 0, 0])
+
+    def done(self):
+        return self.i == N
+
+    def next(self, state):
+        if self.done():
+            raise RuntimeError("No frames left.")
+        self.i += 1
+        return np.eye(4) * self.i, None, None
+
+    def restart(self):
+        self.i = 0
+
+
+class RandomAccess(Sequential):
+
+    def length(self):
+        return N
+
+    def read(self, i):
+        return np.eye(4) * (i + 1), None, None
+
+
+@pytest.mark.parametrize('source', [Sequential, RandomAccess])
+def test_frames_in_order_then_exhausted(source):
+    p = PrefetchingDataSource(source(), depth=2)
+    frames = []
+    while not p.done():
+        frames.append(p.next(None)[0][0, 0])
+    assert frames == list(range(1, N + 1))
+
+    # Reading past the end raises the same error every time (rather than
+    # an IndexError, or blocking)
+    for _ in range(2):
+        with pytest.raises(RuntimeError, match='No frames left'):
+            p.next(None)
+    assert p.done()
+
+    p.restart()
+    assert not p.done() and p.next(None)[0][0, 0] == 1
+    p.close()
+
+
+class StateDependent(RandomAccess):
+    uses_state = True
+
+    def next(self, state):
+        # (the frame depends on the state it's read for)
+        super().next(state)
+        return np.eye(4) * state, None, None
+
+
+def test_state_dependent_sources_are_passed_through():
+    p = PrefetchingDataSource(StateDependent(), depth=2)
+    frames = []
+    while not p.done():
+        frames.append(p.next(10 * len(frames))[0][0, 0])
+        assert p.occupancy() == 0
+    assert frames == [10 * i for i in range(N)]
+    with pytest.raises(RuntimeError, match='No frames left'):
+        p.next(0)
+    p.close()
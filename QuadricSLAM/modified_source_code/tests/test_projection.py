@@ -0,0 +1,107 @@
+import pytest
+
+gtsam = pytest.importorskip('gtsam')
+gtsam_quadrics = pytest.importorskip('gtsam_quadrics')
+
+import numpy as np
+
+from quadricslam.utils import iou_matrix, project_quadrics
+
+CALIB = np.array([525, 525, 0, 320, 240], dtype=np.float64)
+
+# Camera at (3,0,1) looking at the origin (i.e. along -x)
+EYE = [3, 0, 1]
+POSE = gtsam.PinholeCameraCal3_S2.Lookat(EYE, [0, 0, 0], [0, 0, 1],
+                                         gtsam.Cal3_S2(CALIB)).pose()
+QUADRICS = [
+    gtsam_quadrics.ConstrainedDualQuadric(
+        gtsam.Pose3(gtsam.Rot3.Ypr(*ypr), gtsam.Point3(*t)), radii)
+    for ypr, t, radii in [
+        # In front of the camera
+        ((0, 0, 0), (0, 0, 0), [0.2, 0.2, 0.3]),
+        ((0.3, 0.1, -0.2), (0.5, 0.4, 0.2), [0.1, 0.3, 0.2]),
+        ((1.0, 0, 0), (-1, -0.8, 0.5), [0.4, 0.1, 0.1]),
+        # Behind the camera
+        ((0, 0, 0), (6, 0, 1), [0.3, 0.3, 0.3]),
+        ((0.2, 0, 0), (4, 1, 1), [0.2, 0.2, 0.2]),
+        # Containing the camera (not an ellipse when projected)
+        ((0, 0, 0), EYE, [1, 1, 1]),
+    ]
+]
+
+
+def _per_pair_bounds():
+    bs = []
+    for q in QUADRICS:
+        try:
+            bs.append(
+                gtsam_quadrics.QuadricCamera.project(
+                    q, POSE, gtsam.Cal3_S2(CALIB)).bounds().vector())
+        except RuntimeError:
+            bs.append(np.full(4, np.nan))
+    return np.array(bs)
+
+
+def _per_pair_ious(a, b):
+    # What QuadricIouAssociator(batch=False) does for each pair
+    ious = np.zeros((len(a), len(b)))
+    for i, x in enumerate(a):
+        for j, y in enumerate(b):
+            ious[i, j] = gtsam_quadrics.AlignedBox2(x).iou(
+                gtsam_quadrics.AlignedBox2(y))
+            if np.isnan(ious[i, j]):
+                ious[i, j] = 0
+    return ious
+
+
+def _numpy_iou(a, b):
+    # Plain reference IOU (0 for boxes that don't overlap, or aren't boxes)
+    if np.isnan(a).any() or np.isnan(b).any():
+        return 0.0
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if not (w > 0 and h > 0):
+        return 0.0
+    return w * h / ((a[2] - a[0]) * (a[3] - a[1]) +
+                    (b[2] - b[0]) * (b[3] - b[1]) - w * h)
+
+
+def _detections(bounds):
+    # Boxes overlapping each finite projection, plus some that overlap
+    # nothing or are degenerate
+    rng = np.random.default_rng(0)
+    finite = bounds[np.all(np.isfinite(bounds), axis=1)]
+    return np.vstack([
+        finite + rng.uniform(-10, 10, finite.shape),
+        [[0, 0, 5, 5], [600, 400, 640, 480], [np.nan] * 4, [10, 10, 10, 20]]
+    ])
+
+
+def test_project_quadrics_matches_per_pair():
+    batch = project_quadrics(
+        np.array([q.matrix() for q in QUADRICS]), POSE.matrix(), CALIB)
+    assert batch.shape == (len(QUADRICS), 4)
+    assert np.allclose(batch, _per_pair_bounds(), equal_nan=True)
+
+
+def test_iou_matrix_matches_per_pair():
+    bounds = project_quadrics(
+        np.array([q.matrix() for q in QUADRICS]), POSE.matrix(), CALIB)
+    ds = _detections(bounds)
+    batch = iou_matrix(ds, bounds)
+    assert np.allclose(batch, _per_pair_ious(ds, _per_pair_bounds()))
+    assert np.all(np.isfinite(batch))
+
+
+def test_iou_matrix_numpy():
+    a = np.array([[0, 0, 10, 10], [5, 5, 15, 15], [20, 20, 30, 30],
+                  [np.nan] * 4, [3, 3, 3, 8]],
+                 dtype=np.float64)
+    b = np.array([[0, 0, 10, 10], [5, 0, 10, 20], [np.nan, 0, 1, 1]],
+                 dtype=np.float64)
+    ious = iou_matrix(a, b)
+    assert ious.shape == (len(a), len(b))
+    assert np.allclose(ious,
+                       [[_numpy_iou(x, y) for y in b] for x in a])
+    assert ious[0, 0] == 1
+    assert np.all(ious[3] == 0) and np.all(ious[:, 2] == 0)
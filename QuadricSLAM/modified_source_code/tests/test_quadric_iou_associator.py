@@ -0,0 +1,109 @@
+import pytest
+
+gtsam = pytest.importorskip('gtsam')
+gtsam_quadrics = pytest.importorskip('gtsam_quadrics')
+
+import numpy as np
+from spatialmath import SE3
+
+from quadricslam import Detection, QuadricSlamState, StepState, SystemState
+from quadricslam.data_associator.quadric_iou_associator import (
+    QuadricIouAssociator)
+
+CALIB = np.array([525, 525, 0, 320, 240], dtype=np.float64)
+POSE = gtsam.PinholeCameraCal3_S2.Lookat([3, 0, 1], [0, 0, 0], [0, 0, 1],
+                                         gtsam.Cal3_S2(CALIB)).pose()
+
+# Two quadrics in view, & one behind the camera (culled)
+VISIBLE = [(0, 0.5, 0), (0, -0.5, 0)]
+HIDDEN = [(6, 0, 1)]
+
+
+def _add_quadrics(values, keys, ts):
+    for i, t in enumerate(ts):
+        gtsam_quadrics.ConstrainedDualQuadric(
+            gtsam.Pose3(gtsam.Rot3(), gtsam.Point3(*t)),
+            [0.2, 0.2, 0.2]).addToValues(values, keys.qi(i))
+
+
+def _state():
+    state = QuadricSlamState(
+        SystemState(initial_pose=SE3(),
+                    noise_prior=np.zeros(6),
+                    noise_odom=np.full(6, 0.01),
+                    noise_boxes=np.full(4, 3.0),
+                    optimiser_batch=False,
+                    optimiser_params=gtsam.ISAM2Params()))
+    s = state.system
+    s.calib_rgb = CALIB
+    _add_quadrics(s.estimates, state.keys, VISIBLE + HIDDEN)
+    for k in state.keys.quadric_keys(s.estimates):
+        s.labels[k] = 'a'
+
+    n = StepState(0, state.keys)
+    n.odom = POSE.matrix()
+    qs = state.keys.quadrics(s.estimates)
+    n.detections = [
+        # Each visible quadric's projection
+        Detection('a',
+                  gtsam_quadrics.QuadricCamera.project(
+                      qs[state.keys.qi(i)], POSE,
+                      gtsam.Cal3_S2(CALIB)).bounds().vector(), n.pose_key)
+        for i in range(len(VISIBLE))
+    ] + [
+        # New objects entering view, overlapping nothing in the map
+        Detection('a', np.array([10, 10, 60, 60]), n.pose_key),
+        Detection('b', np.array([560, 380, 630, 470]), n.pose_key),
+    ]
+    state.this_step = n
+    return state
+
+
+@pytest.mark.parametrize('kwargs', [{}, {
+    'frustum_culling': True
+}, {
+    'frustum_culling': True,
+    'per_label': True
+}, {
+    'frustum_culling': True,
+    'batch': False
+}])
+def test_every_detection_gets_a_key(kwargs):
+    state = _state()
+    a = QuadricIouAssociator(**kwargs)
+    assert len(a.candidates(state)) == (len(VISIBLE) if a.frustum_culling
+                                        else len(VISIBLE + HIDDEN))
+
+    new, associated, unassociated = a.associate(state)
+    ks = [d.quadric_key for d in new]
+    assert all(k is not None for k in ks)
+    assert unassociated == []
+    assert len(associated) == len(new)
+
+    # Visible quadrics are matched, & the rest are new (distinct) quadrics
+    existing = state.keys.quadric_keys(state.system.estimates)
+    assert ks[:len(VISIBLE)] == existing[:len(VISIBLE)]
+    assert not set(ks[len(VISIBLE):]) & set(existing)
+    assert len(set(ks)) == len(ks)
+
+
+def test_culling_follows_touched_quadrics():
+    state = _state()
+    s = state.system
+    a = QuadricIouAssociator(frustum_culling=True)
+    assert list(a.candidates(state)) == [0, 1]
+
+    # New estimates, where the first quadric has moved out of view & the
+    # hidden one into it
+    s.estimates = gtsam.Values()
+    _add_quadrics(s.estimates, state.keys, [HIDDEN[0], VISIBLE[1], (0, 0, 0)])
+    state.keys.touch([state.keys.qi(0), state.keys.qi(2)])
+    assert list(a.candidates(state)) == [1, 2]
+
+    # New quadrics are appended to the index, rather than rebuilding it
+    builds = state.keys.spatial_index(s.estimates).builds
+    gtsam_quadrics.ConstrainedDualQuadric(
+        gtsam.Pose3(gtsam.Rot3(), gtsam.Point3(0, 0, 0.5)),
+        [0.2, 0.2, 0.2]).addToValues(s.estimates, state.keys.qi(3))
+    assert list(a.candidates(state)) == [1, 2, 3]
+    assert state.keys.spatial_index(s.estimates).builds == builds
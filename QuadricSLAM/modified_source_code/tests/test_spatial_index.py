@@ -0,0 +1,71 @@
+import pytest
+
+pytest.importorskip('gtsam_quadrics')
+
+import numpy as np
+
+from quadricslam.spatial_index import QuadricSpatialIndex
+
+CALIB = np.array([525, 525, 0, 320, 240], dtype=np.float64)
+IMAGE_SIZE = (640, 480)
+POSE = np.eye(4)
+
+
+def _spheres(rng, n):
+    return (rng.uniform(-10, 10, (n, 3)) + [0, 0, 10],
+            rng.uniform(0.1, 1, n))
+
+
+def _same_as_fresh(index):
+    fresh = QuadricSpatialIndex(index.centroids, index.radii)
+    for far in (np.inf, 8, 15):
+        assert np.array_equal(index.in_frustum(POSE, CALIB, IMAGE_SIZE,
+                                               far=far),
+                              fresh.in_frustum(POSE, CALIB, IMAGE_SIZE,
+                                               far=far))
+    for p in ([0, 0, 0], [3, -2, 12]):
+        assert np.array_equal(index.within(p, 4), fresh.within(p, 4))
+
+
+def test_small_moves_keep_the_tree():
+    rng = np.random.default_rng(0)
+    index = QuadricSpatialIndex(*_spheres(rng, 200), tolerance=0.2)
+    rows = rng.choice(200, 50, replace=False)
+    index.set(rows, index.centroids[rows] + rng.uniform(-0.1, 0.1, (50, 3)),
+              index.radii[rows])
+    assert index.builds == 1
+    _same_as_fresh(index)
+
+
+def test_large_moves_rebuild_the_tree():
+    rng = np.random.default_rng(1)
+    index = QuadricSpatialIndex(*_spheres(rng, 200), tolerance=0.2)
+    index.set([7], index.centroids[[7]] + [5, 0, 0], [3])
+    assert index.builds == 2
+    _same_as_fresh(index)
+
+
+def test_appended_spheres_are_found():
+    rng = np.random.default_rng(2)
+    index = QuadricSpatialIndex(*_spheres(rng, 200))
+    for i in range(5):
+        # An update & a few new spheres each time
+        cs, rs = _spheres(rng, 3)
+        index.set([i, len(index), len(index) + 1, len(index) + 2],
+                  np.vstack([index.centroids[[i]], cs]),
+                  np.concatenate([index.radii[[i]], rs]))
+        _same_as_fresh(index)
+    assert len(index) == 215 and index.builds == 1
+
+    # Enough new spheres eventually rebuild the tree
+    cs, rs = _spheres(rng, 40)
+    index.set(np.arange(len(index), len(index) + 40), cs, rs)
+    assert index.builds == 2
+    _same_as_fresh(index)
+
+
+def test_empty():
+    index = QuadricSpatialIndex(np.zeros((0, 3)), np.zeros(0))
+    assert len(index.in_frustum(POSE, CALIB, IMAGE_SIZE, far=10)) == 0
+    index.set([0], [[0, 0, 5]], [1])
+    assert list(index.in_frustum(POSE, CALIB, IMAGE_SIZE, far=10)) == [0]